@@ -0,0 +1 @@
+python -c "import sys; from xpcs_viewer.batch_average import main; sys.exit(main())" $@
@@ -0,0 +1 @@
+python -c "from xpcs_viewer.batch_fit import main; main()" $@
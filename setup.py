@@ -6,7 +6,9 @@ with open("requirements.txt", "r") as f:
 setup(name='xpcs_viewer',
       version='0.258',
       description='A python-based interactive visualization tool to view XPCS dataset',
-      scripts=['run_viewer.bat', 'run_viewer'],
+      scripts=['run_viewer.bat', 'run_viewer', 'run_batch_fit.bat',
+               'run_batch_fit', 'run_batch_average.bat',
+               'run_batch_average'],
       url='https://github.com/AdvancedPhotonSource/pyXpcsViewer',
       packages=find_packages(),
       include_package_data=True,
@@ -1,11 +1,27 @@
 # from xpcs_viwer.viewer_kernel import Viewer_Kernel
-from .viewer import run 
-from .viewer_kernel import ViewerKernel
-from .xpcs_file import XpcsFile as xf
-from .xpcs_file import XpcsFile
+import importlib
 
+# the gui is imported on first use, so the headless commands and the worker
+# processes don't load PyQt
+_lazy_attrs = {
+    'run': ('.viewer', 'run'),
+    'ViewerKernel': ('.viewer_kernel', 'ViewerKernel'),
+    'xf': ('.xpcs_file', 'XpcsFile'),
+    'XpcsFile': ('.xpcs_file', 'XpcsFile'),
+}
 
-__all__ = [run, xf, XpcsFile]
+
+def __getattr__(name):
+    if name not in _lazy_attrs:
+        raise AttributeError('module %r has no attribute %r' % (__name__,
+                                                                 name))
+    module, attr = _lazy_attrs[name]
+    value = getattr(importlib.import_module(module, __name__), attr)
+    globals()[name] = value
+    return value
+
+
+__all__ = ['run', 'xf', 'XpcsFile']
 __version__ = '0.1.0'
 __author__ = 'Miaoqi Chu'
 __credits__ = 'Argonne National Laboratory'
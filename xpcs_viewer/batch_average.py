@@ -0,0 +1,318 @@
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import logging
+import numpy as np
+from .batch_fit import collect_files
+from .helper.average import (run_average, run_average_groups,
+                             run_intt_outlier, finalize_average,
+                             get_average_stat, write_average, group_files,
+                             get_group_path, weighting_modes)
+
+
+logger = logging.getLogger(__name__)
+
+# the fields that can be averaged, the same as the average panel
+avg_fields = ('saxs_2d', 'saxs_1d', 'g2', 'g2_err', 'G2', 'IP', 'IF')
+
+
+class ProgressWriter:
+    """
+    write the progress as one json object per line, so the averaging can be
+    followed by a script; the progress events are written at most once per
+    interval seconds, the other events are always written;
+    """
+
+    def __init__(self, stream=None, interval=1.0) -> None:
+        self.stream = stream
+        self.interval = interval
+        self.t_start = time.perf_counter()
+        self.t_emit = 0.0
+
+    def emit(self, event, force=False, **kwargs):
+        if self.stream is None:
+            return
+        now = time.perf_counter()
+        if event == 'progress' and not force and \
+                now - self.t_emit < self.interval:
+            return
+        if event == 'progress':
+            self.t_emit = now
+        record = {'event': event, 'time': time.time(),
+                  'elapsed_s': round(now - self.t_start, 3)}
+        record.update(kwargs)
+        self.stream.write(json.dumps(record) + '\n')
+        self.stream.flush()
+
+
+def get_stage_callback(stage, get_total, progress, clock):
+    """
+    create the callback of a pass of the averaging that counts the files
+    and the bytes, and writes the progress with the rates of the pass;
+    :param get_total: returns the number of files of the pass; it's only
+        known for the accumulation pass when the screening is done
+    :param clock: dictionary of {stage: the time the pass started}; the
+        time of the first shard is used if the stage is not in it
+    """
+    count = {'done': 0, 'timed': 0, 'bytes': 0}
+
+    def callback(idx, part):
+        now = time.perf_counter()
+        t_start = clock.setdefault(stage, now)
+        total = get_total()
+        count['done'] = min(total, count['done'] + idx.size)
+        # the files done before the job resumed are not timed
+        if not part.get('resumed', False):
+            count['timed'] += idx.size
+            count['bytes'] += int(np.sum(part['nbytes']))
+        wall = now - t_start
+        file_rate = count['timed'] / wall if wall > 0 else 0.0
+        eta = None
+        if file_rate > 0:
+            eta = round((total - count['done']) / file_rate, 1)
+        progress.emit('progress', force=count['done'] == total, stage=stage,
+                      done=count['done'], total=total,
+                      mb_per_s=round(count['bytes'] / 1e6 / wall, 3)
+                      if wall > 0 else 0.0,
+                      files_per_s=round(file_rate, 3), eta_s=eta)
+
+    return callback
+
+
+def batch_average(flist, save_path=None, fields=('saxs_2d', ),
+                  avg_window=3, avg_qindex=0, avg_blmin=0.95, avg_blmax=1.05,
+                  num_workers=None, chunk_size=64, mem_budget=None,
+                  checkpoint_interval=60, incremental=False, group_by=None,
+                  intt_clusters=None, abs_scale=True, retries=2,
+                  retry_delay=10, weighting='uniform', ftype='nexus',
+                  slab_stat=True, progress=None, is_killed=None):
+    """
+    average a list of files without the gui, with the same passes as the
+    average jobs in the viewer: the optional Int_t outlier stage, the g2
+    baseline screening and the accumulation in the worker processes;
+    :param flist: list of the paths of the files
+    :param save_path: the output file; default Avg + the first filename in
+        the current directory. With group_by, each group is saved to
+        save_path with its label before the suffix, and incremental extends
+        the output of each group
+    :param checkpoint_interval: see AverageToolbox.do_average; None to
+        disable the checkpoint
+    :param slab_stat: see AverageToolbox.do_average
+    :param abs_scale: if True, saxs_1d is also weighted by the absolute
+        cross section scale of each file, the same as the average panel
+    :param progress: a ProgressWriter; None to skip the progress
+    :param is_killed: a function that returns True to stop the averaging;
+        the checkpoint is saved so the same command resumes
+    :return: dictionary of {label: output summary}, label is None without
+        group_by; None if killed
+    """
+    if progress is None:
+        progress = ProgressWriter()
+    if save_path is None:
+        save_path = 'Avg' + os.path.basename(flist[0])
+    # the files are read relative to their common directory
+    paths = [os.path.abspath(x) for x in flist]
+    work_dir = os.path.commonpath([os.path.dirname(x) for x in paths])
+    flist = [os.path.relpath(x, work_dir) for x in paths]
+
+    if group_by is None:
+        groups = {None: flist}
+    else:
+        groups = group_files(flist, work_dir, group_by, ftype)
+    progress.emit('start', num_files=len(flist), num_groups=len(groups),
+                  work_dir=work_dir, output=save_path)
+
+    rejected = 0
+    clock = {'intt': time.perf_counter()}
+    if intt_clusters is not None:
+        ret = run_intt_outlier(groups, work_dir, num_workers, chunk_size,
+                               intt_clusters,
+                               get_stage_callback('intt', lambda: len(flist),
+                                                  progress, clock),
+                               is_killed, ftype)
+        if ret is None:
+            progress.emit('killed', stage='intt')
+            return None
+        keep = dict(zip([x for v in groups.values() for x in v],
+                        ret['accept']))
+        rejected = int(np.sum(~ret['accept']))
+        groups = {name: [x for x in v if keep[x]]
+                  for name, v in groups.items()}
+        groups = {name: v for name, v in groups.items() if len(v) > 0}
+
+    num_files = sum(len(v) for v in groups.values())
+    if num_files == 0:
+        logger.error('no file is left to average')
+        return {}
+    num_accept = [0]
+    num_screened = [0]
+
+    def count_accept(idx, part):
+        num_accept[0] += int(np.sum(part['accept']))
+        num_screened[0] += idx.size
+        screen_callback(idx, part)
+        if num_screened[0] >= num_files:
+            clock.setdefault('average', time.perf_counter())
+
+    clock['screen'] = time.perf_counter()
+    screen_callback = get_stage_callback('screen', lambda: num_files,
+                                         progress, clock)
+    kwargs = dict(work_dir=work_dir, num_workers=num_workers,
+                  shard_size=chunk_size, screen_callback=count_accept,
+                  callback=get_stage_callback('average',
+                                              lambda: max(1, num_accept[0]),
+                                              progress, clock),
+                  is_killed=is_killed, fields=fields, avg_window=avg_window,
+                  avg_qindex=avg_qindex, avg_blmin=avg_blmin,
+                  avg_blmax=avg_blmax, abs_scale=abs_scale,
+                  mem_budget=mem_budget, retries=retries,
+                  retry_delay=retry_delay, weighting=weighting, ftype=ftype,
+                  checkpoint_interval=checkpoint_interval)
+    kwargs['checkpoint'] = None
+    if checkpoint_interval is not None:
+        kwargs['checkpoint'] = save_path + '.ckpt'
+    kwargs['base'] = None
+    if incremental and group_by is None:
+        kwargs['base'] = save_path
+    elif incremental:
+        kwargs['base'] = {x: get_group_path(save_path, x) for x in groups}
+    if group_by is None:
+        total = run_average(groups[None], **kwargs)
+        totals = None if total is None else {None: total}
+    else:
+        totals = run_average_groups(groups, **kwargs)
+    if totals is None:
+        progress.emit('killed', stage='average')
+        return None
+
+    summary = {}
+    for label, total in totals.items():
+        path = save_path
+        if label is not None:
+            path = get_group_path(save_path, label)
+        summary[label] = {
+            'output': None,
+            'num_files': len(total['flist']),
+            'accepted': int(np.sum(total['accept'])),
+            'averaged': int(np.sum(total['mask'])),
+            'read_MB': float(np.sum(total['nbytes'])) / 1e6,
+        }
+        result = finalize_average(total)
+        if result is None:
+            logger.info('no file is averaged for %s', path)
+            continue
+        template = os.path.join(work_dir, total['flist'][np.nonzero(
+            total['mask'])[0][0]])
+        write_average(path, template, result,
+                      get_average_stat(total, slab_stat), total, ftype,
+                      slab_stat)
+        summary[label]['output'] = path
+        progress.emit('written', group=label, **summary[label])
+
+    progress.emit('finished', intt_rejected=rejected,
+                  outputs=[x['output'] for x in summary.values()
+                           if x['output'] is not None])
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='average many xpcs files without the gui; the progress '
+                    'is written to stdout as one json object per line')
+    parser.add_argument('inputs', nargs='+',
+                        help='directories, glob patterns, files or text '
+                             'files with one filename per line')
+    parser.add_argument('-o', '--output', default=None,
+                        help='the averaged file; default Avg + the first '
+                             'filename')
+    parser.add_argument('-j', '--num-workers', type=int, default=None)
+    parser.add_argument('--fields', nargs='+', choices=avg_fields,
+                        default=['saxs_2d', 'saxs_1d', 'g2', 'g2_err'])
+    parser.add_argument('--blmin', type=float, default=0.95,
+                        help='the minimal g2 baseline to accept a file')
+    parser.add_argument('--blmax', type=float, default=1.05,
+                        help='the maximal g2 baseline to accept a file')
+    parser.add_argument('--qindex', type=int, default=0,
+                        help='the q index of the g2 baseline')
+    parser.add_argument('--window', type=int, default=3,
+                        help='the number of the last g2 points of the '
+                             'baseline')
+    parser.add_argument('--chunk-size', type=int, default=64,
+                        help='the maximal number of files in a shard')
+    parser.add_argument('--mem-budget', type=int, default=None,
+                        help='the memory budget in MB of each worker to '
+                             'stream G2, IP and IF')
+    parser.add_argument('--checkpoint-interval', type=float, default=60,
+                        help='the interval in seconds to save the '
+                             'checkpoint; 0 to disable')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only add the new files to an existing output')
+    parser.add_argument('--group-by', default=None,
+                        help='a regex of the filename or a metadata key to '
+                             'average the files in groups')
+    parser.add_argument('--intt-clusters', type=int, default=None,
+                        help='the number of clusters of the Int_t outlier '
+                             'stage')
+    parser.add_argument('--weighting', choices=weighting_modes,
+                        default='uniform',
+                        help='the weights of the files: inverse_variance '
+                             'uses g2_err, intensity the mean of Int_t')
+    parser.add_argument('--no-abs-scale', action='store_true',
+                        help='do not weight saxs_1d by the absolute cross '
+                             'section scale')
+    parser.add_argument('--no-slab-stat', action='store_true',
+                        help='skip the std_err and the state of G2, IP and '
+                             'IF; the output can not be extended')
+    parser.add_argument('--retries', type=int, default=2)
+    parser.add_argument('--progress', choices=['json', 'none'],
+                        default='json')
+    parser.add_argument('--progress-interval', type=float, default=1.0,
+                        help='the minimal interval in seconds of the '
+                             'progress lines')
+    parser.add_argument('--ftype', default='nexus')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(name)-24s: %(message)s')
+    if args.blmax <= args.blmin:
+        parser.error('--blmax must be larger than --blmin')
+
+    flist = collect_files(args.inputs)
+    if len(flist) == 0:
+        logger.error('no file found')
+        return 1
+
+    # stop at the next shard on ctrl-c or a job scheduler, and keep the
+    # checkpoint so the same command resumes
+    killed = []
+
+    def on_signal(signum, frame):
+        logger.info('signal %d received; stopping', signum)
+        killed.append(signum)
+
+    signal.signal(signal.SIGINT, on_signal)
+    signal.signal(signal.SIGTERM, on_signal)
+
+    stream = sys.stdout if args.progress == 'json' else None
+    summary = batch_average(
+        flist, args.output, fields=args.fields, avg_window=args.window,
+        avg_qindex=args.qindex, avg_blmin=args.blmin, avg_blmax=args.blmax,
+        num_workers=args.num_workers, chunk_size=args.chunk_size,
+        mem_budget=args.mem_budget,
+        checkpoint_interval=args.checkpoint_interval or None,
+        incremental=args.incremental, group_by=args.group_by,
+        intt_clusters=args.intt_clusters, abs_scale=not args.no_abs_scale,
+        retries=args.retries, weighting=args.weighting, ftype=args.ftype,
+        slab_stat=not args.no_slab_stat,
+        progress=ProgressWriter(stream, args.progress_interval),
+        is_killed=lambda: len(killed) > 0)
+    if not summary or all(x['output'] is None for x in summary.values()):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
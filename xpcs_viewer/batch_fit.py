@@ -0,0 +1,365 @@
+import io
+import os
+import sys
+import csv
+import glob
+import time
+import argparse
+import logging
+import traceback
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from .fileIO.hdf_reader import get
+from .helper.fitting import (fit_with_fixed_raw, fit_tauq_batch, get_g2_p0,
+                             correct_g2_err, goodness_of_fit, quick_look_g2,
+                             single_exp_all, double_exp_all, power_law)
+
+
+logger = logging.getLogger(__name__)
+
+# the same default values as the g2 and diffusion tabs in the viewer
+default_bounds = {
+    'single': [[0.04, 1e-5, 0.5, 0.95],
+               [0.2, 1.0, 2.0, 1.05]],
+    'double': [[0.04, 1e-5, 0.5, 0.95, 1e-5, 0.5, 0.501],
+               [0.2, 1.0, 2.0, 1.05, 1.0, 2.0, 1.0]],
+}
+default_tauq_bounds = [[1e-12, -2.5], [1e-3, -0.5]]
+
+param_names = {
+    'single': ['a', 'b', 'c', 'd'],
+    'double': ['a', 'b', 'c', 'd', 'b2', 'c2', 'f'],
+}
+
+
+def get_columns(fit_func):
+    names = param_names[fit_func]
+    return ['file', 'kind', 'q_index', 'q'] + names + \
+        [x + '_err' for x in names] + ['chi2', 'success']
+
+
+def read_g2(full_path, ftype='nexus'):
+    """
+    read the fields needed by the g2 fitting, without loading the whole
+    xpcs file;
+    :param full_path: the path of the xpcs result file
+    :param ftype: ['nexus' | 'legacy']
+    :return: tuple of (t_el, ql_dyn, g2, g2_err)
+    """
+    fields = ['t0', 'avg_frames', 'stride_frames', 'tau', 'ql_dyn', 'g2',
+              'g2_err']
+    ret = get(full_path, fields, 'alias', ftype=ftype)
+    t_el = ret['t0'] * ret['avg_frames'] * ret['stride_frames'] * ret['tau']
+    return t_el, ret['ql_dyn'], ret['g2'], ret['g2_err']
+
+
+def fit_file(full_path, fit_func='single', bounds=None, fit_flag=None,
+             q_range=None, t_range=None, tauq_bounds=None, tauq_flag=None,
+             tauq_range=None, chi2_max=None, quick=False, ftype='nexus'):
+    """
+    fit g2 and tau(q) for one file; this function runs in the worker
+    processes so it must not depend on any gui object;
+    :param quick: if True, use the non-iterative quick look estimate instead
+        of the nonlinear g2 fitting; the errors are not available and the
+        tau(q) fitting uses equal weights in log scale;
+    :return: list of rows, see get_columns for the order of the columns;
+        the file column is the absolute path and the tau(q) row is the last
+    """
+    if bounds is None:
+        bounds = default_bounds[fit_func]
+    bounds = np.array(bounds)
+    num_args = bounds.shape[1]
+    if fit_flag is None:
+        fit_flag = [True] * num_args
+    if tauq_bounds is None:
+        tauq_bounds = default_tauq_bounds
+    if tauq_flag is None:
+        tauq_flag = [True, True]
+    func = single_exp_all if fit_func == 'single' else double_exp_all
+
+    fname = os.path.abspath(full_path)
+    t_el, ql_dyn, g2, g2_err = read_g2(full_path, ftype)
+    ql_dyn = np.atleast_1d(ql_dyn)
+    g2 = g2.reshape(t_el.size, -1)
+    g2_err = g2_err.reshape(t_el.size, -1)
+
+    t_idx = np.ones(t_el.size, dtype=bool)
+    if t_range is not None:
+        t_idx = (t_el >= t_range[0]) & (t_el <= t_range[1])
+    q_idx = np.ones(ql_dyn.size, dtype=bool)
+    if q_range is not None:
+        q_idx = (ql_dyn >= q_range[0]) & (ql_dyn <= q_range[1])
+
+    t_el = t_el[t_idx]
+    q = ql_dyn[q_idx]
+    g2 = g2[t_idx][:, q_idx]
+    sigma = correct_g2_err(g2_err[t_idx][:, q_idx])
+
+    if quick:
+        ql = quick_look_g2(t_el, g2)
+        fit_val = np.full((q.size, 2, num_args), np.nan)
+        fit_val[:, 0, 0:4] = np.stack([ql['contrast'], ql['tau'],
+                                       ql['stretch'], ql['baseline']], -1)
+        chi2 = goodness_of_fit(single_exp_all, t_el, g2, sigma,
+                               fit_val[:, :, 0:4], [True] * 4)['chi2']
+        tau = fit_val[:, 0, 1]
+        # the estimate is not trusted out of the measured delays
+        success = ql['valid'] & (tau >= np.min(t_el)) & \
+            (tau <= np.max(t_el))
+        tau_err = np.where(success, tau, -1)
+    else:
+        p0 = get_g2_p0(t_el, g2, bounds, fit_func)
+        fit_x = np.logspace(np.log10(np.min(t_el)) - 0.5,
+                            np.log10(np.max(t_el)) + 0.5, 128)
+        fit_line, fit_val = fit_with_fixed_raw(func, t_el, g2, sigma, bounds,
+                                               fit_flag, fit_x, p0=p0,
+                                               warm_start=True)
+        chi2 = goodness_of_fit(func, t_el, g2, sigma, fit_val,
+                               fit_flag)['chi2']
+        success = [x['success'] for x in fit_line]
+        # failed fittings have -1 err
+        tau, tau_err = fit_val[:, 0, 1], fit_val[:, 1, 1]
+
+    rows = []
+    q_index = np.nonzero(q_idx)[0]
+    for n in range(q.size):
+        rows.append([fname, 'g2', int(q_index[n]), q[n]] +
+                    list(fit_val[n, 0]) + list(fit_val[n, 1]) +
+                    [chi2[n], bool(success[n])])
+
+    # tau(q) from the successful g2 fittings
+    valid = tau_err > 0
+    if chi2_max:
+        valid &= chi2 <= chi2_max
+    if tauq_range is not None:
+        valid &= (q >= tauq_range[0]) & (q <= tauq_range[1])
+
+    tauq_val = np.full((2, num_args), np.nan)
+    flag = False
+    tauq_chi2 = np.nan
+    if np.sum(valid) >= 2:
+        tq_line, tq_val = fit_tauq_batch([q[valid]], [tau[valid]],
+                                         [tau_err[valid]], tauq_bounds,
+                                         tauq_flag)
+        tauq_val[:, 0:2] = tq_val[0]
+        flag = tq_line[0]['success']
+        tauq_chi2 = goodness_of_fit(
+            power_law, q[valid], tau[valid].reshape(-1, 1),
+            tau_err[valid].reshape(-1, 1), tq_val, tauq_flag)['chi2'][0]
+    rows.append([fname, 'tauq', -1, np.nan] + list(tauq_val[0]) +
+                list(tauq_val[1]) + [tauq_chi2, flag])
+    return rows
+
+
+def _fit_file_safe(full_path, kwargs):
+    try:
+        return fit_file(full_path, **kwargs)
+    except Exception:
+        logger.error('failed to fit %s: %s', full_path,
+                     traceback.format_exc())
+        return None
+
+
+def collect_files(inputs, suffix=('.hdf', '.h5')):
+    """
+    expand the inputs to a sorted list of files; each input can be a
+    directory, a glob pattern, a text file listing one file per line or a
+    file to fit;
+    """
+    flist = []
+    for x in inputs:
+        if os.path.isdir(x):
+            flist += [os.path.join(x, t) for t in sorted(os.listdir(x))
+                      if os.path.splitext(t)[1] in suffix and
+                      not t.startswith('.')]
+        elif os.path.isfile(x) and os.path.splitext(x)[1] not in suffix:
+            with open(x, 'r') as f:
+                flist += [t.strip() for t in f if t.strip()]
+        elif os.path.isfile(x):
+            flist.append(x)
+        else:
+            flist += sorted(glob.glob(x))
+    # remove duplicates but keep the order
+    return list(dict.fromkeys(flist))
+
+
+def get_finished(output):
+    """
+    get the files that are done in the output table; the rows of a file are
+    written as one unit ending with its tauq row, so a file is done only if
+    its tauq row is complete. Files that failed to load are fitted again;
+    :return: tuple of (finished, size, num_error); finished is the set of
+        the absolute paths; size is the length in bytes of the table up to
+        the last complete unit, the rest is left by a killed job; num_error
+        is the number of the error rows of the files that failed
+    """
+    finished = set()
+    size = 0
+    num_error = 0
+    if not os.path.isfile(output):
+        return finished, size, num_error
+    header = None
+    pos = 0
+    with open(output, 'rb') as f:
+        for line in f:
+            pos += len(line)
+            if not line.endswith(b'\n'):
+                break
+            row = next(csv.reader([line.decode()]), [])
+            if header is None:
+                header = row
+                size = pos
+                continue
+            row = dict(zip(header, row))
+            if row.get('kind') in ['tauq', 'error'] and \
+                    row.get('success') in ['True', 'False']:
+                size = pos
+                if row['kind'] == 'tauq':
+                    finished.add(row['file'])
+                else:
+                    num_error += 1
+    return finished, size, num_error
+
+
+def drop_error_rows(output, size):
+    """
+    rewrite the table with the complete units up to size, without the
+    error rows; the files that failed are fitted again, so their new rows
+    are not mixed with the old errors
+    """
+    tmp = output + '.tmp'
+    header = None
+    pos = 0
+    with open(output, 'rb') as f, open(tmp, 'wb') as fout:
+        for line in f:
+            pos += len(line)
+            if pos > size:
+                break
+            row = next(csv.reader([line.decode()]), [])
+            if header is None:
+                header = row
+            elif dict(zip(header, row)).get('kind') == 'error':
+                continue
+            fout.write(line)
+    os.replace(tmp, output)
+
+
+def write_rows(f, rows):
+    # write the rows of a file in one call, so they are flushed as a unit
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    f.write(buf.getvalue())
+    f.flush()
+
+
+def batch_fit(flist, output, num_workers=None, fit_func='single', **kwargs):
+    """
+    fit g2 and tau(q) for all files in flist in parallel; the results are
+    appended to the csv table output as soon as a file is done, so a killed
+    job resumes from where it stopped when it is submitted again;
+    :param flist: list of files
+    :param output: the csv file to write
+    :param num_workers: number of worker processes, default os.cpu_count()
+    :param fit_func: ['single' | 'double']
+    :param kwargs: passed to fit_file
+    :return: number of files fitted in this run
+    """
+    columns = get_columns(fit_func)
+    finished, size, num_error = get_finished(output)
+    if num_error > 0:
+        logger.info('remove %d error rows from %s to fit them again',
+                    num_error, output)
+        drop_error_rows(output, size)
+    elif os.path.isfile(output) and os.path.getsize(output) > size:
+        # the rows of a file that was being written when the job was killed
+        logger.info('remove the incomplete rows at the end of %s', output)
+        with open(output, 'r+b') as f:
+            f.truncate(size)
+    todo = [x for x in flist if os.path.abspath(x) not in finished]
+    logger.info('%d files in total; %d finished; %d to fit', len(flist),
+                len(flist) - len(todo), len(todo))
+    if len(todo) == 0:
+        return 0
+
+    kwargs['fit_func'] = fit_func
+    t0 = time.perf_counter()
+    with open(output, 'a', newline='') as f, \
+            ProcessPoolExecutor(max_workers=num_workers) as executor:
+        if size == 0:
+            write_rows(f, [columns])
+        futures = {executor.submit(_fit_file_safe, x, kwargs): x
+                   for x in todo}
+        for n, future in enumerate(as_completed(futures)):
+            rows = future.result()
+            if rows is None:
+                fname = os.path.abspath(futures[future])
+                nan = [np.nan] * (len(columns) - 4)
+                rows = [[fname, 'error', -1] + nan + [False]]
+            write_rows(f, rows)
+            if (n + 1) % 100 == 0 or n + 1 == len(todo):
+                dt = time.perf_counter() - t0
+                logger.info('%d / %d files fitted, %.2f files/s', n + 1,
+                            len(todo), (n + 1) / dt)
+    return len(todo)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='fit g2 and tau(q) for many xpcs files without the gui')
+    parser.add_argument('inputs', nargs='+',
+                        help='directories, glob patterns, files or text '
+                             'files with one filename per line')
+    parser.add_argument('-o', '--output', default='fit_summary.csv',
+                        help='csv table to write; an existing table is '
+                             'resumed')
+    parser.add_argument('-j', '--num-workers', type=int, default=None)
+    parser.add_argument('--fit-func', choices=['single', 'double'],
+                        default='single')
+    parser.add_argument('--bounds', type=float, nargs='+', default=None,
+                        help='lower bounds followed by the upper bounds')
+    parser.add_argument('--fix', type=int, nargs='*', default=[],
+                        help='index of the parameters to fix at the upper '
+                             'bound')
+    parser.add_argument('--q-range', type=float, nargs=2, default=None)
+    parser.add_argument('--t-range', type=float, nargs=2, default=None)
+    parser.add_argument('--tauq-bounds', type=float, nargs=4, default=None,
+                        help='a_min b_min a_max b_max')
+    parser.add_argument('--tauq-range', type=float, nargs=2, default=None)
+    parser.add_argument('--quick', action='store_true',
+                        help='use the non-iterative quick look estimate '
+                             'instead of the g2 fitting')
+    parser.add_argument('--chi2-max', type=float, default=None,
+                        help='exclude the g2 fittings with larger reduced '
+                             'chi-square from the tau(q) fitting')
+    parser.add_argument('--ftype', default='nexus')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(name)-24s: %(message)s')
+
+    num_args = len(param_names[args.fit_func])
+    bounds = None
+    if args.bounds is not None:
+        if len(args.bounds) != 2 * num_args:
+            parser.error('--bounds needs %d values' % (2 * num_args))
+        bounds = np.array(args.bounds).reshape(2, num_args).tolist()
+    fit_flag = [n not in args.fix for n in range(num_args)]
+    tauq_bounds = None
+    if args.tauq_bounds is not None:
+        tauq_bounds = np.array(args.tauq_bounds).reshape(2, 2).tolist()
+
+    flist = collect_files(args.inputs)
+    if len(flist) == 0:
+        logger.error('no file found')
+        return 1
+
+    batch_fit(flist, args.output, num_workers=args.num_workers,
+              fit_func=args.fit_func, bounds=bounds, fit_flag=fit_flag,
+              q_range=args.q_range, t_range=args.t_range,
+              tauq_bounds=tauq_bounds, tauq_range=args.tauq_range,
+              chi2_max=args.chi2_max, quick=args.quick, ftype=args.ftype)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,6 +2,7 @@ import h5py
 import os
 import numpy as np
 import json
+import time
 import logging
 from .ftype_utils import get_ftype
 
@@ -33,17 +34,149 @@ colors = ['r', 'g', 'b', 'c', 'm', 'y', 'k']
 symbols = ['o', 's', 't', 'd', '+']
 
 
-def put(save_path, result, ftype='legacy', mode='raw'):
+def get_field_option(option, key):
+    # an option is either the same for all fields or a dict of {key: value}
+    if isinstance(option, dict):
+        return option.get(key)
+    return option
+
+
+def put(save_path, result, ftype='legacy', mode='raw', keep_shape=False,
+        chunks=None, compression=None, downcast=False):
+    """
+    write the fields in result to a hdf file;
+    :param save_path: the hdf file, or an opened h5py File/Group to write
+        many results in one open (batch mode)
+    :param result: dictionary of {key: value}
+    :param ftype: ['nexus' | 'legacy'], see default.json
+    :param mode: ['raw' | 'alias']; alias is defined in .hdf_key,
+                 otherwise the raw hdf key will be used
+    :param keep_shape: if False, 1d arrays are saved as (1, N)
+    :param chunks: the chunk shape, True for automatic chunking or None for
+        contiguous datasets; or a dict of {key: chunks} for each field
+    :param compression: [None | 'gzip' | 'lzf'], or a dict for each field;
+        only used for arrays that are chunked
+    :param downcast: if True, float64 arrays are saved as float32
+    :return: None
+    """
+    if isinstance(save_path, (h5py.File, h5py.Group)):
+        put_fields(save_path, result, ftype, mode, keep_shape, chunks,
+                   compression, downcast)
+        return
     with h5py.File(save_path, 'a') as f:
-        for key, val in result.items():
-            if mode == 'alias':
-                key = hdf_key[ftype][key]
-            if key in f:
-                del f[key]
-            if isinstance(val, np.ndarray) and val.ndim == 1:
+        put_fields(f, result, ftype, mode, keep_shape, chunks, compression,
+                   downcast)
+    return
+
+
+def put_fields(f, result, ftype, mode, keep_shape, chunks, compression,
+               downcast):
+    t0 = time.perf_counter()
+    nbytes = 0
+    for key, val in result.items():
+        field = key
+        if mode == 'alias':
+            key = hdf_key[ftype][key]
+        if isinstance(val, np.ndarray):
+            if val.ndim == 1 and not keep_shape:
                 val = np.reshape(val, (1, -1))
+            if downcast and val.dtype == np.float64:
+                val = val.astype(np.float32)
+            nbytes += val.nbytes
+
+        if key in f:
+            dset = f[key]
+            # overwrite in place to keep the layout and the filters
+            if isinstance(dset, h5py.Dataset) and \
+                    isinstance(val, np.ndarray) and \
+                    dset.shape == val.shape and dset.dtype == val.dtype:
+                dset[...] = val
+                continue
+            del f[key]
+
+        chunk = get_field_option(chunks, field)
+        if chunk is None or not isinstance(val, np.ndarray) or \
+                val.size <= 1:
             f[key] = val
-        return
+        else:
+            comp = get_field_option(compression, field)
+            f.create_dataset(key, data=val, chunks=chunk, compression=comp,
+                             shuffle=comp is not None)
+
+    dt = time.perf_counter() - t0
+    logger.info('write %d fields to %s: %.2f MB in %.3f s, %.1f MB/s',
+                len(result), f.file.filename, nbytes / 1e6, dt,
+                nbytes / 1e6 / max(dt, 1e-9))
+
+
+def copy_metadata(template, save_path, skip=()):
+    """
+    create a new file with the groups and datasets of template, except the
+    paths in skip; the datasets are copied by h5py without being loaded
+    and the soft and external links are kept as links;
+    :param template: the file to copy from
+    :param save_path: the new file; it's overwritten if it exists
+    :param skip: list of the paths of the datasets or groups to skip
+    :return: None
+    """
+    skip = set('/' + x.strip('/') for x in skip)
+
+    def copy_group(src, dst):
+        dst.attrs.update(src.attrs)
+        for name in src:
+            path = '/'.join([src.name.rstrip('/'), name])
+            if path in skip:
+                continue
+            link = src.get(name, getlink=True)
+            if isinstance(link, (h5py.SoftLink, h5py.ExternalLink)):
+                dst[name] = link
+            elif any(x.startswith(path + '/') for x in skip):
+                copy_group(src[name], dst.create_group(name))
+            else:
+                src.copy(name, dst, name=name)
+
+    with h5py.File(template, 'r') as fs, h5py.File(save_path, 'w') as fd:
+        copy_group(fs, fd)
+
+
+def get_group(fname, group, attrs=False):
+    """
+    get all the datasets in a group without changing their shapes;
+    :param fname: the hdf file
+    :param group: the path of the group
+    :param attrs: if True, also return the attributes of the group
+    :return: dictionary of {name: value}, or a tuple of it and the
+        dictionary of the attributes; None if the file or the group doesn't
+        exist
+    """
+    if not os.path.isfile(fname):
+        return None
+    ret = {}
+    with h5py.File(fname, 'r') as f:
+        if group not in f:
+            return None
+        for key, dset in f[group].items():
+            if not isinstance(dset, h5py.Dataset):
+                continue
+            val = dset[()]
+            if type(val) in [np.bytes_, bytes]:
+                val = val.decode()
+            ret[key] = val
+        if attrs:
+            return ret, dict(f[group].attrs)
+    return ret
+
+
+def put_attrs(fname, group, attrs):
+    """
+    set the attributes of a group, creating the group if not existing;
+    :param fname: the hdf file
+    :param group: the path of the group
+    :param attrs: dictionary of {name: value}
+    :return: None
+    """
+    with h5py.File(fname, 'a') as f:
+        f.require_group(group).attrs.update(attrs)
 
 
 def get_abs_cs_scale(fname, ftype='legacy'):
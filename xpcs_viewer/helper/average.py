@@ -0,0 +1,1327 @@
+import os
+import re
+import time
+import hashlib
+import logging
+import traceback
+import multiprocessing
+import h5py
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from ..fileIO.hdf_reader import hdf_key, copy_metadata, put
+
+
+logger = logging.getLogger(__name__)
+
+# the group in the output file to keep the statistics of the averaging
+avg_stat_group = '/xpcs_viewer/average'
+# the large multi-tau fields that can be streamed slab by slab
+slab_fields = ('G2', 'IP', 'IF')
+# the group in the output file to keep the state to extend the average
+state_group = avg_stat_group + '/state'
+# the large fields of a single file that are not copied to the output
+single_fields = ('c2_half', 'g2_full', 'g2_partials', 'G2', 'IP', 'IF')
+# the weights of the files in the average, see get_file_weights
+weighting_modes = ('uniform', 'inverse_variance', 'intensity')
+# the summary statistics of Int_t used to cluster the outliers
+intt_features = ('log_mean', 'rel_std', 'rel_min', 'rel_max', 'rel_drift')
+
+
+def validate_g2_baseline(g2_data, q_idx, avg_window=3, avg_blmin=0.95,
+                         avg_blmax=1.05):
+    """
+    check if the g2 baseline of a file is in the range
+    :param g2_data: g2 of one file, (nt, nq)
+    :param q_idx: the q index to check; 0 is used if it's out of range
+    :param avg_window: the number of the last delays to average
+    :return: a tuple of (flag, baseline)
+    """
+    if q_idx >= g2_data.shape[1]:
+        idx = 0
+        logger.info('q_index is out of range; using 0 instead')
+    else:
+        idx = q_idx
+
+    g2_baseline = np.mean(g2_data[-avg_window:, idx])
+    if avg_blmax >= g2_baseline >= avg_blmin:
+        return True, g2_baseline
+    else:
+        return False, g2_baseline
+
+
+def add_time(timer, key, t0):
+    """
+    add the time since t0 to the stage key of timer;
+    :return: the current time, to start the next stage
+    """
+    t1 = time.perf_counter()
+    timer[key] += t1 - t0
+    return t1
+
+
+def read_g2_tail(fname, work_dir='.', avg_window=3, avg_qindex=0,
+                 ftype='nexus'):
+    """
+    read the slice of g2 used by the baseline check, g2[-avg_window:, q]
+    :param avg_qindex: the q index; 0 is used if it's out of range
+    :return: a tuple of (g2_tail, nbytes); g2_tail is (avg_window, 1)
+    """
+    key = hdf_key[ftype]
+    with h5py.File(os.path.join(work_dir, fname), 'r') as f:
+        g2 = f[key['g2']]
+        if avg_qindex >= g2.shape[1]:
+            logger.info('q_index is out of range; using 0 instead')
+            avg_qindex = 0
+        g2_tail = g2[-avg_window:, avg_qindex: avg_qindex + 1]
+    return g2_tail, g2_tail.nbytes
+
+
+def read_average_fields(fname, work_dir, fields, abs_scale=False,
+                        ftype='nexus'):
+    """
+    read only the fields to average, instead of loading the whole file with
+    XpcsFile;
+    :param fname: the filename in work_dir
+    :param fields: the fields to average
+    :param abs_scale: if True, read the absolute cross section scale of the
+        file; saxs_1d is weighted by it in the average
+    :param ftype: ['nexus' | 'legacy'], see default.json
+    :return: a tuple of (data, scale, nbytes); data is a dictionary of the
+        fields; nbytes is the number of bytes read from the file
+    """
+    key = hdf_key[ftype]
+    data = {}
+    scale = 1.0
+    nbytes = 0
+    with h5py.File(os.path.join(work_dir, fname), 'r') as f:
+        for field in fields:
+            data[field] = f[key[field]][()]
+            nbytes += data[field].nbytes
+
+        # the same as XpcsFile: saxs_2d is masked
+        if 'saxs_2d' in fields:
+            mask = f[key['mask']][()]
+            nbytes += mask.nbytes
+            saxs_2d = np.squeeze(data['saxs_2d'])
+            mask = np.squeeze(mask)
+            if mask.shape != saxs_2d.shape:
+                mask = mask.T
+            data['saxs_2d'] = saxs_2d * mask
+
+        if abs_scale and 'saxs_1d' in fields:
+            if key['abs_cross_section_scale'] in f:
+                scale = float(f[key['abs_cross_section_scale']][()])
+                nbytes += 8
+
+    for field in fields:
+        if field != 'saxs_2d':
+            data[field] = np.squeeze(data[field])
+    return data, scale, nbytes
+
+
+def read_intt(fname, work_dir='.', ftype='nexus'):
+    """
+    read the intensity of Int_t; the same as XpcsFile, the intensity is
+    the second row of a 2d Int_t
+    :return: a tuple of (intt, nbytes); intt is a 1d float64 array
+    """
+    with h5py.File(os.path.join(work_dir, fname), 'r') as f:
+        dset = f[hdf_key[ftype]['Int_t']]
+        intt = np.ravel(dset[1] if dset.ndim == 2 else dset[()])
+    return intt.astype(np.float64), intt.nbytes
+
+
+def get_intt_features(intt):
+    """
+    compute the summary statistics of Int_t of many files at once; the
+    statistics other than the mean are relative to the mean, so they
+    describe the shape of Int_t and not its level;
+    :param intt: (num_files, num_points) array of Int_t
+    :return: (num_files, len(intt_features)) array; the rows are not finite
+        for the files with no positive intensity
+    """
+    intt = np.atleast_2d(intt)
+    num_points = intt.shape[1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.mean(intt, axis=1)
+        rel = intt / mean[:, None]
+        # the slope of a linear fit over the series, from -1 to 1
+        if num_points > 1:
+            t = np.linspace(-1, 1, num_points)
+            drift = (rel - 1) @ t / (t @ t)
+        else:
+            drift = np.zeros(intt.shape[0])
+        return np.stack([np.log(mean), np.std(rel, axis=1),
+                         np.min(rel, axis=1), np.max(rel, axis=1), drift],
+                        axis=1)
+
+
+def intt_shard(flist, work_dir='.', ftype='nexus'):
+    """
+    the map step of the Int_t outlier stage; read Int_t of the files and
+    compute their features, in one batch for the files of the same length;
+    :return: dictionary with the keys
+        'features': float64 array, see get_intt_features; nan for damaged
+            files,
+        'nbytes': int64 array, the number of bytes read from each file,
+        'time': {'read': s, 'compute': s}, the time spent in each stage
+    """
+    tot_num = len(flist)
+    part = {
+        'features': np.full((tot_num, len(intt_features)), np.nan),
+        'nbytes': np.zeros(tot_num, dtype=np.int64),
+        'time': {'read': 0.0, 'compute': 0.0},
+    }
+    t0 = time.perf_counter()
+    batches = {}
+    for m, fname in enumerate(flist):
+        try:
+            intt, nbytes = read_intt(fname, work_dir, ftype)
+        except Exception:
+            logger.error('file %s is damaged, skip: %s', fname,
+                         traceback.format_exc())
+            continue
+        batches.setdefault(intt.size, []).append((m, intt))
+        part['nbytes'][m] = nbytes
+    t0 = add_time(part['time'], 'read', t0)
+
+    for batch in batches.values():
+        idx = [m for m, _ in batch]
+        part['features'][idx] = get_intt_features(np.stack(
+            [intt for _, intt in batch]))
+    add_time(part['time'], 'compute', t0)
+    return part
+
+
+def cluster_intt(features, num_clusters=2, random_state=0):
+    """
+    cluster the files by their Int_t features with KMeans; the largest
+    cluster is accepted and the other clusters are the outliers. The
+    features are scaled by their median and median absolute deviation, so
+    a few outliers don't set the scale;
+    :param features: the output of get_intt_features
+    :param num_clusters: the number of clusters
+    :return: a tuple of (label, accept); label is -1 for the files with no
+        valid features, which are not accepted
+    """
+    label = np.full(features.shape[0], -1, dtype=np.int64)
+    valid = np.all(np.isfinite(features), axis=1)
+    if np.sum(valid) == 0:
+        return label, valid
+
+    val = features[valid]
+    med = np.median(val, axis=0)
+    mad = np.median(np.abs(val - med), axis=0) * 1.4826
+    val = (val - med) / np.where(mad > 0, mad, 1.0)
+    num_clusters = min(num_clusters, np.unique(val, axis=0).shape[0])
+    if num_clusters < 2:
+        label[valid] = 0
+        return label, valid
+
+    # imported here so the worker processes don't load sklearn
+    from sklearn.cluster import KMeans
+    label[valid] = KMeans(n_clusters=num_clusters, n_init=10,
+                          random_state=random_state).fit_predict(val)
+    freq = np.bincount(label[valid])
+    return label, label == freq.argmax()
+
+
+def run_intt_outlier(groups, work_dir='.', num_workers=None, shard_size=64,
+                     num_clusters=2, callback=None, is_killed=None,
+                     ftype='nexus'):
+    """
+    the outlier stage before the averaging; read only Int_t of the files
+    with the worker processes and cluster the files of each group by the
+    features of Int_t, see cluster_intt;
+    :param groups: dictionary of {name: list of filenames in work_dir}
+    :param callback: called with (index, result) when a shard is done, see
+        intt_shard; the indices are in the list of the files of all
+        groups, in the order of groups
+    :return: dictionary with 'features', 'label' and 'accept' of the files
+        of all groups; None if killed
+    """
+    flist, labels = [], []
+    for n, name in enumerate(groups):
+        flist += list(groups[name])
+        labels += [n] * len(groups[name])
+    labels = np.array(labels, dtype=np.int64)
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    num_workers = max(1, min(num_workers, len(flist)))
+
+    t0 = time.perf_counter()
+    ret = {
+        'features': np.full((len(flist), len(intt_features)), np.nan),
+        'label': np.full(len(flist), -1, dtype=np.int64),
+        'accept': np.zeros(len(flist), dtype=bool),
+    }
+    shards = split_shards(np.arange(len(flist)), shard_size, num_workers)
+
+    def on_done(n, part):
+        ret['features'][shards[n]] = part['features']
+        if callback is not None:
+            callback(shards[n], part)
+
+    executor = get_executor(num_workers)
+    try:
+        flag = map_shards(intt_shard, [[flist[n] for n in x] for x in shards],
+                          executor, on_done, is_killed, work_dir=work_dir,
+                          ftype=ftype)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+    if not flag:
+        logger.info('Int_t outlier stage is killed')
+        return None
+
+    for n in range(len(groups)):
+        idx = labels == n
+        ret['label'][idx], ret['accept'][idx] = cluster_intt(
+            ret['features'][idx], num_clusters)
+    logger.info('Int_t outlier stage: %d of %d files accepted in %.2f s',
+                np.sum(ret['accept']), len(flist), time.perf_counter() - t0)
+    return ret
+
+
+def screen_shard(flist, work_dir='.', avg_window=3, avg_qindex=0,
+                 avg_blmin=0.95, avg_blmax=1.05, ftype='nexus'):
+    """
+    the screening pass; check the g2 baseline of the files in flist by
+    reading only the slice of g2 it needs;
+    :return: dictionary with the keys
+        'baseline': float32 array, the g2 baseline; nan for damaged files,
+        'accept': bool array, True if the baseline is in the range,
+        'nbytes': int64 array, the number of bytes read from each file,
+        'time': {'read': s, 'compute': s}, the time spent in each stage
+    """
+    tot_num = len(flist)
+    part = {
+        'baseline': np.full(tot_num, np.nan, dtype=np.float32),
+        'accept': np.zeros(tot_num, dtype=bool),
+        'nbytes': np.zeros(tot_num, dtype=np.int64),
+        'time': {'read': 0.0, 'compute': 0.0},
+    }
+    for m, fname in enumerate(flist):
+        t0 = time.perf_counter()
+        try:
+            g2_tail, nbytes = read_g2_tail(fname, work_dir, avg_window,
+                                           avg_qindex, ftype)
+        except Exception:
+            logger.error('file %s is damaged, skip: %s', fname,
+                         traceback.format_exc())
+            continue
+        finally:
+            t0 = add_time(part['time'], 'read', t0)
+        flag, val = validate_g2_baseline(g2_tail, 0, avg_window, avg_blmin,
+                                         avg_blmax)
+        add_time(part['time'], 'compute', t0)
+        part['baseline'][m] = val
+        part['accept'][m] = flag
+        part['nbytes'][m] = nbytes
+    return part
+
+
+def welford_add(stat, shape, weight=1.0):
+    """
+    start adding one sample to the running statistics; the sample is then
+    added with welford_slab, at once or slab by slab;
+    :param stat: the running statistics; None to start
+    :param shape: the shape of the sample
+    :param weight: the weight of the sample; a scalar, or an array of the
+        shape of the sample to weight each element
+    :return: the updated statistics
+    """
+    if stat is None:
+        stat = {
+            'count': 0,
+            'weight': 0.0,
+            'weight2': 0.0,
+            # float64 to keep the precision of long accumulations
+            'mean': np.zeros(shape, dtype=np.float64),
+            'm2': np.zeros(shape, dtype=np.float64),
+        }
+    stat['count'] += 1
+    # the weights become arrays with the first array weight
+    stat['weight'] = stat['weight'] + weight
+    stat['weight2'] = stat['weight2'] + np.square(weight)
+    return stat
+
+
+def welford_slab(stat, val, weight=1.0, index=Ellipsis):
+    """
+    add a slab of the sample started by welford_add to the running mean and
+    variance, with the weighted Welford algorithm; the arrays are updated
+    in place;
+    :param val: the slab of the sample
+    :param weight: the weight of the slab; an array weight must be of the
+        shape of the slab
+    :param index: the slice of the slab in the sample
+    """
+    total = stat['weight']
+    if np.ndim(total) > 0:
+        total = total[index]
+    mean = stat['mean'][index]
+    delta = val - mean
+    # the elements without any weight yet are left at 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where(total > 0, np.true_divide(weight, total), 0.0)
+    mean += delta * ratio
+    # m2 += w * (x - old_mean) * (x - new_mean)
+    delta *= val - mean
+    delta *= weight
+    stat['m2'][index] += delta
+
+
+def welford_update(stat, val, weight=1.0):
+    """
+    add one sample to the running mean and variance;
+    :param stat: the running statistics; None to start
+    :param val: the sample
+    :param weight: the weight of the sample
+    :return: the updated statistics
+    """
+    stat = welford_add(stat, val.shape, weight)
+    welford_slab(stat, val, weight)
+    return stat
+
+
+def welford_merge(stat_a, stat_b):
+    """
+    combine the statistics of two sets of samples (Chan et al.); stat_a is
+    updated in place;
+    :return: the combined statistics
+    """
+    if stat_a is None or stat_a['count'] == 0:
+        return stat_b
+    if stat_b is None or stat_b['count'] == 0:
+        return stat_a
+    weight = stat_a['weight'] + stat_b['weight']
+    delta = stat_b['mean'] - stat_a['mean']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where(weight > 0, stat_b['weight'] / weight, 0.0)
+    stat_a['mean'] += delta * ratio
+    stat_a['m2'] += stat_b['m2']
+    stat_a['m2'] += delta ** 2 * (stat_a['weight'] * ratio)
+    stat_a['count'] += stat_b['count']
+    stat_a['weight'] = weight
+    stat_a['weight2'] = stat_a['weight2'] + stat_b['weight2']
+    return stat_a
+
+
+def welford_finalize(stat):
+    """
+    get the variance and the standard error of the mean from the running
+    statistics
+    :return: a tuple of (var, std_err); the variance is unbiased for the
+        weighted samples and is 0 for a single sample. With array weights,
+        the elements without any weight are nan
+    """
+    weight, weight2 = stat['weight'], stat['weight2']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dof = weight - weight2 / weight
+        if stat['count'] < 2:
+            var = np.zeros_like(stat['m2'])
+        else:
+            var = np.where(dof > 0, stat['m2'] / dof, 0.0)
+        std_err = np.sqrt(var * weight2) / weight
+    return var, std_err
+
+
+def get_slab_rows(shape, mem_budget, num_buffer=4):
+    """
+    get the number of rows along the first axis of a slab that fits in the
+    memory budget
+    :param shape: the shape of the dataset
+    :param mem_budget: the memory budget in MB
+    :param num_buffer: the number of float64 slabs alive at the same time;
+        the read buffer and the temporary arrays of welford_slab
+    :return: the number of rows, at least 1
+    """
+    row_bytes = 8 * num_buffer * int(np.prod(shape[1:]))
+    return int(max(1, min(shape[0], mem_budget * 1e6 // max(1, row_bytes))))
+
+
+def read_slab_fields(fname, work_dir, fields, mem_budget, ftype='nexus'):
+    """
+    read the slab_fields of a file into float64 arrays, slab by slab along
+    the first axis so the conversion buffers stay within mem_budget; the
+    whole file is read before any of it is added to the statistics, so a
+    file that fails in the middle can be skipped
+    :param fields: the slab_fields to read
+    :param mem_budget: the memory budget of the slabs in MB
+    :return: a tuple of ({field: array}, nbytes)
+    """
+    ret = {}
+    nbytes = 0
+    with h5py.File(os.path.join(work_dir, fname), 'r') as f:
+        for key in fields:
+            dset = f[hdf_key[ftype][key]]
+            if dset.dtype.kind not in 'biuf':
+                raise TypeError('%s of %s is not numeric: %s' % (
+                    key, fname, dset.dtype))
+            val = np.empty(dset.shape, dtype=np.float64)
+            rows = get_slab_rows(dset.shape, mem_budget, num_buffer=1)
+            for beg in range(0, max(1, dset.shape[0]), rows):
+                index = np.s_[beg:beg + rows]
+                dset.read_direct(val, index, index)
+            ret[key] = val
+            nbytes += dset.size * dset.dtype.itemsize
+    return ret, nbytes
+
+
+def welford_update_slabs(stat, val, mem_budget, weight=1.0):
+    """
+    add one sample to the running statistics slab by slab along the first
+    axis, so the temporary arrays of welford_slab stay within mem_budget
+    :param mem_budget: the memory budget of the slabs in MB
+    :return: the updated statistics
+    """
+    stat = welford_add(stat, val.shape, weight)
+    rows = get_slab_rows(val.shape, mem_budget, num_buffer=3)
+    for beg in range(0, max(1, val.shape[0]), rows):
+        index = np.s_[beg:beg + rows]
+        welford_slab(stat, val[index], weight, index)
+    return stat
+
+
+def get_weight_fields(weighting):
+    # the fields read to compute the weights of a file
+    if weighting == 'inverse_variance':
+        return ['g2_err']
+    elif weighting == 'intensity':
+        return ['Int_t']
+    elif weighting == 'uniform':
+        return []
+    raise ValueError('unknown weighting %s; use one of %s' % (
+        weighting, weighting_modes))
+
+
+def get_file_weights(data, weighting='uniform'):
+    """
+    get the weights of a file in the average from the fields read in the
+    same pass, see get_weight_fields;
+    :param data: the fields of the file
+    :param weighting: ['uniform' | 'inverse_variance' | 'intensity'];
+        inverse_variance weights each element of g2 by 1 / g2_err ** 2 and
+        the other fields by 1 / mean(g2_err ** 2); intensity weights all the
+        fields by the mean of Int_t, i.e. by the photon counts
+    :return: a tuple of (weight, g2_weight); weight is the scalar weight of
+        the fields; g2_weight is the array weight of g2, or None to use
+        weight
+    """
+    if weighting == 'inverse_variance':
+        err = np.asarray(data['g2_err'], dtype=np.float64)
+        valid = np.isfinite(err) & (err > 0)
+        g2_weight = np.zeros(err.shape)
+        g2_weight[valid] = 1.0 / err[valid] ** 2
+        if not np.any(valid):
+            return 0.0, g2_weight
+        return 1.0 / np.mean(err[valid] ** 2), g2_weight
+    elif weighting == 'intensity':
+        intt = np.asarray(data['Int_t'])
+        # the same as XpcsFile, the intensity is the second row
+        if intt.ndim == 2:
+            intt = intt[1]
+        weight = float(np.mean(intt))
+        if not np.isfinite(weight) or weight < 0:
+            weight = 0.0
+        return weight, None
+    return 1.0, None
+
+
+def average_shard(flist, work_dir='.', fields=('saxs_2d', ), abs_scale=False,
+                  mem_budget=None, weighting='uniform', ftype='nexus'):
+    """
+    the map step of the averaging; accumulate the mean and variance of the
+    fields over the files in flist in one pass. It runs in the worker
+    processes, so it only takes and returns picklable values;
+    :param flist: list of filenames in work_dir that passed the screening
+    :param fields: the fields to average
+    :param abs_scale: if True, saxs_1d is weighted by the absolute cross
+        section scale of each file, on top of the weighting
+    :param mem_budget: the memory budget in MB of the slabs of the
+        slab_fields; they are read and added to the statistics slab by slab
+        and keep the shape of the dataset. Each file is read into a float64
+        copy first, so a file that fails to read is skipped as a whole.
+        None to read them at once
+    :param weighting: the weights of the files, see get_file_weights; they
+        are computed from the fields read in the same pass
+    :return: dictionary of the partial result with the keys
+        'stat': {key: the running statistics, see welford_update},
+        'mask': int array, 1 if the file is averaged,
+        'nbytes': int64 array, the number of bytes read from each file,
+        'time': {'read': s, 'compute': s}, the time spent in each stage
+    """
+    tot_num = len(flist)
+    part = {
+        'stat': {key: None for key in fields},
+        'mask': np.zeros(tot_num, dtype=np.int64),
+        'nbytes': np.zeros(tot_num, dtype=np.int64),
+        'time': {'read': 0.0, 'compute': 0.0},
+    }
+    timer = part['time']
+
+    if mem_budget is None:
+        slabs = []
+    else:
+        slabs = [key for key in fields if key in slab_fields]
+    whole = [key for key in fields if key not in slabs]
+    # the fields only read for the weights are not averaged
+    extra = [key for key in get_weight_fields(weighting) if key not in whole]
+
+    for m, fname in enumerate(flist):
+        t0 = time.perf_counter()
+        try:
+            data, scale, nbytes = read_average_fields(fname, work_dir,
+                                                      whole + extra,
+                                                      abs_scale, ftype)
+            if len(slabs) > 0:
+                slab_data, slab_nbytes = read_slab_fields(
+                    fname, work_dir, slabs, mem_budget, ftype)
+                data.update(slab_data)
+                nbytes += slab_nbytes
+        except Exception:
+            logger.error('file %s is damaged, skip: %s', fname,
+                         traceback.format_exc())
+            continue
+        finally:
+            t0 = add_time(timer, 'read', t0)
+
+        part['nbytes'][m] = nbytes
+        file_weight, g2_weight = get_file_weights(data, weighting)
+        if file_weight <= 0:
+            logger.info('file %s has no weight, skip', fname)
+            continue
+        for key in whole + slabs:
+            stat = part['stat'][key]
+            if stat is not None and stat['mean'].shape != data[key].shape:
+                logger.info('data shape does not match for key %s, %s',
+                            key, fname)
+                continue
+            weight = file_weight
+            if key == 'g2' and g2_weight is not None and \
+                    g2_weight.shape == data[key].shape:
+                weight = g2_weight
+            elif key == 'saxs_1d':
+                weight = file_weight * scale
+            if key in slabs:
+                part['stat'][key] = welford_update_slabs(stat, data[key],
+                                                         mem_budget, weight)
+            else:
+                part['stat'][key] = welford_update(stat, data[key], weight)
+            part['mask'][m] = 1
+        add_time(timer, 'compute', t0)
+
+    return part
+
+
+def merge_stat(total, stat):
+    """
+    the reduce step of the averaging; merge the statistics of a shard into
+    the total; total is updated in place
+    :param total: dictionary of {key: the running statistics}
+    :param stat: the 'stat' of the output of average_shard
+    :return: None
+    """
+    for key, val in stat.items():
+        old = total.get(key)
+        if val is not None and old is not None and \
+                old['mean'].shape != val['mean'].shape:
+            logger.info('data shape does not match for key %s; %d '
+                        'files are skipped', key, val['count'])
+            continue
+        total[key] = welford_merge(old, val)
+
+
+def finalize_average(total):
+    """
+    get the average from the combined statistics
+    :param total: the output of run_average
+    :return: dictionary of the averaged fields; None if no file is averaged.
+        g2_err is the standard error of the averaged g2 if g2 is averaged
+        with more than one file; with the inverse_variance weighting, it's
+        1 / sqrt(sum(1 / g2_err ** 2))
+    """
+    if np.sum(total['mask']) == 0:
+        logger.info('no dataset is valid; check the baseline criteria.')
+        return None
+
+    result = {}
+    for key, stat in total['stat'].items():
+        if stat is None:
+            continue
+        result[key] = stat['mean']
+
+    if 'g2_err' in result:
+        stat = total['stat'].get('g2')
+        if stat is not None and np.ndim(stat['weight']) > 0 and \
+                total.get('weighting') == 'inverse_variance':
+            with np.errstate(divide='ignore'):
+                result['g2_err'] = 1.0 / np.sqrt(stat['weight'])
+        elif stat is not None and stat['count'] > 1:
+            result['g2_err'] = welford_finalize(stat)[1]
+        else:
+            count = total['stat']['g2_err']['count']
+            result['g2_err'] = result['g2_err'] / np.sqrt(count)
+
+    logger.info('the valid dataset number is %d / %d',
+                np.sum(total['mask']), total['mask'].size)
+    return result
+
+
+def get_average_stat(total, slab_stat=True):
+    """
+    get the statistics of the averaged fields, to be saved in avg_stat_group
+    :param total: the output of run_average
+    :param slab_stat: if False, the std_err of the large slab_fields is
+        skipped
+    :return: dictionary with '<field>_std_err' for the fields, the
+        per-pixel variance map 'saxs_2d_var', 'num_files', 'weighting' and
+        the number of files averaged for each field '<field>_count'
+    """
+    ret = {'num_files': int(np.sum(total['mask'])),
+           'weighting': total.get('weighting', 'uniform')}
+    for key, stat in total['stat'].items():
+        if stat is None:
+            continue
+        ret[key + '_count'] = stat['count']
+        if not slab_stat and key in slab_fields:
+            continue
+        var, std_err = welford_finalize(stat)
+        ret[key + '_std_err'] = std_err
+        if key == 'saxs_2d':
+            ret['saxs_2d_var'] = var
+    return ret
+
+
+def split_shards(index, shard_size, num_workers):
+    """
+    split the file indices into shards of at most shard_size files; smaller
+    shards are used so that every worker gets at least one;
+    :return: list of the index arrays of the shards
+    """
+    num = max(1, min(num_workers, len(index)))
+    shard_size = max(1, min(shard_size, -(-len(index) // num)))
+    return [index[n: n + shard_size]
+            for n in range(0, len(index), shard_size)]
+
+
+def get_executor(num_workers):
+    # None to run in the current process
+    if num_workers <= 1:
+        return None
+    # spawn the workers so they don't inherit the threads of the gui
+    ctx = multiprocessing.get_context('spawn')
+    return ProcessPoolExecutor(num_workers, mp_context=ctx)
+
+
+def map_shards(func, shards, executor=None, callback=None, is_killed=None,
+               **kwargs):
+    """
+    apply func to every shard, in the executor if given
+    :param callback: called with (n, result) when the n-th shard is done
+    :param is_killed: a function that returns True to stop
+    :param kwargs: passed to func
+    :return: True if all the shards are done; False if killed
+    """
+    if executor is None:
+        for n, shard in enumerate(shards):
+            if is_killed is not None and is_killed():
+                return False
+            callback(n, func(shard, **kwargs))
+        return True
+
+    futures = {executor.submit(func, shard, **kwargs): n
+               for n, shard in enumerate(shards)}
+    for future in as_completed(futures):
+        if is_killed is not None and is_killed():
+            for x in futures:
+                x.cancel()
+            return False
+        callback(futures[future], future.result())
+    return True
+
+
+# the per-file arrays of the averaging state
+state_keys = ('baseline', 'accept', 'screened', 'mask', 'averaged',
+              'nbytes')
+
+
+def init_state(tot_num, fields):
+    return {
+        'baseline': np.full(tot_num, np.nan, dtype=np.float32),
+        'accept': np.zeros(tot_num, dtype=bool),
+        'screened': np.zeros(tot_num, dtype=bool),
+        'mask': np.zeros(tot_num, dtype=np.int64),
+        'averaged': np.zeros(tot_num, dtype=bool),
+        'nbytes': np.zeros(tot_num, dtype=np.int64),
+        'stat': {key: None for key in fields},
+    }
+
+
+def get_state_key(**kwargs):
+    # a saved state is only used by a job with the same parameters
+    return hashlib.sha1(repr(sorted(kwargs.items())).encode()).hexdigest()
+
+
+def save_state(group, key, state, flist, stats=None, compression='gzip',
+               skip_mean=()):
+    """
+    save the averaging state to a hdf group, with the file list and the
+    key of the parameters; the arrays are chunked and compressed
+    :param group: an opened h5py group
+    :param stats: list of the statistics {field: stat} of the groups of a
+        grouped job, saved as stat/<n>/<field>; None to save state['stat']
+    :param compression: see hdf_reader.put
+    :param skip_mean: the fields whose mean is not saved, because it's the
+        averaged dataset of the same file; see load_state
+    """
+    data = {k: state[k] for k in state_keys}
+    data['flist'] = np.array(flist, dtype=h5py.string_dtype())
+    if stats is None:
+        stats = {'stat': state['stat']}
+    else:
+        stats = {'stat/%d' % n: x for n, x in enumerate(stats)}
+    for prefix, stat_dict in stats.items():
+        for field, stat in stat_dict.items():
+            if stat is None:
+                continue
+            for k, v in stat.items():
+                if k == 'mean' and field in skip_mean:
+                    continue
+                data['/'.join([prefix, field, k])] = v
+    group.attrs['key'] = key
+    put(group, data, keep_shape=True, chunks=True, compression=compression)
+
+
+def read_stat(group, fields, ftype=None):
+    """
+    read the statistics {field: stat} of the fields saved by save_state
+    :param ftype: the mean that is not saved is read from the averaged
+        dataset of the file with the keys of ftype; None to skip
+    """
+    stat = {key: None for key in fields}
+    for field, val in group.items():
+        if field not in stat:
+            continue
+        stat[field] = {k: v[()] for k, v in val.items()}
+        path = hdf_key[ftype][field] if ftype is not None else None
+        if 'mean' not in stat[field] and path in group.file:
+            stat[field]['mean'] = np.reshape(
+                group.file[path][()], stat[field]['m2'].shape).astype(
+                    np.float64)
+    return stat
+
+
+def load_state(group, key, flist, fields, num_groups=None, ftype=None):
+    """
+    load the averaging state saved by save_state for the files in flist;
+    the files that are not in the saved file list are left to do
+    :param num_groups: the number of groups of a grouped job; their
+        statistics are loaded to state['stats']. None for a single average
+    :param ftype: see read_stat
+    :return: the state; None if it's saved with other parameters, with
+        files that are not in flist or without the mean of a field
+    """
+    if group.attrs.get('key') != key:
+        logger.info('%s is saved with other parameters; ignored',
+                    group.file.filename)
+        return None
+    old_flist = list(group['flist'].asstr()[()])
+    index = {fname: n for n, fname in enumerate(flist)}
+    if any(fname not in index for fname in old_flist):
+        # the statistics can't be split to remove a file
+        logger.info('%s has files that are not in the job; ignored',
+                    group.file.filename)
+        return None
+    idx = [index[fname] for fname in old_flist]
+
+    state = init_state(len(flist), fields)
+    for k in state_keys:
+        state[k][idx] = group[k][()]
+    stat = group.get('stat', {})
+    if num_groups is None:
+        state['stat'] = read_stat(stat, fields, ftype)
+        stats = [state['stat']]
+    else:
+        state['stats'] = [read_stat(stat.get(str(n), {}), fields, ftype)
+                          for n in range(num_groups)]
+        stats = state['stats']
+    if any(x is not None and 'mean' not in x
+           for stat in stats for x in stat.values()):
+        logger.info('%s has no mean of the averaged fields; ignored',
+                    group.file.filename)
+        return None
+    return state
+
+
+def save_checkpoint(fname, key, state, flist, stats=None):
+    """
+    save the averaging state to a temporary hdf file; the file is written
+    to another path and renamed so a crash doesn't break the old checkpoint.
+    It's compressed with lzf, which is fast enough to be written often
+    :param stats: see save_state
+    """
+    tmp_path = fname + '.part'
+    with h5py.File(tmp_path, 'w') as f:
+        save_state(f, key, state, flist, stats, compression='lzf')
+    os.replace(tmp_path, fname)
+
+
+def load_checkpoint(fname, key, flist, fields, group='/', num_groups=None,
+                    ftype=None):
+    """
+    load the averaging state from a checkpoint, or from group of an
+    average output
+    :param num_groups: see load_state
+    :param ftype: see read_stat; for an average output
+    :return: the state; None if it doesn't exist or it can't be used by
+        the job, see load_state
+    """
+    if fname is None or not os.path.isfile(fname):
+        return None
+    try:
+        with h5py.File(fname, 'r') as f:
+            if group not in f:
+                return None
+            return load_state(f[group], key, flist, fields, num_groups,
+                              ftype)
+    except Exception:
+        logger.error('failed to load the state from %s: %s', fname,
+                     traceback.format_exc())
+        return None
+
+
+def report_resumed(state, screen_callback=None, callback=None):
+    """
+    call the callbacks with the files done before the job resumed; see
+    run_average
+    """
+    idx = np.nonzero(state['screened'])[0]
+    if screen_callback is not None and idx.size > 0:
+        part = {k: state[k][idx] for k in ('baseline', 'accept', 'nbytes')}
+        screen_callback(idx, dict(part, resumed=True))
+    idx = np.nonzero(state['averaged'])[0]
+    if callback is not None and idx.size > 0:
+        callback(idx, {'mask': state['mask'][idx],
+                       'nbytes': np.zeros(idx.size, dtype=np.int64),
+                       'resumed': True})
+
+
+def get_saver(checkpoint, checkpoint_interval, write):
+    """
+    create the function to save the checkpoint, see average_passes; the
+    interval is at least ten times the time of the last save, so the large
+    statistics such as G2 are not written more often than they grow
+    :param write: the function to write the checkpoint
+    :return: the function save(force); None if checkpoint is None
+    """
+    if checkpoint is None:
+        return None
+    last = {'time': time.perf_counter(), 'cost': 0.0}
+
+    def save(force):
+        wait = max(checkpoint_interval, 10 * last['cost'])
+        if force or time.perf_counter() - last['time'] >= wait:
+            t0 = time.perf_counter()
+            write()
+            last['time'] = time.perf_counter()
+            last['cost'] = last['time'] - t0
+
+    return save
+
+
+def average_passes(flist, state, stats, labels, num_workers, shard_size,
+                   screen_kwargs, avg_kwargs, screen_callback=None,
+                   callback=None, is_killed=None, save=None, retries=0,
+                   retry_delay=10):
+    """
+    run the screening pass and the accumulation pass for the files that
+    are not done in state, in one worker pool. The files can be in groups
+    that are averaged separately; the shards of all groups are scheduled
+    together;
+    :param flist: list of filenames
+    :param state: the per-file state, see init_state; updated in place
+    :param stats: list of the statistics {field: stat} of the groups;
+        updated in place
+    :param labels: int array, the index of the group of each file
+    :param save: called after each shard, with True to force saving the
+        state; None to disable
+    :param retries: the number of times to read again the files that
+        failed in the screening or the accumulation
+    :param retry_delay: the time in seconds to wait before a retry
+    :return: True if all the files are done; False if killed
+    """
+    # the time of the workers in reading and computing, for the log
+    timer = {'screen': {'read': 0.0, 'compute': 0.0},
+             'average': {'read': 0.0, 'compute': 0.0}}
+
+    def on_screen(idx, part):
+        for key, val in part['time'].items():
+            timer['screen'][key] += val
+        state['baseline'][idx] = part['baseline']
+        state['accept'][idx] = part['accept']
+        state['screened'][idx] = True
+        state['nbytes'][idx] += part['nbytes']
+        if screen_callback is not None:
+            screen_callback(idx, part)
+        if save is not None:
+            save(False)
+
+    def on_average(idx, part):
+        for key, val in part['time'].items():
+            timer['average'][key] += val
+        # a shard has the files of one group
+        merge_stat(stats[labels[idx[0]]], part['stat'])
+        state['mask'][idx] = part['mask']
+        state['averaged'][idx] = True
+        state['nbytes'][idx] += part['nbytes']
+        if callback is not None:
+            callback(idx, part)
+        if save is not None:
+            save(False)
+
+    def run_pass(executor, func, index, on_done, kwargs):
+        # the shards don't mix the groups
+        size = split_shards(index, shard_size, num_workers)[0].size \
+            if index.size > 0 else 1
+        shards = []
+        for n in np.unique(labels[index]):
+            shards += split_shards(index[labels[index] == n], size, 1)
+        flag = map_shards(func, [[flist[n] for n in x] for x in shards],
+                          executor, lambda n, part: on_done(shards[n], part),
+                          is_killed, **kwargs)
+        if not flag:
+            logger.info('averaging is killed')
+            if save is not None:
+                save(True)
+        return flag
+
+    t0 = time.perf_counter()
+    nbytes0 = np.sum(state['nbytes'])
+    executor = get_executor(num_workers)
+    try:
+        for attempt in range(retries + 1):
+            index = np.nonzero(~state['screened'])[0]
+            if not run_pass(executor, screen_shard, index, on_screen,
+                            screen_kwargs):
+                return False
+            if index.size > 0 and save is not None:
+                save(True)
+            t1 = time.perf_counter()
+            logger.info('screened %d files in %.2f s; %d accepted',
+                        index.size, t1 - t0, np.sum(state['accept']))
+
+            index = np.nonzero(state['accept'] & ~state['averaged'])[0]
+            if not run_pass(executor, average_shard, index, on_average,
+                            avg_kwargs):
+                return False
+
+            # the files that failed to read, e.g. still being written
+            failed_screen = state['screened'] & np.isnan(state['baseline'])
+            failed_avg = state['averaged'] & state['accept'] & \
+                (state['mask'] == 0)
+            num_failed = np.sum(failed_screen) + np.sum(failed_avg)
+            if num_failed == 0 or attempt == retries:
+                break
+            logger.info('retry %d failed files in %.1f s', num_failed,
+                        retry_delay)
+            time.sleep(retry_delay)
+            state['screened'][failed_screen] = False
+            state['averaged'][failed_avg] = False
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    nbytes = np.sum(state['nbytes']) - nbytes0
+    logger.info('averaged %d files with %d workers in %.2f s; %.1f MB read, '
+                '%.2f MB per file', index.size, num_workers,
+                time.perf_counter() - t1, nbytes / 1e6,
+                nbytes / 1e6 / max(1, index.size))
+    for stage, val in timer.items():
+        logger.info('%s: %.2f s reading, %.2f s computing in the workers',
+                    stage, val['read'], val['compute'])
+    return True
+
+
+def run_average(flist, work_dir='.', num_workers=None, shard_size=64,
+                screen_callback=None, callback=None, is_killed=None,
+                fields=('saxs_2d', ), avg_window=3, avg_qindex=0,
+                avg_blmin=0.95, avg_blmax=1.05, abs_scale=False,
+                mem_budget=None, checkpoint=None, checkpoint_interval=60,
+                base=None, retries=0, retry_delay=10, weighting='uniform',
+                ftype='nexus'):
+    """
+    average the files in two passes with the worker processes. The
+    screening pass reads only the g2 slice of each file to check the
+    baseline; the accumulation pass reads the fields of the accepted files
+    in shards, and the statistics of the shards are merged as they finish;
+    :param flist: list of filenames in work_dir
+    :param num_workers: the number of worker processes; default
+        os.cpu_count(); 1 to run in the current process
+    :param shard_size: the maximal number of files in a shard
+    :param screen_callback: called with (index, result) when a shard of the
+        screening pass is done, see screen_shard; index is the array of the
+        indices of the files of the shard in flist
+    :param callback: called with (index, partial) when a shard of the
+        accumulation pass is done, see average_shard. When the job resumes,
+        both callbacks are first called with the files done before; the
+        partial then only has 'mask', 'nbytes' and 'resumed', and the result
+        of the screening has 'resumed' instead of 'time'
+    :param is_killed: a function that returns True to stop the averaging
+    :param mem_budget: the memory budget in MB of each worker to stream
+        G2, IP and IF, see average_shard
+    :param checkpoint: the temporary hdf file to save the state of the
+        averaging; a job with the same files and parameters resumes from it.
+        It's removed when the averaging finishes. None to disable
+    :param checkpoint_interval: the minimal time in seconds between two
+        checkpoints; the state is also saved after the screening pass and
+        when the job is killed
+    :param base: an average output saved with the state by write_average;
+        if it's averaged with the same parameters and its files are all in
+        flist, only the new files are read and added to it
+    :param retries: the number of times to read again the files that
+        failed; see average_passes
+    :param retry_delay: the time in seconds to wait before a retry
+    :param weighting: the weights of the files, see get_file_weights
+    :return: the state with the keys 'stat', the statistics of the fields;
+        'mask', 1 for the averaged files; 'nbytes'; 'baseline' and 'accept'
+        of the screening; 'screened', 'averaged', 'key' and 'flist' to save
+        the state; 'weighting'. None if killed
+    """
+    get_weight_fields(weighting)
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    num_workers = max(1, min(num_workers, len(flist)))
+    flist = list(flist)
+    screen_kwargs = dict(work_dir=work_dir, avg_window=avg_window,
+                         avg_qindex=avg_qindex, avg_blmin=avg_blmin,
+                         avg_blmax=avg_blmax, ftype=ftype)
+    avg_kwargs = dict(work_dir=work_dir, fields=fields, abs_scale=abs_scale,
+                      mem_budget=mem_budget, weighting=weighting,
+                      ftype=ftype)
+
+    state_key = get_state_key(**screen_kwargs, fields=list(fields),
+                              abs_scale=abs_scale, weighting=weighting)
+    state = None
+    for fname, group in [(checkpoint, '/'), (base, state_group)]:
+        state = load_checkpoint(fname, state_key, flist, fields, group,
+                                ftype=ftype)
+        if state is not None:
+            logger.info('resume from %s: %d screened, %d averaged', fname,
+                        np.sum(state['screened']), np.sum(state['averaged']))
+            break
+
+    if state is None:
+        state = init_state(len(flist), fields)
+    else:
+        report_resumed(state, screen_callback, callback)
+
+    save = get_saver(checkpoint, checkpoint_interval,
+                     lambda: save_checkpoint(checkpoint, state_key, state,
+                                             flist))
+    labels = np.zeros(len(flist), dtype=np.int64)
+    flag = average_passes(flist, state, [state['stat']], labels, num_workers,
+                          shard_size, screen_kwargs, avg_kwargs,
+                          screen_callback, callback, is_killed, save,
+                          retries, retry_delay)
+    if not flag:
+        return None
+
+    if checkpoint is not None and os.path.isfile(checkpoint):
+        os.remove(checkpoint)
+    state.update({'key': state_key, 'flist': flist,
+                  'weighting': weighting})
+    return state
+
+
+def run_average_groups(groups, work_dir='.', num_workers=None, shard_size=64,
+                       screen_callback=None, callback=None, is_killed=None,
+                       fields=('saxs_2d', ), avg_window=3, avg_qindex=0,
+                       avg_blmin=0.95, avg_blmax=1.05, abs_scale=False,
+                       mem_budget=None, checkpoint=None,
+                       checkpoint_interval=60, base=None, retries=0,
+                       retry_delay=10, weighting='uniform', ftype='nexus'):
+    """
+    average several groups of files in one pass; the files of all groups
+    are screened together and the shards of all groups share the worker
+    pool, so the groups are averaged concurrently;
+    :param groups: dictionary of {name: list of filenames in work_dir}
+    :param screen_callback: see run_average; the indices are in the list of
+        the files of all groups, in the order of groups
+    :param callback: see run_average
+    :param checkpoint: see run_average; one checkpoint has the state of all
+        the groups and is only used by a job with the same groups
+    :param checkpoint_interval: see run_average
+    :param base: dictionary of {name: the average output of the group}, see
+        run_average; the groups without a usable output start from scratch.
+        It's not used if the job resumes from the checkpoint
+    :param retries: see run_average
+    :param weighting: see run_average
+    :return: dictionary of {name: the output of run_average for the
+        group}; None if killed
+    """
+    get_weight_fields(weighting)
+    names = list(groups)
+    flist, labels = [], []
+    for n, name in enumerate(names):
+        flist += list(groups[name])
+        labels += [n] * len(groups[name])
+    labels = np.array(labels, dtype=np.int64)
+
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    num_workers = max(1, min(num_workers, len(flist)))
+    screen_kwargs = dict(work_dir=work_dir, avg_window=avg_window,
+                         avg_qindex=avg_qindex, avg_blmin=avg_blmin,
+                         avg_blmax=avg_blmax, ftype=ftype)
+    avg_kwargs = dict(work_dir=work_dir, fields=fields, abs_scale=abs_scale,
+                      mem_budget=mem_budget, weighting=weighting,
+                      ftype=ftype)
+    state_key = get_state_key(**screen_kwargs, fields=list(fields),
+                              abs_scale=abs_scale, weighting=weighting)
+    # the checkpoint of the groups is not used by a single average
+    group_key = get_state_key(key=state_key, groups=[str(x) for x in names])
+
+    state = load_checkpoint(checkpoint, group_key, flist, fields,
+                            num_groups=len(names))
+    if state is not None:
+        logger.info('resume from %s: %d screened, %d averaged', checkpoint,
+                    np.sum(state['screened']), np.sum(state['averaged']))
+        stats = state.pop('stats')
+    else:
+        state = init_state(len(flist), fields)
+        stats = [{key: None for key in fields} for _ in names]
+        for n, name in enumerate(names):
+            part = load_checkpoint((base or {}).get(name), state_key,
+                                   groups[name], fields, state_group,
+                                   ftype=ftype)
+            if part is None:
+                continue
+            logger.info('extend %s: %d averaged', base[name],
+                        np.sum(part['averaged']))
+            idx = np.nonzero(labels == n)[0]
+            for k in state_keys:
+                state[k][idx] = part[k]
+            stats[n] = part['stat']
+    report_resumed(state, screen_callback, callback)
+
+    save = get_saver(checkpoint, checkpoint_interval,
+                     lambda: save_checkpoint(checkpoint, group_key, state,
+                                             flist, stats))
+    flag = average_passes(flist, state, stats, labels, num_workers,
+                          shard_size, screen_kwargs, avg_kwargs,
+                          screen_callback, callback, is_killed, save,
+                          retries, retry_delay)
+    if not flag:
+        return None
+
+    if checkpoint is not None and os.path.isfile(checkpoint):
+        os.remove(checkpoint)
+    ret = {}
+    for n, name in enumerate(names):
+        idx = labels == n
+        ret[name] = {k: state[k][idx] for k in state_keys}
+        ret[name].update({'stat': stats[n], 'key': state_key,
+                          'flist': list(groups[name]),
+                          'weighting': weighting})
+    return ret
+
+
+def get_group_label(fname, work_dir='.', group_by=None, ftype='nexus'):
+    """
+    get the group of a file for the grouped averaging
+    :param group_by: a metadata key in default.json or a hdf path starting
+        with '/', whose value is the label; otherwise a regular expression
+        searched in the filename, whose first group, or the whole match if
+        it has no group, is the label
+    :return: the label as str; None if the regular expression doesn't match
+    """
+    if group_by in hdf_key[ftype] or group_by.startswith('/'):
+        path = hdf_key[ftype].get(group_by, group_by)
+        with h5py.File(os.path.join(work_dir, fname), 'r') as f:
+            val = f[path][()]
+        if isinstance(val, bytes):
+            return val.decode()
+        return str(np.squeeze(val))
+
+    match = re.search(group_by, fname)
+    if match is None:
+        return None
+    if match.groups():
+        return match.group(1)
+    return match.group(0)
+
+
+def get_group_path(save_path, label):
+    # the output of a group is save_path with the label before the suffix
+    root, ext = os.path.splitext(save_path)
+    return '%s_%s%s' % (root, re.sub(r'[^\w.-]+', '_', label), ext)
+
+
+def group_files(flist, work_dir='.', group_by=None, ftype='nexus'):
+    """
+    partition the files by get_group_label; the files without a label are
+    left out
+    :return: dictionary of {label: list of filenames}, in the order of the
+        first file of each group
+    """
+    groups = {}
+    for fname in flist:
+        try:
+            label = get_group_label(fname, work_dir, group_by, ftype)
+        except Exception:
+            logger.error('failed to get the group of %s: %s', fname,
+                         traceback.format_exc())
+            continue
+        if label is None:
+            logger.info('%s does not match %s; skipped', fname, group_by)
+            continue
+        groups.setdefault(label, []).append(fname)
+    return groups
+
+
+def write_average(save_path, template, result, stat=None, state=None,
+                  ftype='nexus', slab_stat=True):
+    """
+    create the output file of the averaging. The metadata of the template
+    file are copied, without the averaged fields and the large fields of a
+    single file such as the two-time correlation; the averaged fields are
+    written as chunked and compressed datasets. The file is written to a
+    temporary path and renamed at the end;
+    :param save_path: the output file
+    :param template: one of the averaged files
+    :param result: the output of finalize_average
+    :param stat: the output of get_average_stat, saved in avg_stat_group;
+        None to skip
+    :param state: the output of run_average, saved in state_group so the
+        average can be extended later; None to skip. Only the weights and
+        m2 of the statistics are saved, the mean is the averaged dataset
+    :param ftype: ['nexus' | 'legacy'], see default.json
+    :param slab_stat: if False, the state is not saved when one of the
+        slab_fields is averaged, as it would hold another copy of it
+    :return: None
+    """
+    key = hdf_key[ftype]
+    skip = [key[x] for x in single_fields] + [key[x] for x in result]
+    tmp_path = save_path + '.part'
+    copy_metadata(template, tmp_path, skip)
+
+    with h5py.File(tmp_path, 'a') as f:
+        put(f, result, ftype=ftype, mode='alias', chunks=True,
+            compression='gzip')
+        if stat is not None:
+            stat = {'/'.join([avg_stat_group, k]): v for k, v in stat.items()}
+            put(f, stat, keep_shape=True, chunks=True, compression='gzip')
+        if state is not None and not slab_stat and \
+                any(x in slab_fields for x in result):
+            logger.info('the state of the slab fields is not saved; %s '
+                        'can not be extended', save_path)
+        elif state is not None:
+            # g2_err of the result is not the mean of g2_err
+            save_state(f.require_group(state_group), state['key'], state,
+                       state['flist'],
+                       skip_mean=[x for x in result if x != 'g2_err'])
+    os.replace(tmp_path, save_path)
+    logger.info('create file: %s, %.1f MB', save_path,
+                os.path.getsize(save_path) / 1e6)
@@ -1,8 +1,9 @@
 import numpy as np
-from scipy.optimize import curve_fit
+from scipy.optimize import curve_fit, least_squares
 import traceback
 from sklearn import linear_model
 import os
+import time
 import traceback
 import logging
 from joblib import Memory
@@ -18,6 +19,80 @@ def fit_with_fixed(*args, **kwargs):
     return fit_with_fixed_raw(*args, **kwargs)
 
 
+def single_exp_all(x, a, b, c, d):
+    """
+    single exponential fitting for xpcs-multitau analysis
+    :param x: delay in seconds
+    :param a: contrast
+    :param b: tau
+    :param c: restriction factor
+    :param d: baseline
+    :return:
+    """
+    return a * np.exp(-2 * (x / b) ** c) + d
+
+
+def double_exp_all(x, a, b1, c1, d, b2, c2, f):
+    """
+    double exponential fitting for xpcs-multitau analysis
+    Args:
+        x: delay in seconds, float or 1d-numpy.ndarray
+        a: contrast
+        f: fraction for the 1st exp function; the 2nd has (1-f) weight
+        b1: tau for 1st exp function
+        c1: restriction factor for the 1st exp function
+        b2: tau for 2nd exp function
+        c2: restriction factor for the 2nd exp function
+        d: baseline
+    Return:
+        function value
+    """
+    t1 = np.exp(-1 * (x / b1) ** c1) * f
+    t2 = np.exp(-1 * (x / b2) ** c2) * (1 - f)
+    return a * (t1 + t2) ** 2 + d
+
+
+def power_law(x, a, b):
+    """
+    power law for fitting the diffusion factor
+    :param x: tau
+    :param a:
+    :param b:
+    :return:
+    """
+    return a * x ** b
+
+
+def correct_g2_err(g2_err=None, threshold=1E-6):
+    # correct the err for some data points with really small error, which
+    # may cause the fitting to blowup
+
+    g2_err_mod = np.copy(g2_err)
+    for n in range(g2_err.shape[1]):
+        data = g2_err[:, n]
+        idx = data > threshold
+        # avoid averaging of empty slice
+        if np.sum(idx) > 0:
+            avg = np.mean(data[idx])
+        else:
+            avg = threshold
+        g2_err_mod[np.logical_not(idx), n] = avg
+
+    return g2_err_mod
+
+
+@memory.cache
+def fit_bootstrap(*args, **kwargs):
+    # the replicates are cached along with the regular fitting
+    return fit_bootstrap_raw(*args, **kwargs)
+
+
+@memory.cache
+def fit_g2_global(*args, **kwargs):
+    # wrap the fitting function in memory so avoid re-run
+    return fit_g2_global_raw(*args, **kwargs)
+
+
 def single_exp(x, tau, bkg, cts):
     return cts * np.exp( -2 * x / tau) + bkg
 
@@ -82,8 +157,240 @@ def fit_xpcs(tel, qd, g2, g2_err, b):
     return fit_result, fit_val
 
 
+def get_half_decay_time(log_t, y):
+    """
+    interpolate the time where the normalized g2 first drops below 0.5
+    :param log_t: log of the delay, (nt, )
+    :param y: the normalized g2, (..., nt, nq)
+    :return: the half decay time, (..., nq); the last delay is used for the
+        curves that never drop below 0.5
+    """
+    below = y < 0.5
+    idx = np.where(np.any(below, axis=-2), np.argmax(below, axis=-2), -1)
+    idx = np.clip(idx, 1, y.shape[-2] - 1)
+    y0 = np.take_along_axis(y, idx[..., None, :] - 1, axis=-2)[..., 0, :]
+    y1 = np.take_along_axis(y, idx[..., None, :], axis=-2)[..., 0, :]
+    frac = np.clip((y0 - 0.5) / np.where(y0 != y1, y0 - y1, 1.0), 0, 1)
+    return np.exp(log_t[idx - 1] + frac * (log_t[idx] - log_t[idx - 1]))
+
+
+def fit_log_linear(log_t, y, ymin=0.05, ymax=0.95):
+    """
+    weighted (0/1) linear regression of log(-log(y) / 2) = c * log(t) -
+    c * log(tau) on the decaying part of the normalized g2, for all columns
+    at once;
+    :param log_t: log of the delay, (nt, )
+    :param y: the normalized g2, (..., nt, nq)
+    :return: a tuple of (tau, stretch, ok), (..., nq); ok is False where the
+        regression is not possible, tau is then not finite
+    """
+    valid = (y > ymin) & (y < ymax)
+    z = np.log(-np.log(np.clip(y, ymin, ymax)) / 2.0)
+
+    w = valid.astype(np.float64)
+    xc = log_t[:, None]
+    sw = np.sum(w, axis=-2)
+    sx = np.sum(w * xc, axis=-2)
+    sy = np.sum(w * z, axis=-2)
+    sxx = np.sum(w * xc * xc, axis=-2)
+    sxy = np.sum(w * xc * z, axis=-2)
+    det = sw * sxx - sx * sx
+    ok = (sw >= 2) & (det > 1e-12)
+    det = np.where(ok, det, 1.0)
+    stretch = (sw * sxy - sx * sy) / det
+    intercept = (sxx * sy - sx * sxy) / det
+    ok = ok & (stretch > 0)
+    stretch = np.where(ok, stretch, 1.0)
+    with np.errstate(over='ignore'):
+        tau = np.exp(-intercept / stretch)
+    return tau, stretch, ok & np.isfinite(tau)
+
+
+def estimate_single_exp(t_el, g2, window=3, ymin=0.05, ymax=0.95,
+                        num_grid=33, max_ratio=4.0, min_snr=3.0,
+                        tau_margin=10.0, full_output=False):
+    """
+    non-iterative estimate of the single exponential parameters for every q;
+    the baseline is the average of the last points of g2 and the tau and the
+    stretching factor come from a weighted linear regression of
+    log(-log(y) / 2) = c * log(t) - c * log(tau) on the decaying part, where
+    y = (g2 - baseline) / contrast. The average of the first points is too
+    low as the contrast when the decay starts within them, which also
+    inflates the stretching factor; the contrast extrapolated to t = 0 is
+    instead chosen on a grid from that average up to max_ratio times it, as
+    the one whose regression fits g2 with the smallest squared residual,
+    refined by a parabola through the grid points. The whole computation is
+    vectorized over q so it is cheap enough to seed every fitting.
+    :param t_el: delay in seconds, 1d-numpy.ndarray with the length of nt
+    :param g2: g2 values, numpy.ndarray with the shape of (nt, nq); more
+        leading dimensions, e.g. (num_files, nt, nq), are computed at once
+    :param window: number of points used at both ends to get the baseline
+        and the lower end of the contrast grid
+    :param ymin: the lower bound of the normalized g2 used in the regression
+    :param ymax: the upper bound of the normalized g2 used in the regression
+    :param num_grid: the number of contrasts on the grid; 1 to keep the
+        average of the first points
+    :param max_ratio: the upper end of the contrast grid relative to the
+        average of the first points
+    :param min_snr: the estimate is only valid if the contrast is larger
+        than min_snr times the noise of g2, the larger of the scatter of
+        the first points and the point to point scatter of the second half
+    :param tau_margin: the estimate is only valid if tau is within
+        [t_el[0] / tau_margin, t_el[-1] * tau_margin]
+    :param full_output: if True, also return the half decay time and the
+        cumulants, see quick_look_g2
+    :return: numpy.ndarray with the shape of (..., nq, 4); the columns are
+        [contrast, tau, stretch, baseline], same as single_exp_all;
+    """
+    g2 = np.asarray(g2, dtype=np.float64)
+    t_el = np.asarray(t_el, dtype=np.float64)
+    log_t = np.log(t_el)
+
+    baseline = np.mean(g2[..., -window:, :], axis=-2)
+    contrast = np.mean(g2[..., :window, :], axis=-2) - baseline
+    # avoid dividing by zero for flat curves
+    contrast = np.where(np.abs(contrast) > 1e-6, contrast, 1e-6)
+    delta = g2 - baseline[..., None, :]
+
+    # the squared residual of the regression with each contrast of the grid
+    log_ratio = np.linspace(0, np.log(max_ratio), max(1, num_grid))
+    sse = np.full(log_ratio.shape + contrast.shape, np.inf)
+    for k, val in enumerate(log_ratio):
+        beta = contrast * np.exp(val)
+        tau, stretch, ok = fit_log_linear(log_t, delta / beta[..., None, :],
+                                          ymin, ymax)
+        with np.errstate(over='ignore', invalid='ignore'):
+            model = beta[..., None, :] * np.exp(
+                -2 * (t_el[:, None] / tau[..., None, :]) **
+                stretch[..., None, :])
+            sse[k] = np.where(ok, np.sum((delta - model) ** 2, axis=-2),
+                              np.inf)
+
+    best = np.argmin(sse, axis=0)
+    if log_ratio.size >= 3:
+        # the vertex of the parabola through the best point and its
+        # neighbours
+        mid = np.clip(best, 1, log_ratio.size - 2)
+        s0, s1, s2 = [np.take_along_axis(sse, (mid + n)[None], axis=0)[0]
+                      for n in (-1, 0, 1)]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            den = s0 - 2 * s1 + s2
+            shift = np.clip(0.5 * (s0 - s2) / den, -1, 1)
+        step = log_ratio[1] - log_ratio[0]
+        val = np.where(np.isfinite(shift) & (den > 0),
+                       log_ratio[mid] + shift * step, log_ratio[best])
+    else:
+        val = log_ratio[best]
+    # keep the average of the first points where no regression works
+    val = np.where(np.all(np.isinf(sse), axis=0), 0.0, val)
+    contrast = contrast * np.exp(val)
+
+    y = delta / contrast[..., None, :]
+    tau, stretch, ok = fit_log_linear(log_t, y, ymin, ymax)
+
+    # fall back to the half-decay time when the regression is not possible
+    tau_half = get_half_decay_time(log_t, y) / (np.log(2) / 2.0)
+    tau = np.where(ok, tau, tau_half)
+
+    p = np.stack([contrast, tau, stretch, baseline], axis=-1)
+    if not full_output:
+        return p
+
+    # flat or noisy curves give a regression too, with a meaningless tau
+    noise = np.maximum(
+        np.std(g2[..., :window, :], axis=-2, ddof=1),
+        np.std(np.diff(g2[..., t_el.size // 2:, :], axis=-2), axis=-2) /
+        np.sqrt(2))
+    valid = ok & (contrast > min_snr * noise) & \
+        (tau >= t_el[0] / tau_margin) & (tau <= t_el[-1] * tau_margin)
+
+    gamma, pdi = get_cumulants(np.exp(log_t), y, tau_half)
+    extra = {'t_half': tau_half * (np.log(2) / 2.0), 'gamma': gamma,
+             'pdi': pdi, 'valid': valid}
+    return p, extra
+
+
+def get_cumulants(t_el, y, t_scale, ymin=0.2, ymax=0.95):
+    """
+    the cumulant analysis of the early decay, log(y) / 2 = c0 - gamma * t +
+    mu2 / 2 * t ^ 2, solved with weighted (0/1) normal equations for all
+    columns at once. the time is scaled by t_scale of each column to keep
+    the equations well conditioned.
+    :param t_el: delay in seconds, (nt, )
+    :param y: the normalized g2, (..., nt, nq)
+    :param t_scale: the time scale of each column, (..., nq)
+    :return: a tuple of (gamma, pdi), the mean decay rate and the
+        polydispersity index mu2 / gamma ^ 2; nan if it can't be solved
+    """
+    s = t_el[:, None] / t_scale[..., None, :]
+    w = ((y > ymin) & (y < ymax)).astype(np.float64)
+    z = np.log(np.clip(y, ymin, ymax)) / 2.0
+    design = np.stack([np.ones_like(s), -s, s * s / 2.0], axis=-1)
+    mat = np.einsum('...tqi,...tq,...tqj->...qij', design, w, design)
+    vec = np.einsum('...tqi,...tq,...tq->...qi', design, w, z)
+    ok = (np.sum(w, axis=-2) >= 3) & (np.linalg.cond(mat) < 1e12)
+    mat[~ok] = np.eye(3)
+    coef = np.linalg.solve(mat, vec[..., None])[..., 0]
+    gamma = np.where(ok, coef[..., 1] / t_scale, np.nan)
+    pdi = np.where(ok, coef[..., 2] / np.where(ok, coef[..., 1], 1.0) ** 2,
+                   np.nan)
+    return gamma, pdi
+
+
+def quick_look_g2(t_el, g2, window=3):
+    """
+    quick look of g2 without the nonlinear fitting, for the triage of many
+    files; it combines estimate_single_exp, the half decay time and the
+    cumulant analysis.
+    :param t_el: delay in seconds, (nt, )
+    :param g2: g2 values, (..., nt, nq); a stack of files with the same
+        delays and q can be computed at once
+    :param window: number of points used at both ends to get the contrast
+        and baseline
+    :return: a dictionary of arrays with the shape of (..., nq): contrast,
+        tau, stretch, baseline from the log-linear regression, t_half the
+        half decay time of the normalized g2, gamma the first cumulant, pdi
+        the polydispersity index and valid, False where the regression
+        fell back to the half decay time, the contrast is not clearly above
+        the noise or tau is far out of the delays; see estimate_single_exp
+    """
+    p, extra = estimate_single_exp(t_el, g2, window=window, full_output=True)
+    result = {'contrast': p[..., 0], 'tau': p[..., 1], 'stretch': p[..., 2],
+              'baseline': p[..., 3]}
+    result.update(extra)
+    return result
+
+
+def get_g2_p0(t_el, g2, bounds, fit_func='single', estimate=True):
+    """
+    get the initial values for the g2 fitting
+    :param t_el: delay in seconds
+    :param g2: g2 values, numpy.ndarray with the shape of (nt, nq)
+    :param bounds: bounds for fitting; (2, 4) for single exp and (2, 7) for
+        double exp;
+    :param fit_func: ['single' | 'double']
+    :param estimate: if False, use the center of the bounds for all q;
+        otherwise use estimate_single_exp for the first four parameters;
+    :return: numpy.ndarray with the shape of (num_args, ) if estimate is
+        False, otherwise (nq, num_args)
+    """
+    p0 = np.array(bounds).mean(axis=0)
+    # tau's bounds are in log scale, set as the geometric average
+    p0[1] = np.sqrt(bounds[0][1] * bounds[1][1])
+    if fit_func == 'double':
+        p0[4] = np.sqrt(bounds[0][4] * bounds[1][4])
+
+    if not estimate:
+        return p0
+
+    # the 2nd exp of the double exp function keeps the bounds' center
+    p0 = np.tile(p0, (g2.shape[1], 1))
+    p0[:, 0:4] = estimate_single_exp(t_el, g2)
+    return p0
+
+
 def fit_with_fixed_raw(base_func, x, y, sigma, bounds, fit_flag, fit_x,
-                       p0=None):
+                       p0=None, warm_start=False):
     """
     :param base_func: the base function used for fitting; it can have multiple
         input variables, some of which can be fixed during the fitting;
@@ -96,8 +403,13 @@ def fit_with_fixed_raw(base_func, x, y, sigma, bounds, fit_flag, fit_x,
     :param fit_flag: tuple of bools, True/False for fit and fixed
     :param fit_x: the fitting line for x
     :param p0: the initial value for the variables; if None is provided, the
-        intial value is set as the mean of lower and upper bounds
-    :return: a tuple of (fit_line, fit_val)
+        intial value is set as the mean of lower and upper bounds; a 2d
+        array with the shape of (y.shape[1], num_args) gives one initial
+        value for each column of y;
+    :param warm_start: if True, each column is seeded with the solution of
+        the previous column when that fitting succeeded;
+    :return: a tuple of (fit_line, fit_val); the number of function
+        evaluations used by each column is kept in fit_line as 'nfev';
     """
     if not isinstance(fit_flag, np.ndarray):
         fit_flag = np.array(fit_flag)
@@ -113,8 +425,12 @@ def fit_with_fixed_raw(base_func, x, y, sigma, bounds, fit_flag, fit_x,
     # number of arguments, regardless of fixed or to be fitted
     num_args = len(fit_flag)
 
+    # number of function evaluations, including the ones for the jacobian
+    nfev = [0]
+
     # create a function that takes care of the fit flag;
     def func(x1, *args):
+        nfev[0] += 1
         inputs = np.zeros(num_args)
         inputs[fix_flag] = bounds[1, fix_flag]
         inputs[fit_flag] = np.array(args)
@@ -126,20 +442,30 @@ def fit_with_fixed_raw(base_func, x, y, sigma, bounds, fit_flag, fit_x,
     if p0 is None:
         p0 = np.mean(bounds_fit, axis=0)
     else:
-        p0 = np.array(p0)[fit_flag]
+        p0 = np.array(p0)[..., fit_flag]
+    # the initial values must be feasible
+    p0 = np.clip(p0, bounds_fit[0], bounds_fit[1])
+    p0_all = np.broadcast_to(p0, (y.shape[1], bounds_fit.shape[1]))
 
     fit_val = np.zeros((y.shape[1], 2, num_args))
 
     fit_line = []
+    popt_prev = None
     for n in range(y.shape[1]):
         flag = True
+        p0 = p0_all[n]
+        if warm_start and popt_prev is not None:
+            p0 = popt_prev
+        nfev[0] = 0
         try:
             popt, pcov = curve_fit(func, x, y[:, n], p0=p0, sigma=sigma[:, n],
                                    bounds=bounds_fit)
-        except (Exception, RuntimeError, ValueError, Warning) as err:
+        except (Exception, RuntimeError, ValueError, Warning):
             msg = "Fitting failed: %s" % traceback.format_exc()
             logger.info(msg)
             flag = False
+            popt_prev = None
+            count = nfev[0]
             fit_val[n, 0, fit_flag] = p0 
             fit_val[n, 0, fix_flag] = bounds[1, fix_flag]
             # mark failed fitting to be negative so they can be filtered later
@@ -154,11 +480,518 @@ def fit_with_fixed_raw(base_func, x, y, sigma, bounds, fit_flag, fit_x,
             fit_val[n, 0, fix_flag] = bounds[1, fix_flag]
             # errors; the fixed variables have error of 0
             fit_val[n, 1, fit_flag] = np.sqrt(np.diag(pcov))
+            popt_prev = popt
+            count = nfev[0]
             # fit line
             fit_y = func(fit_x, *popt)
 
         finally:
             fit_line.append({'fit_x': fit_x, 'fit_y': fit_y, 'success': flag,
-                             'msg': msg})
+                             'msg': msg, 'nfev': count})
+
+    return fit_line, fit_val
 
+
+def fit_g2_global_raw(t_el, q, g2, sigma, bounds, fit_flag, tauq_bounds,
+                      tauq_flag, fit_x, p0=None):
+    """
+    fit g2 of all q at once with the single exponential function, where the
+    contrast, stretch and baseline are free for each q and the relaxation
+    time follows a shared power law, tau(q) = a * q ** b. the residuals of
+    all q are stacked into one least squares problem with an analytical
+    jacobian; log10(a) is fitted instead of a to keep it well conditioned.
+    :param t_el: delay in seconds, (nt, )
+    :param q: q values, (nq, )
+    :param g2: g2 values, (nt, nq)
+    :param sigma: the error of g2, (nt, nq)
+    :param bounds: bounds of the single exp function, (2, 4); the tau bounds
+        are not used;
+    :param fit_flag: 4 bools for [contrast, tau, stretch, baseline]; the
+        fixed ones use the upper bound; the tau flag is not used;
+    :param tauq_bounds: bounds of the power law, [[a_min, b_min],
+        [a_max, b_max]]
+    :param tauq_flag: 2 bools for [a, b]; the fixed ones use the upper bound
+    :param fit_x: the x values for the g2 fitting lines
+    :param p0: the initial value with the shape of (nq, 4); the tau column is
+        used to get the initial power law; if None, estimate_single_exp is
+        used;
+    :return: a tuple of (fit_line, fit_val, tauq_val, success, msg); fit_line
+        and fit_val are in the same format as fit_with_fixed_raw, where tau
+        and its error are derived from the power law; tauq_val is
+        [[a, b], [a_err, b_err]]
+    """
+    nq = q.size
+    bounds = np.array(bounds, dtype=np.float64)
+    tauq_bounds = np.array(tauq_bounds, dtype=np.float64)
+    fit_flag = np.array(fit_flag, dtype=bool)
+    tauq_flag = np.array(tauq_flag, dtype=bool)
+    log_t = np.log(t_el)[:, None]
+    log_q = np.log(q)
+
+    if p0 is None:
+        p0 = estimate_single_exp(t_el, g2)
+
+    # parameters: [log10(a), b, contrast * nq, stretch * nq, baseline * nq]
+    lb = np.concatenate([[np.log10(tauq_bounds[0, 0]), tauq_bounds[0, 1]],
+                         np.repeat(bounds[0, [0, 2, 3]], nq)])
+    ub = np.concatenate([[np.log10(tauq_bounds[1, 0]), tauq_bounds[1, 1]],
+                         np.repeat(bounds[1, [0, 2, 3]], nq)])
+    free = np.concatenate([tauq_flag, np.repeat(fit_flag[[0, 2, 3]], nq)])
+
+    # the initial power law from a linear regression of log(tau)
+    tau0 = np.clip(p0[:, 1], 1e-12, None)
+    A = np.vstack([np.ones(nq), log_q]).T
+    coef = np.linalg.lstsq(A, np.log(tau0), rcond=None)[0]
+    x0 = np.concatenate([[coef[0] / np.log(10), coef[1]],
+                         p0[:, 0], p0[:, 2], p0[:, 3]])
+    # the fixed parameters use the upper bounds
+    x0[~free] = ub[~free]
+    x0 = np.clip(x0, lb, ub)
+
+    def unpack(x_free):
+        x = x0.copy()
+        x[free] = x_free
+        la, b = x[0], x[1]
+        contrast, stretch, baseline = x[2:].reshape(3, nq)
+        return la, b, contrast, stretch, baseline
+
+    def residual(x_free):
+        la, b, contrast, stretch, baseline = unpack(x_free)
+        tau = 10 ** la * q ** b
+        u = (t_el[:, None] / tau) ** stretch
+        model = contrast * np.exp(-2 * u) + baseline
+        return ((model - g2) / sigma).ravel()
+
+    def jacobian(x_free):
+        la, b, contrast, stretch, baseline = unpack(x_free)
+        tau = 10 ** la * q ** b
+        log_r = log_t - np.log(tau)
+        u = np.exp(stretch * log_r)
+        e = np.exp(-2 * u)
+        jac = np.zeros((t_el.size, nq, x0.size))
+        # d(model) / d(log tau)
+        dlt = 2 * contrast * e * u * stretch
+        jac[:, :, 0] = dlt * np.log(10)
+        jac[:, :, 1] = dlt * log_q
+        idx = np.arange(nq)
+        jac[:, idx, 2 + idx] = e
+        jac[:, idx, 2 + nq + idx] = -2 * contrast * e * u * log_r
+        jac[:, idx, 2 + 2 * nq + idx] = 1.0
+        jac /= sigma[:, :, None]
+        return jac.reshape(-1, x0.size)[:, free]
+
+    fit_val = np.zeros((nq, 2, 4))
+    tauq_val = np.zeros((2, 2))
+    try:
+        res = least_squares(residual, x0[free], jac=jacobian,
+                            bounds=(lb[free], ub[free]), method='trf',
+                            x_scale='jac')
+        if not res.success:
+            raise RuntimeError(res.message)
+    except (Exception, RuntimeError, ValueError):
+        msg = "Fitting failed: %s" % traceback.format_exc()
+        logger.info(msg)
+        la, b, contrast, stretch, baseline = unpack(x0[free])
+        tau = 10 ** la * q ** b
+        fit_val[:, 0] = np.vstack([contrast, tau, stretch, baseline]).T
+        fit_val[:, 1] = -1
+        tauq_val[0] = [10 ** la, b]
+        tauq_val[1] = -1
+        fit_line = [{'fit_x': fit_x, 'fit_y': None, 'success': False,
+                     'msg': msg} for _ in range(nq)]
+        return fit_line, fit_val, tauq_val, False, msg
+
+    la, b, contrast, stretch, baseline = unpack(res.x)
+    tau = 10 ** la * q ** b
+
+    # covariance scaled by the reduced chi-square, same as curve_fit
+    dof = max(1, res.fun.size - res.x.size)
+    chi2 = np.sum(res.fun ** 2) / dof
+    cov_free = np.linalg.pinv(res.jac.T @ res.jac) * chi2
+    cov = np.zeros((x0.size, x0.size))
+    cov[np.ix_(free, free)] = cov_free
+    err = np.sqrt(np.clip(np.diag(cov), 0, None))
+
+    # propagate the power law errors to log(tau) of each q
+    grad = np.vstack([np.full(nq, np.log(10)), log_q]).T
+    var_log_tau = np.einsum('ij,jk,ik->i', grad, cov[0:2, 0:2], grad)
+    tau_err = tau * np.sqrt(np.clip(var_log_tau, 0, None))
+
+    fit_val[:, 0] = np.vstack([contrast, tau, stretch, baseline]).T
+    fit_val[:, 1] = np.vstack([err[2:2 + nq], tau_err,
+                               err[2 + nq:2 + 2 * nq], err[2 + 2 * nq:]]).T
+    tauq_val[0] = [10 ** la, b]
+    tauq_val[1] = [10 ** la * np.log(10) * err[0], err[1]]
+
+    fit_y = single_exp_all(fit_x[:, None], contrast, tau, stretch, baseline)
+    msg = 'FittingSuccess'
+    fit_line = [{'fit_x': fit_x, 'fit_y': fit_y[:, n], 'success': True,
+                 'msg': msg} for n in range(nq)]
+    return fit_line, fit_val, tauq_val, True, msg
+
+
+def fit_tauq_batch(q_list, tau_list, err_list, bounds, fit_flag):
+    """
+    fit the power law tau = a * q ** b for many files at once. the power law
+    is linear in log space, log(tau) = log(a) + b * log(q), so all files are
+    solved together with one weighted linear regression, using the weight
+    (tau / tau_err) ** 2. the files whose solution violates the bounds are
+    refined with the nonlinear fitting, starting from the clipped solution.
+    :param q_list: list of q arrays, one for each file
+    :param tau_list: list of tau arrays, one for each file
+    :param err_list: list of tau error arrays, one for each file
+    :param bounds: [[a_min, b_min], [a_max, b_max]]
+    :param fit_flag: 2 bools for [a, b]; the fixed ones use the upper bound
+    :return: a tuple of (fit_line, fit_val) in the same format as
+        fit_with_fixed_raw, with one element for each file; the fitting line
+        covers the q range of each file
+    """
+    bounds = np.array(bounds, dtype=np.float64)
+    fit_flag = np.array(fit_flag, dtype=bool)
+    num_files = len(q_list)
+    num_free = np.sum(fit_flag)
+
+    # pad all files to the same length; the padded points have zero weight
+    size = max([len(x) for x in q_list] + [1])
+    log_q = np.zeros((num_files, size))
+    log_tau = np.zeros((num_files, size))
+    weight = np.zeros((num_files, size))
+    for n in range(num_files):
+        q, tau, err = (np.asarray(x, dtype=np.float64).ravel() for x in
+                       (q_list[n], tau_list[n], err_list[n]))
+        valid = (q > 0) & (tau > 0) & (err > 0)
+        m = np.sum(valid)
+        log_q[n, :m] = np.log(q[valid])
+        log_tau[n, :m] = np.log(tau[valid])
+        weight[n, :m] = (tau[valid] / err[valid]) ** 2
+    num_points = np.sum(weight > 0, axis=1)
+
+    # design matrix for [log(a), b]; the fixed ones move to the left side
+    design = np.stack([np.ones_like(log_q), log_q], axis=-1)
+    p_fix = np.array([np.log(bounds[1, 0]), bounds[1, 1]])[~fit_flag]
+    target = log_tau - design[..., ~fit_flag] @ p_fix
+    design = design[..., fit_flag]
+
+    # batched normal equations, (num_files, num_free, num_free)
+    mat = np.einsum('fni,fn,fnj->fij', design, weight, design)
+    vec = np.einsum('fni,fn,fn->fi', design, weight, target)
+    enough = num_points >= num_free
+    enough &= np.linalg.cond(mat) < 1e12
+    # replace the singular ones so the batched solver does not fail
+    mat[~enough] = np.eye(num_free)
+    inv = np.linalg.inv(mat)
+    popt = np.einsum('fij,fj->fi', inv, vec)
+
+    # covariance scaled by the reduced chi-square, same as curve_fit
+    resid = target - np.einsum('fni,fi->fn', design, popt)
+    dof = num_points - num_free
+    chi2 = np.sum(weight * resid ** 2, axis=1) / np.clip(dof, 1, None)
+    chi2[dof <= 0] = 1.0
+    perr = np.sqrt(np.clip(np.diagonal(inv, axis1=1, axis2=2), 0, None) *
+                   chi2[:, None])
+
+    # back to [a, b]
+    val = np.zeros((num_files, 2))
+    err = np.zeros((num_files, 2))
+    val[:, fit_flag] = popt
+    val[:, ~fit_flag] = p_fix
+    err[:, fit_flag] = perr
+    val[:, 0] = np.exp(val[:, 0])
+    err[:, 0] = val[:, 0] * err[:, 0]
+
+    in_bounds = np.all((val[:, fit_flag] >= bounds[0, fit_flag]) &
+                       (val[:, fit_flag] <= bounds[1, fit_flag]), axis=1)
+
+    fit_line = []
+    fit_val = np.zeros((num_files, 2, 2))
+    num_refined = 0
+    for n in range(num_files):
+        q = np.exp(log_q[n, :num_points[n]])
+        if num_points[n] > 0:
+            fit_x = np.logspace(np.log10(np.min(q) / 1.1),
+                                np.log10(np.max(q) * 1.1), 128)
+        else:
+            fit_x = None
+
+        if not enough[n]:
+            msg = 'Fitting failed: %d valid points for %d parameters' % (
+                num_points[n], num_free)
+            fit_val[n, 0] = np.clip(val[n], bounds[0], bounds[1])
+            fit_val[n, 1] = -1
+            fit_line.append({'fit_x': fit_x, 'fit_y': None, 'success': False,
+                             'msg': msg, 'nfev': 0})
+        elif in_bounds[n]:
+            fit_val[n] = [val[n], err[n]]
+            fit_line.append({'fit_x': fit_x,
+                             'fit_y': power_law(fit_x, *val[n]),
+                             'success': True, 'msg': 'FittingSuccess',
+                             'nfev': 0})
+        else:
+            num_refined += 1
+            tau = np.exp(log_tau[n, :num_points[n]])
+            sigma = tau / np.sqrt(weight[n, :num_points[n]])
+            p0 = np.clip(val[n], bounds[0], bounds[1])
+            line, v = fit_with_fixed_raw(power_law, q, tau.reshape(-1, 1),
+                                         sigma.reshape(-1, 1), bounds,
+                                         fit_flag, fit_x, p0=p0)
+            fit_val[n] = v[0]
+            fit_line.append(line[0])
+
+    logger.info('tau(q) fitting for %d files; %d refined with curve_fit',
+                num_files, num_refined)
     return fit_line, fit_val
+
+
+def goodness_of_fit(base_func, x, y, sigma, fit_val, fit_flag):
+    """
+    compute the goodness of fit for all columns at once. the jacobian is
+    evaluated with forward differences, one vectorized function call per
+    free parameter, so no refitting is needed.
+    :param base_func: the function used for fitting; it must broadcast
+        parameters of the shape (m, ) against x of the shape (n, 1)
+    :param x: the input, (n, )
+    :param y: the output, (n, m)
+    :param sigma: the error of y, (n, m)
+    :param fit_val: the fitting result from fit_with_fixed_raw, (m, 2, k)
+    :param fit_flag: k bools, True for the fitted parameters
+    :return: a dictionary with the reduced chi-square 'chi2' (m, ), the
+        normalized residuals 'residual' (n, m), the parameter correlation
+        'corr' (m, k, k) and the condition number of the correlation matrix
+        'cond' (m, ); the failed fittings have nan values
+    """
+    fit_flag = np.array(fit_flag, dtype=bool)
+    num_free = np.sum(fit_flag)
+    p = fit_val[:, 0, :]
+    num, num_col = y.shape
+    x = np.asarray(x).reshape(-1, 1)
+
+    model = base_func(x, *p.T)
+    residual = (y - model) / sigma
+    dof = max(num - num_free, 1)
+    chi2 = np.sum(residual ** 2, axis=0) / dof
+
+    jac = np.zeros((num, num_col, num_free))
+    for n, idx in enumerate(np.nonzero(fit_flag)[0]):
+        step = 1e-6 * np.abs(p[:, idx]) + 1e-12
+        p_step = p.copy()
+        p_step[:, idx] += step
+        jac[:, :, n] = (base_func(x, *p_step.T) - model) / step / sigma
+
+    # the correlation doesn't depend on the chi-square scaling of pcov
+    cov = np.linalg.pinv(np.einsum('nmi,nmj->mij', jac, jac))
+    diag = np.sqrt(np.clip(np.diagonal(cov, axis1=1, axis2=2), 1e-300, None))
+    corr_free = cov / diag[:, :, None] / diag[:, None, :]
+    corr = np.zeros((num_col, fit_flag.size, fit_flag.size))
+    corr[:, np.outer(fit_flag, fit_flag)] = corr_free.reshape(num_col, -1)
+    cond = np.linalg.cond(corr_free) if num_free > 0 else np.ones(num_col)
+
+    # failed fittings have negative errors
+    failed = fit_val[:, 1, 0] < 0
+    chi2[failed] = np.nan
+    cond[failed] = np.nan
+    corr[failed] = np.nan
+    residual[:, failed] = np.nan
+
+    return {
+        'chi2': chi2,
+        'residual': residual.astype(np.float32),
+        'corr': corr.astype(np.float32),
+        'cond': cond,
+    }
+
+
+def get_fit_dtype(num_args):
+    """
+    the structured dtype of the fitting result of one q
+    :param num_args: the number of parameters of the fitting function
+    :return: numpy dtype with the fields 'val', 'err', 'success', 'nfev'
+        and 'chi2'
+    """
+    return np.dtype([('val', np.float64, (num_args,)),
+                     ('err', np.float64, (num_args,)),
+                     ('success', np.bool_),
+                     ('nfev', np.int32),
+                     ('chi2', np.float64)])
+
+
+def pack_fit_result(fit_line, fit_val, chi2=None):
+    """
+    pack the result of fit_with_fixed_raw into contiguous arrays; all the
+    fitting lines share the same fit_x, so it is kept only once and the
+    fit_y of all q are stacked; the messages are not kept since the failed
+    fittings are logged already;
+    :param fit_line: list of dicts, one for each q
+    :param fit_val: the fitting values, (m, 2, k)
+    :param chi2: the reduced chi-square, (m, ); nan if None
+    :return: a tuple of (fit_res, fit_x, fit_y); fit_res is a structured
+        array (m, ) with the dtype from get_fit_dtype; fit_y is float32
+        (m, fit_x.size) with nan for the failed fittings
+    """
+    num_col, _, num_args = fit_val.shape
+    fit_res = np.zeros(num_col, dtype=get_fit_dtype(num_args))
+    fit_res['val'] = fit_val[:, 0]
+    fit_res['err'] = fit_val[:, 1]
+    fit_res['success'] = [x['success'] for x in fit_line]
+    fit_res['nfev'] = [x.get('nfev', 0) for x in fit_line]
+    fit_res['chi2'] = np.nan if chi2 is None else chi2
+
+    fit_x = fit_line[0]['fit_x']
+    fit_y = np.full((num_col, fit_x.size), np.nan, dtype=np.float32)
+    for n, x in enumerate(fit_line):
+        if x['success'] and x['fit_y'] is not None:
+            fit_y[n] = x['fit_y']
+    return fit_res, fit_x, fit_y
+
+
+def fit_batch_raw(base_func, x, y, sigma, bounds, fit_flag, p0,
+                  max_iter=200, tol=1e-10):
+    """
+    fit many columns of y with the same function at once, with a vectorized
+    Levenberg-Marquardt solver; the jacobians of all columns are computed by
+    forward differences in one call of base_func per parameter, and the
+    damped normal equations are solved in one batch. the parameters are
+    clipped to the bounds after each step.
+    :param base_func: the function used for fitting; it must broadcast the
+        parameters given as (1, m) arrays over x given as (n, 1)
+    :param x: the input, (n, )
+    :param y: the output, (n, m)
+    :param sigma: the error of y, (n, m)
+    :param bounds: the fitting bounds, (2, k)
+    :param fit_flag: k bools; the fixed ones use the upper bound
+    :param p0: the initial values, (m, k)
+    :param max_iter: the maximal number of iterations
+    :param tol: the relative decrease of the chi-square to stop
+    :return: a tuple of (popt, success); popt is (m, k)
+    """
+    fit_flag = np.asarray(fit_flag, dtype=bool)
+    bounds = np.asarray(bounds, dtype=np.float64)
+    lb, ub = bounds[0, fit_flag], bounds[1, fit_flag]
+    xc = np.asarray(x, dtype=np.float64).reshape(-1, 1)
+    popt = np.array(p0, dtype=np.float64)
+    popt[:, ~fit_flag] = bounds[1, ~fit_flag]
+    popt[:, fit_flag] = np.clip(popt[:, fit_flag], lb, ub)
+
+    def get_residual(p, cols=Ellipsis):
+        # the normalized residual of the columns cols with parameters p
+        with np.errstate(all='ignore'):
+            return (y[:, cols] - base_func(xc, *p.T)) / sigma[:, cols]
+
+    res = get_residual(popt)
+    cost = np.sum(res ** 2, axis=0)
+    damp = np.full(y.shape[1], 1e-3)
+    active = np.isfinite(cost)
+    free = np.nonzero(fit_flag)[0]
+    for _ in range(max_iter):
+        if not np.any(active):
+            break
+        idx = np.nonzero(active)[0]
+        p, r = popt[idx], res[:, idx]
+        jac = np.empty(r.shape + (free.size, ))
+        for j, k in enumerate(free):
+            step = 1.5e-8 * np.maximum(np.abs(p[:, k]), 1e-12)
+            # step backwards at the upper bound
+            step = np.where(p[:, k] + step > ub[j], -step, step)
+            p1 = p.copy()
+            p1[:, k] += step
+            jac[..., j] = (r - get_residual(p1, idx)) / step
+        mat = np.einsum('nbi,nbj->bij', jac, jac)
+        vec = np.einsum('nbi,nb->bi', jac, r)
+        # the parameters at a bound that the gradient pushes out are kept
+        pf = p[:, free]
+        hold = ((pf <= lb) & (vec < 0)) | ((pf >= ub) & (vec > 0))
+        vec[hold] = 0
+        mat[hold[:, :, None] | hold[:, None, :]] = 0
+        diag = np.einsum('bii->bi', mat)
+        diag[hold] = 1
+        mat[:, np.arange(free.size), np.arange(free.size)] = \
+            (1 + damp[idx, None]) * np.maximum(diag, 1e-30)
+        try:
+            delta = np.linalg.solve(mat, vec[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            delta = np.stack([np.linalg.lstsq(a, b, rcond=None)[0]
+                              for a, b in zip(mat, vec)])
+        p_new = p.copy()
+        p_new[:, free] = np.clip(p[:, free] + delta, lb, ub)
+        r_new = get_residual(p_new, idx)
+        cost_new = np.sum(r_new ** 2, axis=0)
+
+        better = np.isfinite(cost_new) & (cost_new <= cost[idx])
+        # a small decrease only means convergence with small damping
+        done = better & (cost[idx] - cost_new <= tol * cost[idx]) & \
+            (damp[idx] <= 1e-3)
+        # the step is too small to change the parameters
+        done |= np.all(p_new == p, axis=1)
+        popt[idx[better]] = p_new[better]
+        res[:, idx[better]] = r_new[:, better]
+        cost[idx[better]] = cost_new[better]
+        damp[idx] = np.where(better, damp[idx] / 3, damp[idx] * 2)
+        active[idx[done | (damp[idx] > 1e10)]] = False
+
+    success = np.isfinite(cost) & np.all(np.isfinite(popt), axis=1)
+    return popt, success
+
+
+def fit_bootstrap_raw(base_func, x, y, sigma, bounds, fit_flag, fit_val,
+                      num_boot=50, time_budget=None, seed=0, batch_size=32):
+    """
+    estimate the uncertainty of the fitting parameters with the residual
+    bootstrap. each replicate adds the resampled normalized residuals of a
+    column to its fitting curve; the replicates of all columns are refitted
+    together by the vectorized solver fit_batch_raw, starting from the
+    original solution, batch_size replicates at a time. unlike the errors
+    from pcov, the spread doesn't depend on the scale of sigma.
+    :param base_func: the function used for fitting
+    :param x: the input, (n, )
+    :param y: the output, (n, m)
+    :param sigma: the error of y, (n, m)
+    :param bounds: the fitting bounds, (2, k)
+    :param fit_flag: k bools; the fixed ones use the upper bound
+    :param fit_val: the result of fit_with_fixed_raw, (m, 2, k)
+    :param num_boot: the maximal number of replicates
+    :param time_budget: the time limit in seconds; the batches that are not
+        started when it runs out are skipped; None for no limit
+    :param seed: the seed of the random number generator
+    :param batch_size: the number of replicates fitted at once
+    :return: a dictionary with 'err' (m, k), the standard deviation of the
+        replicates; 'ci' (m, 2, k), the 16th and 84th percentiles; 'num'
+        (m, ), the number of successful replicates for each column; the
+        failed columns and the ones with less than 2 replicates have -1 err
+    """
+    t0 = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    num, num_col = y.shape
+    x = np.asarray(x)
+    p = fit_val[:, 0, :]
+    model = base_func(x.reshape(-1, 1), *p.T)
+    residual = (y - model) / sigma
+    cols = np.arange(num_col)
+
+    samples = np.full((num_boot, num_col, p.shape[1]), np.nan)
+    count = 0
+    while count < num_boot:
+        if time_budget is not None and time.perf_counter() - t0 > time_budget:
+            break
+        size = min(batch_size, num_boot - count)
+        idx = rng.integers(0, num, size=(size, num, num_col))
+        # the replicates are stacked as the columns, (n, size * m)
+        y_boot = model + sigma * residual[idx, cols]
+        y_boot = np.moveaxis(y_boot, 0, 1).reshape(num, -1)
+        val, success = fit_batch_raw(base_func, x, y_boot,
+                                     np.tile(sigma, (1, size)), bounds,
+                                     fit_flag, np.tile(p, (size, 1)))
+        val[~success] = np.nan
+        samples[count: count + size] = val.reshape(size, num_col, -1)
+        count += size
+
+    samples = samples[:count]
+    num_valid = np.sum(np.isfinite(samples[:, :, 0]), axis=0)
+    ok = (num_valid >= 2) & (fit_val[:, 1, 0] >= 0)
+    err = np.full((num_col, p.shape[1]), -1.0)
+    ci = np.full((num_col, 2, p.shape[1]), np.nan)
+    if np.any(ok):
+        err[ok] = np.nanstd(samples[:, ok], axis=0, ddof=1)
+        ci[ok] = np.moveaxis(
+            np.nanpercentile(samples[:, ok], [16, 84], axis=0), 0, 1)
+    logger.info('bootstrap: %d replicates in %.2f s', count,
+                time.perf_counter() - t0)
+    return {'err': err, 'ci': ci, 'num': num_valid}
@@ -66,15 +66,15 @@ class TableDataModel(QtCore.QAbstractTableModel):
         else:
             self.input_list = input_list
         self.max_display = max_display
-        self.xlabels = ['id', 'size', 'progress', 'start', 'ETA (s)',
-                        'finish', 'fname']
+        self.xlabels = ['id', 'priority', 'size', 'progress', 'MB/s',
+                        'files/s', 'start', 'ETA (s)', 'finish', 'fname']
 
     # overwrite parent method
     def data(self, index, role):
         if role == QtCore.Qt.DisplayRole:
             x = self.input_list[index.row()]
-            ret = [x.jid, x.size, x._progress, x.stime, x.eta, x.etime,
-                   x.short_name]
+            ret = [x.jid, x.priority, x.size, x._progress, x.mb_rate,
+                   x.file_rate, x.stime, x.eta, x.etime, x.short_name]
             return ret[index.column()]
 
     # overwrite parent method
@@ -4,61 +4,42 @@ from PyQt5.QtCore import QObject, pyqtSlot
 import logging
 import uuid
 import time
+import traceback
 import numpy as np
-from ..fileIO.hdf_reader import put
-from ..xpcs_file import XpcsFile as XF
-from shutil import copyfile
 from ..helper.listmodel import ListDataModel
+from ..helper.average import (run_average, run_average_groups,
+                               finalize_average, get_average_stat,
+                               write_average, group_files, get_group_path,
+                               run_intt_outlier, intt_features)
 import pyqtgraph as pg
-from tqdm import trange
 
 
 logger = logging.getLogger(__name__)
 
 
-def average_plot_cluster(self, hdl1, num_clusters=2):
-    if self.meta['avg_file_list'] != tuple(self.target) or \
-            'avg_intt_minmax' not in self.meta:
-        logger.info('avg cache not exist')
-        labels = ['Int_t']
-        res = self.fetch(labels, file_list=self.target)
-        Int_t = res['Int_t'][:, 1, :].astype(np.float32)
-        Int_t = Int_t / np.max(Int_t)
-        intt_minmax = []
-        for n in range(len(self.target)):
-            intt_minmax.append([np.min(Int_t[n]), np.max(Int_t[n])])
-        intt_minmax = np.array(intt_minmax).T.astype(np.float32)
-
-        self.meta['avg_file_list'] = tuple(self.target)
-        self.meta['avg_intt_minmax'] = intt_minmax
-        self.meta['avg_intt_mask'] = np.ones(len(self.target))
-
-    else:
-        logger.info('using avg cache')
-        intt_minmax = self.meta['avg_intt_minmax']
-
-    y_pred = sk_kmeans(n_clusters=num_clusters).fit_predict(intt_minmax.T)
-    freq = np.bincount(y_pred)
-    self.meta['avg_intt_mask'] = y_pred == y_pred[freq.argmax()]
-    valid_num = np.sum(y_pred == y_pred[freq.argmax()])
-    title = '%d / %d' % (valid_num, y_pred.size)
-    hdl1.show_scatter(intt_minmax,
-                      color=y_pred,
-                      xlabel='Int-t min',
-                      ylabel='Int-t max',
-                      title=title)
+def init_telemetry():
+    # the counters of the screening and the accumulation pass; read and
+    # compute are the time summed over the workers, wall is the time
+    # between the start of the pass and its last finished shard
+    return {stage: {'files': 0, 'bytes': 0, 'read': 0.0, 'compute': 0.0,
+                    't_start': None, 't_last': None}
+            for stage in ('intt', 'screen', 'average')}
 
 
 class WorkerSignal(QObject):
     progress = QtCore.pyqtSignal(tuple)
     values = QtCore.pyqtSignal(tuple)
     status = QtCore.pyqtSignal(tuple)
+    result = QtCore.pyqtSignal(tuple)
 
 
 class AverageToolbox(QtCore.QRunnable):
 
-    def __init__(self, work_dir=None, flist=['hello'], jid=None) -> None:
+    def __init__(self, work_dir=None, flist=['hello'], jid=None,
+                 priority=0) -> None:
         super().__init__()
+        # the job can be started again after it's killed
+        self.setAutoDelete(False)
         self.file_list = flist.copy()
         self.model = ListDataModel(self.file_list)
 
@@ -69,11 +50,28 @@ class AverageToolbox(QtCore.QRunnable):
             self.jid = uuid.uuid4()
         else:
             self.jid = jid
+        # the jobs with higher priority are started first by the scheduler
+        self.priority = priority
         self.submit_time = time.strftime('%H:%M:%S')
         self.stime = self.submit_time
         self.etime = '--:--:--'
         self.status = 'wait'
-        self.baseline = np.zeros(max(len(self.model), 10), dtype=np.float32)
+        # the number of times the job failed, see AverageScheduler
+        self.failures = 0
+        # nan for the files not processed yet
+        self.baseline = np.full(len(self.model), np.nan, dtype=np.float32)
+        # the number of bytes read from each file
+        self.nbytes = np.zeros(len(self.model), dtype=np.int64)
+        # the files that pass the baseline check in the screening pass
+        self.accept = np.zeros(len(self.model), dtype=bool)
+        # the number of accepted files accumulated
+        self.num_done = 0
+        # the Int_t features and clusters of the outlier stage; the files
+        # rejected by it are not screened
+        self.intt_features = np.full((len(self.model), len(intt_features)),
+                                     np.nan)
+        self.intt_label = np.full(len(self.model), -1, dtype=np.int64)
+        self.intt_accept = np.ones(len(self.model), dtype=bool)
         self.ptr = 0
         self.short_name = self.generate_avg_fname()
         self.eta ='...' 
@@ -81,14 +79,141 @@ class AverageToolbox(QtCore.QRunnable):
         self._progress = '0%'
         # axis to show the baseline;
         self.ax = None
-        # use one file as templelate
-        self.origin_path = os.path.join(self.work_dir, self.model[0])
+        # axis to show the Int_t clusters
+        self.ax_intt = None
+        # the time when the job starts running
+        self.t_start = None
+        self.telemetry = init_telemetry()
+        # the rates shown in the job table, in MB/s and files/s
+        self.mb_rate = 0.0
+        self.file_rate = 0.0
+        # the signals are emitted at most once per ui_interval seconds
+        self.ui_interval = 0.2
+        self.t_emit = 0.0
+        self.pending = []
 
         self.is_killed = False
-    
+
     def kill(self):
         self.is_killed = True
 
+    def set_empty(self, msg):
+        # nothing to average; this is final, so the job is not retried
+        logger.info('average job %d: %s', self.jid, msg)
+        self.status = 'empty'
+        self._progress = 'empty'
+        self.etime = time.strftime('%H:%M:%S')
+
+    def reset(self):
+        # clear the progress before the job (re)starts
+        self.is_killed = False
+        self.baseline[:] = np.nan
+        self.nbytes[:] = 0
+        self.accept[:] = False
+        self.num_done = 0
+        self.intt_features[:] = np.nan
+        self.intt_label[:] = -1
+        self.intt_accept[:] = True
+        self.ptr = 0
+        self.eta = '...'
+        self._progress = '0%'
+        self.t_start = time.perf_counter()
+        self.telemetry = init_telemetry()
+        self.mb_rate = 0.0
+        self.file_rate = 0.0
+        self.t_emit = 0.0
+        self.pending = []
+
+    def get_run_time(self):
+        if self.t_start is None:
+            return 0.0
+        return time.perf_counter() - self.t_start
+
+    def get_read_rate(self):
+        # the read rate in MB/s since the job started; the files done
+        # before the job resumed are not counted
+        run_time = self.get_run_time()
+        if run_time <= 0:
+            return 0.0
+        nbytes = sum(x['bytes'] for x in self.telemetry.values())
+        return nbytes / 1e6 / run_time
+
+    def get_stage_rate(self, stage):
+        """
+        :param stage: ['intt' | 'screen' | 'average']
+        :return: a tuple of the rates of the pass in (MB/s, files/s)
+        """
+        val = self.telemetry[stage]
+        if val['t_start'] is None or val['t_last'] is None:
+            return 0.0, 0.0
+        wall = val['t_last'] - val['t_start']
+        if wall <= 0:
+            return 0.0, 0.0
+        return val['bytes'] / 1e6 / wall, val['files'] / wall
+
+    def update_telemetry(self, stage, idx, part):
+        # the files done before the job resumed are not timed
+        if part.get('resumed', False):
+            return
+        val = self.telemetry[stage]
+        val['files'] += idx.size
+        val['bytes'] += int(np.sum(part['nbytes']))
+        val['read'] += part['time']['read']
+        val['compute'] += part['time']['compute']
+        val['t_last'] = time.perf_counter()
+        if val['t_start'] is None:
+            val['t_start'] = val['t_last']
+
+    def emit_update(self, stage, force=False):
+        """
+        emit the baselines received since the last call and the progress,
+        at most once per ui_interval unless force is True, so a job with
+        many small shards doesn't flood the gui with signals;
+        """
+        now = time.perf_counter()
+        if not force and now - self.t_emit < self.ui_interval:
+            return
+        self.t_emit = now
+        self.mb_rate, self.file_rate = [round(x, 2) for x in
+                                        self.get_stage_rate(stage)]
+        if len(self.pending) > 0:
+            self.signals.values.emit((self.jid, np.concatenate(
+                self.pending)))
+            self.pending = []
+        self.signals.progress.emit((self.jid, self._progress))
+
+    def get_telemetry(self):
+        # the counters and rates of the passes, see init_telemetry
+        ret = {}
+        for stage, val in self.telemetry.items():
+            if val['files'] == 0:
+                continue
+            mb_rate, file_rate = self.get_stage_rate(stage)
+            busy = val['read'] + val['compute']
+            ret[stage] = {
+                'files': val['files'],
+                'read_MB': val['bytes'] / 1e6,
+                'wall_s': val['t_last'] - val['t_start'],
+                'MB/s': mb_rate,
+                'files/s': file_rate,
+                'read_s': val['read'],
+                'compute_s': val['compute'],
+                'read_fraction': val['read'] / busy if busy > 0 else 0.0,
+            }
+        return ret
+
+    def get_config(self):
+        # the parameters to create the job again, see AverageScheduler
+        return {
+            'jid': self.jid,
+            'work_dir': self.work_dir,
+            'flist': list(self.model[:]),
+            'priority': self.priority,
+            'status': self.status,
+            'failures': self.failures,
+            'kwargs': self.kwargs,
+        }
+
     def __str__(self) -> str:
         return str(self.jid)
 
@@ -106,117 +231,224 @@ class AverageToolbox(QtCore.QRunnable):
 
     @pyqtSlot()
     def run(self):
-        self.do_average(*self.args, **self.kwargs)
+        try:
+            self.do_average(*self.args, **self.kwargs)
+        except Exception:
+            logger.error('average job %d failed: %s', self.jid,
+                         traceback.format_exc())
+        if self.status == 'running':
+            self.status = 'failed'
+            self._progress = 'failed'
+            self.failures += 1
+        self.signals.status.emit((self.jid, self.status))
 
     def setup(self, *args, **kwargs):
         self.args = args
         self.kwargs = kwargs
 
-    def do_average(self, chunk_size=256, save_path=None, avg_window=3, 
+    def do_average(self, chunk_size=256, save_path=None, avg_window=3,
                    avg_qindex=0, avg_blmin=0.95, avg_blmax=1.05,
-                   fields=['saxs_2d']):
+                   fields=['saxs_2d'], num_workers=None, mem_budget=None,
+                   checkpoint_interval=60, incremental=False,
+                   group_by=None, retries=2, retry_delay=10,
+                   intt_clusters=None, weighting='uniform', abs_scale=True,
+                   slab_stat=True):
+        """
+        average the files in two passes; the screening pass reads only the
+        g2 baseline of each file, so the baseline plot is shown right away,
+        and the accumulation pass reads the fields of the accepted files in
+        shards of chunk_size with the worker processes;
+        :param num_workers: the number of worker processes; None to use all
+            the cores
+        :param mem_budget: the memory budget in MB of each worker to stream
+            G2, IP and IF slab by slab; None to read them at once
+        :param checkpoint_interval: the interval in seconds to save the
+            state of the job to save_path + '.ckpt'; a job with the same
+            files and parameters resumes from it. None to disable
+        :param incremental: if True and save_path is an average of some of
+            the files with the same parameters, only the other files are
+            read and added to it
+        :param save_path: the output file; default Avg + the first filename
+            in work_dir
+        :param group_by: a regular expression of the filename or a metadata
+            key to partition the files; the groups are averaged in one pass
+            and each is saved to save_path with its label before the
+            suffix; the incremental mode extends the output of each group.
+            None to average all the files together
+        :param retries: the number of times to read again the files that
+            failed, after retry_delay seconds
+        :param intt_clusters: the number of clusters of the Int_t outlier
+            stage; the files of each group are clustered by the features of
+            Int_t before the screening, and only the largest cluster is
+            averaged. None to skip the stage
+        :param weighting: ['uniform' | 'inverse_variance' | 'intensity'],
+            the weights of the files; see get_file_weights
+        :param abs_scale: if True, saxs_1d is also weighted by the absolute
+            cross section scale of each file
+        :param slab_stat: if False, the std_err and the state of G2, IP and
+            IF are not saved, and the output can't be extended
+        """
+        if save_path is None:
+            save_path = os.path.join(self.work_dir,
+                                     'Avg' + os.path.basename(self.model[0]))
         self.stime = time.strftime('%H:%M:%S')
         self.status = 'running'
         logger.info('average job %d starts', self.jid)
-        tot_num = len(self.model)
-        steps = (tot_num + chunk_size - 1) // chunk_size
-        mask = np.zeros(tot_num, dtype=np.int64)
-        prev_percentage = 0
-
-        def validate_g2_baseline(g2_data, q_idx):
-            if q_idx >= g2_data.shape[1]:
-                idx = 0 
-                logger.info('q_index is out of range; using 0 instead')
-            else:
-                idx = q_idx
-
-            g2_baseline = np.mean(g2_data[-avg_window:, idx])
-            if avg_blmax >= g2_baseline >= avg_blmin:
-                return True, g2_baseline
-            else:
-                return False, g2_baseline
-
-        result = {}
-        for key in fields:
-            result[key] = None 
-
-        t0 = time.perf_counter()
-        for n in range(steps):
-            beg = chunk_size * (n + 0)
-            end = chunk_size * (n + 1)
-            end = min(tot_num, end)
-            for m in range(beg, end):
-                # time.sleep(0.5)
-                if self.is_killed:
-                    logger.info('the averaging instance has been killed.')
-                    self._progress = 'killed'
-                    self.status = 'killed'
-                    return
-                    
-                curr_percentage = int((m + 1) * 100 / tot_num)
-                if curr_percentage >= prev_percentage:
-                    prev_percentage = curr_percentage
-                    dt = (time.perf_counter() - t0) / (m + 1)
-                    eta = dt * (tot_num - m - 1)
-                    self.eta = eta
-                    self._progress = "%d%%" % (curr_percentage)
-                    # self.signals.progress.emit((self.jid, curr_percentage))
-
-                fname = self.model[m]
-                try:
-                    xf = XF(fname, cwd=self.work_dir, fields=fields)
-                    flag, val = validate_g2_baseline(xf.g2, avg_qindex)
-                    self.baseline[self.ptr] = val
-                    self.ptr += 1
-                # except Exceptionn as ec:
-                except:
-                    flag, val = False, 0
-                    logger.error('file %s is damaged, skip', fname)
-
-                if flag:
-                    for key in fields:
-                        if key != 'saxs_1d':
-                            data = xf.at(key)
-                        else:
-                            data = xf.at('saxs_1d')['data_raw']
-                        if result[key] is None:
-                            result[key] = data
-                            mask[m] = 1
-                        elif result[key].shape == data.shape:
-                            result[key] += data
-                            mask[m] = 1
-                        else:
-                            logger.info(f'data shape does not match for key {key}, {fname}')
-
-                self.signals.values.emit((self.jid, val))
-        
-        if np.sum(mask) == 0:
-            logger.info('no dataset is valid; check the baseline criteria.')
-            return
+        if self.t_start is None:
+            self.t_start = time.perf_counter()
+        self.telemetry['intt']['t_start'] = time.perf_counter()
+        self.telemetry['screen']['t_start'] = time.perf_counter()
+        if group_by is None:
+            groups = {None: self.model[:]}
         else:
-            for key in fields:
-                if key == 'saxs_1d':
-                    # only keep the Iq component, put method doesn't accept dict
-                    result['saxs_1d'] = result['saxs_1d'] / np.sum(mask)
-                else:
-                    result[key] /= np.sum(mask)
-                if key == 'g2_err':
-                    result[key] /= np.sqrt(np.sum(mask))
+            groups = group_files(self.model[:], self.work_dir, group_by)
+            logger.info('%d groups: %s', len(groups), list(groups))
+            if len(groups) == 0:
+                self.set_empty('no file matches the groups')
+                return
+        # the index in the model of the files of the groups
+        pos = {fname: n for n, fname in enumerate(self.model[:])}
+        if intt_clusters is not None:
+            groups = self.reject_intt_outlier(groups, pos, intt_clusters,
+                                              num_workers, chunk_size)
+            if groups is None:
+                logger.info('the averaging instance has been killed.')
+                self._progress = 'killed'
+                self.status = 'killed'
+                return
+            if len(groups) == 0:
+                self.set_empty('all files are rejected by the Int_t stage')
+                return
+        order = np.array([pos[x] for flist in groups.values()
+                          for x in flist], dtype=np.int64)
+        tot_num = order.size
+        checkpoint = None
+        if checkpoint_interval is not None:
+            checkpoint = save_path + '.ckpt'
+        base = None
+        if incremental and group_by is None:
+            base = save_path
+        elif incremental:
+            base = {x: get_group_path(save_path, x) for x in groups}
+
+        def update_screen(idx, part):
+            self.update_telemetry('screen', idx, part)
+            idx = order[idx]
+            self.baseline[idx] = part['baseline']
+            self.accept[idx] = part['accept']
+            self.nbytes[idx] += part['nbytes']
+            self.ptr = min(tot_num, self.ptr + idx.size)
+            self._progress = 'screen %d%%' % (self.ptr * 100 // tot_num)
+            self.pending.append(part['baseline'])
+            if self.ptr == tot_num and \
+                    self.telemetry['average']['t_start'] is None:
+                # the eta only counts the accumulation pass
+                self.telemetry['average']['t_start'] = time.perf_counter()
+            self.emit_update('screen', force=self.ptr == tot_num)
+
+        def update_progress(idx, part):
+            self.update_telemetry('average', idx, part)
+            self.nbytes[order[idx]] += part['nbytes']
+            # the failed files are counted again when they are retried
+            self.num_done = min(np.sum(self.accept), self.num_done + idx.size)
+            num_accept = max(1, np.sum(self.accept))
+            file_rate = self.get_stage_rate('average')[1]
+            if file_rate > 0:
+                self.eta = round((num_accept - self.num_done) / file_rate, 1)
+            self._progress = '%d%%' % (self.num_done * 100 // num_accept)
+            self.emit_update('average')
+
+        kwargs = dict(work_dir=self.work_dir, num_workers=num_workers,
+                      shard_size=chunk_size, screen_callback=update_screen,
+                      callback=update_progress,
+                      is_killed=lambda: self.is_killed, fields=fields,
+                      avg_window=avg_window, avg_qindex=avg_qindex,
+                      avg_blmin=avg_blmin, avg_blmax=avg_blmax,
+                      mem_budget=mem_budget, retries=retries,
+                      retry_delay=retry_delay, weighting=weighting,
+                      abs_scale=abs_scale, checkpoint=checkpoint,
+                      checkpoint_interval=checkpoint_interval, base=base)
+        if group_by is None:
+            total = run_average(groups[None], **kwargs)
+            totals = None if total is None else {None: total}
+        else:
+            totals = run_average_groups(groups, **kwargs)
+        if totals is None:
+            logger.info('the averaging instance has been killed.')
+            self._progress = 'killed'
+            self.status = 'killed'
+            return
 
-            logger.info('the valid dataset number is %d / %d' % (
-                np.sum(mask), tot_num))
-        
-        logger.info('create file: {}'.format(save_path))
-        copyfile(self.origin_path, save_path)
-        put(save_path, result, mode='alias')
+        self.nbytes[order] = np.concatenate([x['nbytes'] for x in
+                                             totals.values()])
+        results = {}
+        for label, total in totals.items():
+            result = finalize_average(total)
+            if result is None:
+                continue
+            path = save_path
+            if label is not None:
+                path = get_group_path(save_path, label)
+            # the metadata are copied from the first averaged file
+            idx = np.nonzero(total['mask'])[0][0]
+            template = os.path.join(self.work_dir, total['flist'][idx])
+            write_average(path, template, result,
+                          get_average_stat(total, slab_stat), total,
+                          slab_stat=slab_stat)
+            results[label] = result
+        if len(results) == 0:
+            self.set_empty('no dataset is valid')
+            return
 
         self.status = 'finished'
-        self.signals.status.emit((self.jid, self.status))
         self.etime = time.strftime('%H:%M:%S')
+        self.eta = 0
         self.model.layoutChanged.emit()
+        self.emit_update('average', force=True)
         self.signals.progress.emit((self.jid, 100))
         logger.info('average job %d finished', self.jid)
-        return result
+        for stage, val in self.get_telemetry().items():
+            logger.info('%s: %d files, %.1f MB/s, %.1f files/s, %.0f%% of '
+                        'the worker time in reading', stage, val['files'],
+                        val['MB/s'], val['files/s'],
+                        val['read_fraction'] * 100)
+        if group_by is None:
+            return results[None]
+        return results
+
+    def reject_intt_outlier(self, groups, pos, num_clusters, num_workers,
+                            chunk_size):
+        """
+        run the Int_t outlier stage on the files of the groups;
+        :param pos: the index in the model of each file
+        :return: the groups with only the accepted files; None if killed
+        """
+        order = np.array([pos[x] for flist in groups.values()
+                          for x in flist], dtype=np.int64)
+
+        def update_intt(idx, part):
+            self.update_telemetry('intt', idx, part)
+            self.intt_features[order[idx]] = part['features']
+            self._progress = 'Int_t %d%%' % \
+                (self.telemetry['intt']['files'] * 100 // order.size)
+            self.emit_update('intt')
+
+        ret = run_intt_outlier(groups, self.work_dir, num_workers,
+                               chunk_size, num_clusters, update_intt,
+                               lambda: self.is_killed)
+        if ret is None:
+            return None
+        self.intt_label[order] = ret['label']
+        self.intt_accept[order] = ret['accept']
+        self.telemetry['screen']['t_start'] = time.perf_counter()
+        self.emit_update('intt', force=True)
+        logger.info('Int_t outlier stage rejected %d files',
+                    np.sum(~ret['accept']))
+        # the groups with all the files rejected are dropped
+        groups = {name: [x for x in flist if self.intt_accept[pos[x]]]
+                  for name, flist in groups.items()}
+        return {name: flist for name, flist in groups.items()
+                if len(flist) > 0}
 
     def initialize_plot(self, hdl):
         hdl.clear()
@@ -235,12 +467,37 @@ class AverageToolbox(QtCore.QRunnable):
             t.addItem(up)
         t.setMouseEnabled(x=False, y=False)
 
+        self.ax_intt = None
+        if self.kwargs.get('intt_clusters') is not None:
+            t = hdl.addPlot()
+            t.setLabel('bottom', 'log Int-t mean')
+            t.setLabel('left', 'Int-t relative std')
+            self.ax_intt = pg.ScatterPlotItem(size=8)
+            t.addItem(self.ax_intt)
         return
 
     def update_plot(self):
         if self.ax is not None:
-            self.ax.setData(self.baseline[:self.ptr])
-            return
+            # the shards finish out of order
+            idx = np.nonzero(np.isfinite(self.baseline))[0]
+            self.ax.setData(idx, self.baseline[idx])
+        if self.ax_intt is not None:
+            idx = np.nonzero(np.all(np.isfinite(self.intt_features),
+                                    axis=1))[0]
+            # the accepted files are green; one color for each cluster of
+            # the outliers, gray before the clustering
+            num = max(2, np.max(self.intt_label) + 1)
+            brush = []
+            for n in idx:
+                if self.intt_label[n] < 0:
+                    brush.append(pg.mkBrush('gray'))
+                elif self.intt_accept[n]:
+                    brush.append(pg.mkBrush('g'))
+                else:
+                    brush.append(pg.intColor(self.intt_label[n], hues=num))
+            self.ax_intt.setData(self.intt_features[idx, 0],
+                                 self.intt_features[idx, 1], brush=brush)
+        return
 
     def get_pg_tree(self):
         data = {}
@@ -256,10 +513,21 @@ class AverageToolbox(QtCore.QRunnable):
 
         # additional keys to describe the worker
         add_keys = ['submit_time', 'etime', 'status', 'baseline', 'ptr',
-                    'eta', 'size']
+                    'num_done', 'eta', 'size']
 
         for key in add_keys:
             data[key] = self.__dict__[key]
+        if self.kwargs.get('intt_clusters') is not None:
+            data['intt_rejected'] = int(np.sum(~self.intt_accept))
+        if self.ptr == np.sum(self.intt_accept):
+            data['accepted'] = int(np.sum(self.accept))
+        if self.ptr > 0:
+            data['read_MB'] = float(np.sum(self.nbytes)) / 1e6
+            data['read_MB_per_file'] = float(np.sum(self.nbytes)) / 1e6 / \
+                self.ptr
+        telemetry = self.get_telemetry()
+        if len(telemetry) > 0:
+            data['telemetry'] = telemetry
 
         if self.size > 20:
             data['first_10_datasets'] = self.model[0:10]
@@ -271,88 +539,3 @@ class AverageToolbox(QtCore.QRunnable):
         tree.setWindowTitle('Job_%d_%s' % (self.jid, self.model[0]))
         tree.resize(600, 800)
         return tree
-
-
-def do_average(flist, work_dir=None, save_path=None, avg_window=3, 
-               avg_qindex=0, avg_blmin=0.95, avg_blmax=1.05,
-               fields=['saxs_2d', 'saxs_1d', 'g2', 'g2_err']):
-
-    if work_dir is None:
-        work_dir = './' 
-
-    tot_num = len(flist)
-    abs_cs_scale_tot = 0.0
-    baseline = np.zeros(tot_num, dtype=np.float32)
-    mask = np.zeros(tot_num, dtype=np.int64)
-
-    def validate_g2_baseline(g2_data, q_idx):
-        if q_idx >= g2_data.shape[1]:
-            idx = 0 
-            logger.info('q_index is out of range; using 0 instead')
-        else:
-            idx = q_idx
-
-        g2_baseline = np.mean(g2_data[-avg_window:, idx])
-        if avg_blmax >= g2_baseline >= avg_blmin:
-            return True, g2_baseline
-        else:
-            return False, g2_baseline
-
-    result = {}
-    for key in fields:
-        result[key] = None 
-
-    for m in trange(tot_num):
-        fname = flist[m]
-        try:
-            xf = XF(fname, cwd=work_dir, fields=fields)
-            flag, val = validate_g2_baseline(xf.g2, avg_qindex)
-            baseline[m] = val
-        except Exception as ec:
-            flag, val = False, 0
-            logger.error('file %s is damaged, skip', fname)
-
-        if flag:
-            for key in fields:
-                if key != 'saxs_1d':
-                    data = xf.at(key)
-                else:
-                    data = xf.at('saxs_1d')['data_raw']
-                    scale = xf.abs_cross_section_scale
-                    if scale is None:
-                        scale = 1.0
-                    data *= scale
-                    abs_cs_scale_tot += scale
-
-                if result[key] is None:
-                    result[key] = data
-                    mask[m] = 1
-                elif result[key].shape == data.shape:
-                    result[key] += data
-                    mask[m] = 1
-                else:
-                    logger.info(f'data shape does not match for key {key}, {fname}')
-    
-    if np.sum(mask) == 0:
-        logger.info('no dataset is valid; check the baseline criteria.')
-        return
-    else:
-        for key in fields:
-            if key == 'saxs_1d':
-                result['saxs_1d'] /= abs_cs_scale_tot
-            else:
-                result[key] /= np.sum(mask)
-            if key == 'g2_err':
-                result[key] /= np.sqrt(np.sum(mask))
-
-        logger.info('the valid dataset number is %d / %d' % (
-            np.sum(mask), tot_num))
-
-    original_file = os.path.join(work_dir, flist[0])
-    if save_path is None:
-        save_path = 'AVG' + os.path.basename(flist[0])
-    logger.info('create file: {}'.format(save_path))
-    copyfile(original_file, save_path)
-    put(save_path, result, mode='alias')
-
-    return baseline 
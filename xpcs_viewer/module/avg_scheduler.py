@@ -0,0 +1,205 @@
+from PyQt5 import QtCore
+import os
+import json
+import logging
+import traceback
+
+
+logger = logging.getLogger(__name__)
+
+# the unfinished average jobs are saved here and loaded at the start
+queue_fname = os.path.join(os.path.expanduser('~'), '.xpcs_viewer',
+                           'avg_queue.json')
+
+
+class AverageScheduler(QtCore.QObject):
+    """
+    run the average jobs in the job table; the waiting jobs are started
+    automatically by priority, then by submission, as long as the number
+    of running jobs is below max_jobs and the total read rate of the running
+    jobs is below io_limit. The waiting, running and failed jobs are saved
+    to queue_fname so they can be restored after a restart; the finished,
+    killed and empty jobs, with nothing to average, are not;
+    """
+
+    def __init__(self, jobs, on_start=None, max_jobs=4, io_limit=None,
+                 auto_start=True, warmup=5.0, fname=queue_fname,
+                 max_failures=3, active=True) -> None:
+        """
+        :param jobs: the TableDataModel of the AverageToolbox jobs
+        :param on_start: called with the job before it starts, to connect
+            its signals
+        :param max_jobs: the maximal number of running jobs
+        :param io_limit: the limit of the total read rate in MB/s; None
+            for no limit
+        :param auto_start: if True, start the waiting jobs automatically
+        :param warmup: with io_limit, no job is started while a running job
+            is younger than warmup seconds, since its rate is not known yet
+        :param fname: the json file to save the queue; None to disable
+        :param max_failures: a failed job is restored as a waiting job until
+            it has failed max_failures times, then it's dropped from the
+            queue
+        :param active: if False, no job is started until activate is
+            called, so the limits can be set first
+        """
+        super().__init__()
+        self.jobs = jobs
+        self.active = active
+        self.max_failures = max_failures
+        self.on_start = on_start
+        self.io_limit = io_limit
+        self.auto_start = auto_start
+        self.warmup = warmup
+        self.fname = fname
+        self.thread_pool = QtCore.QThreadPool()
+        self.set_max_jobs(max_jobs)
+        # check the limits when the running jobs change their rates
+        self.timer = QtCore.QTimer()
+        self.timer.setInterval(1000)
+        self.timer.timeout.connect(self.schedule)
+        self.timer.start()
+
+    def set_max_jobs(self, max_jobs):
+        self.max_jobs = max_jobs
+        # some room for the jobs started by hand over the limit
+        self.thread_pool.setMaxThreadCount(max(max_jobs, 1) + 4)
+        self.schedule()
+
+    def set_io_limit(self, io_limit):
+        self.io_limit = io_limit
+        self.schedule()
+
+    def set_auto_start(self, auto_start):
+        self.auto_start = auto_start
+        self.schedule()
+
+    def activate(self):
+        # start scheduling the jobs, with the limits set
+        self.active = True
+        self.schedule()
+
+    def get_running(self):
+        return [x for x in self.jobs if x.status == 'running']
+
+    def get_io_rate(self):
+        # the total read rate of the running jobs in MB/s
+        return sum(x.get_read_rate() for x in self.get_running())
+
+    def can_start(self):
+        running = self.get_running()
+        if len(running) >= self.max_jobs:
+            return False
+        if self.io_limit is None:
+            return True
+        if any(x.get_run_time() < self.warmup for x in running):
+            return False
+        return self.get_io_rate() < self.io_limit
+
+    def schedule(self):
+        """
+        start the waiting jobs that fit in the limits
+        """
+        if not self.active or not self.auto_start:
+            return
+        waiting = [x for x in self.jobs if x.status == 'wait']
+        waiting.sort(key=lambda x: (-x.priority, x.jid))
+        for job in waiting:
+            if not self.can_start():
+                break
+            self.start(job)
+
+    def start(self, job):
+        """
+        start a job now, regardless of the limits
+        """
+        if job.status in ['running', 'finished', 'empty']:
+            return False
+        job.reset()
+        job.status = 'running'
+        if self.on_start is not None:
+            self.on_start(job)
+        self.thread_pool.start(job)
+        logger.info('start average job %d, priority %d', job.jid,
+                    job.priority)
+        self.save_queue()
+        return True
+
+    def submit(self, job):
+        job.signals.status.connect(self.update_status)
+        self.jobs.append(job)
+        self.save_queue()
+        self.schedule()
+
+    def remove(self, index):
+        if not 0 <= index < len(self.jobs):
+            return
+        job = self.jobs[index]
+        if job.status == 'running':
+            logger.info('average job %d is running; kill it first', job.jid)
+            return
+        self.jobs.pop(index)
+        self.save_queue()
+
+    def kill(self, job):
+        if job.status == 'wait':
+            job.status = 'killed'
+            job._progress = 'killed'
+            self.save_queue()
+        job.kill()
+
+    def update_status(self, data):
+        self.jobs.layoutChanged.emit()
+        self.save_queue()
+        self.schedule()
+
+    def save_queue(self):
+        if self.fname is None:
+            return
+        queue = [x.get_config() for x in self.jobs
+                 if x.status in ['wait', 'running'] or
+                 (x.status == 'failed' and x.failures < self.max_failures)]
+        try:
+            os.makedirs(os.path.dirname(self.fname), exist_ok=True)
+            with open(self.fname, 'w') as f:
+                json.dump(queue, f, indent=4)
+        except Exception:
+            logger.error('failed to save the average queue: %s',
+                         traceback.format_exc())
+
+    def load_queue(self, create_job):
+        """
+        restore the jobs saved by save_queue; the running and failed jobs
+        become waiting jobs and resume from their checkpoints. The jobs are
+        started by schedule
+        :param create_job: called with the saved config to create a job
+        :return: the list of the restored jobs
+        """
+        if self.fname is None or not os.path.isfile(self.fname):
+            return []
+        try:
+            with open(self.fname) as f:
+                queue = json.load(f)
+        except Exception:
+            logger.error('failed to load the average queue: %s',
+                         traceback.format_exc())
+            return []
+
+        restored = []
+        for config in queue:
+            # killed by the user, or failed too many times
+            if config.get('status') == 'killed' or \
+                    config.get('failures', 0) >= self.max_failures:
+                continue
+            try:
+                job = create_job(config)
+            except Exception:
+                logger.error('failed to restore average job: %s',
+                             traceback.format_exc())
+                continue
+            job.failures = config.get('failures', 0)
+            job.signals.status.connect(self.update_status)
+            self.jobs.append(job)
+            restored.append(job)
+        logger.info('restored %d average jobs from %s', len(restored),
+                    self.fname)
+        return restored
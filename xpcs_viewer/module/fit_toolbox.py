@@ -0,0 +1,155 @@
+from PyQt5 import QtCore
+from PyQt5.QtCore import pyqtSlot
+import logging
+import time
+import traceback
+import numpy as np
+from .average_toolbox import WorkerSignal
+from ..helper.fitting import fit_tauq_batch, quick_look_g2
+
+
+logger = logging.getLogger(__name__)
+
+
+def fit_tauq(xf_list, q_range, bounds, fit_flag, chi2_max=None):
+    """
+    fit tau(q) of all files with a g2 fitting in one batch;
+    :param xf_list: list of xpcs_file objects
+    :param q_range: the q range for the power law fitting
+    :param bounds: [[a_min, b_min], [a_max, b_max]]
+    :param fit_flag: 2 bools for [a, b]
+    :param chi2_max: the g2 fittings with larger reduced chi-square are
+        excluded; None or 0 to keep all successful fittings
+    :return: list of the new fit_summary of each file; None for the files
+        without a g2 fitting. The files are not modified
+    """
+    ret = [None] * len(xf_list)
+    fit_list, data_list = [], []
+    for n, x in enumerate(xf_list):
+        data = x.get_tauq_data(q_range, chi2_max)
+        if data is None:
+            logger.info('g2 fitting is not available for %s', x.fname)
+        elif data[0].size == 0:
+            ret[n] = dict(x.fit_summary, tauq_success=False)
+        else:
+            fit_list.append(n)
+            data_list.append(data)
+
+    # the power laws of all files are fitted in one batch
+    if len(fit_list) > 0:
+        q_list, tau_list, err_list = zip(*data_list)
+        fit_line, fit_val = fit_tauq_batch(q_list, tau_list, err_list,
+                                           bounds, fit_flag)
+        for n, idx in enumerate(fit_list):
+            ret[idx] = xf_list[idx].get_tauq_summary(
+                data_list[n], fit_line[n], fit_val[n], fit_flag)
+    return ret
+
+
+def quick_look(xf_list, q_range=None, t_range=None):
+    """
+    compute the quick look estimate of g2 for the files that don't have one
+    for the given ranges yet; the files with the same delays and shape are
+    stacked and computed in one vectorized call;
+    :param xf_list: list of xpcs_file objects
+    :param q_range: a tuple of q lower bound and upper bound
+    :param t_range: a tuple of t lower bound and upper bound
+    :return: None; the result is kept in xf.quick_look
+    """
+    key = str((q_range, t_range))
+    groups = {}
+    for x in xf_list:
+        if x.quick_look is not None and x.quick_look['key'] == key:
+            continue
+        t_el, q, g2, _ = x.get_g2_data(q_range, t_range)
+        group = groups.setdefault((t_el.tobytes(), g2.shape), [])
+        group.append((x, t_el, q, g2))
+
+    for group in groups.values():
+        t_el = group[0][1]
+        result = quick_look_g2(t_el, np.stack([item[3] for item in group]))
+        for n, (x, _, q, _) in enumerate(group):
+            x.quick_look = {k: v[n] for k, v in result.items()}
+            x.quick_look.update({'key': key, 'q_val': q, 't_el': t_el})
+
+
+def get_job_key(mode, xf_list, kwargs):
+    # numpy arrays are converted so the parameters can be compared as str
+    args = {k: v.tolist() if isinstance(v, np.ndarray) else v
+            for k, v in kwargs.items()}
+    return (mode, tuple(id(x) for x in xf_list), str(sorted(args.items())))
+
+
+class FitToolbox(QtCore.QRunnable):
+    """
+    fit g2 or tau(q) of a list of files in the thread pool so the gui stays
+    responsive; the index and the new fit_summary of a file are emitted with
+    the result signal as soon as its fitting is done. The files are not
+    modified in the thread; the gui assigns the summary and sets done, so
+    the plot can be updated incrementally;
+    """
+
+    def __init__(self, xf_list, mode='g2', jid=0, **kwargs) -> None:
+        super().__init__()
+        # the job is dropped by the viewer when it is killed
+        self.setAutoDelete(False)
+        self.xf_list = xf_list
+        self.mode = mode
+        self.jid = jid
+        self.kwargs = kwargs
+        self.key = get_job_key(mode, xf_list, kwargs)
+        self.signals = WorkerSignal()
+        self.size = len(xf_list)
+        self.done = [False] * self.size
+        self.status = 'wait'
+        self.is_killed = False
+
+    def kill(self):
+        self.is_killed = True
+
+    def is_running(self):
+        return self.status in ['wait', 'running']
+
+    @pyqtSlot()
+    def run(self):
+        self.status = 'running'
+        t0 = time.perf_counter()
+        if self.mode == 'g2':
+            self.fit_each(lambda xf: xf.fit_g2(update=False, **self.kwargs))
+        elif self.kwargs.get('fit_mode', 'per-q') == 'global':
+            kwargs = self.kwargs.copy()
+            kwargs.pop('fit_mode')
+            self.fit_each(lambda xf: xf.fit_g2_global(update=False,
+                                                      **kwargs))
+        else:
+            kwargs = self.kwargs.copy()
+            kwargs.pop('fit_mode', None)
+            # the batch fitting is fast; all files finish at once
+            for n, summary in enumerate(fit_tauq(self.xf_list, **kwargs)):
+                self.signals.result.emit((self.jid, n, summary))
+            self.signals.progress.emit((self.jid, 100))
+
+        if self.status == 'running':
+            self.status = 'finished'
+            logger.info('%s fitting job %d finished in %.3f s', self.mode,
+                        self.jid, time.perf_counter() - t0)
+        self.signals.status.emit((self.jid, self.status))
+
+    def fit_each(self, func):
+        for n, xf in enumerate(self.xf_list):
+            # the job is killed when the fitting parameters change; the
+            # fitting of the current file can't be interrupted
+            if self.is_killed:
+                logger.info('%s fitting job %d is killed', self.mode,
+                            self.jid)
+                self.status = 'killed'
+                return
+            try:
+                summary = func(xf)
+            except Exception:
+                logger.error('failed to fit %s: %s', xf.fname,
+                             traceback.format_exc())
+            else:
+                self.signals.result.emit((self.jid, n, summary))
+            self.signals.progress.emit((self.jid,
+                                        int((n + 1) * 100 / self.size)))
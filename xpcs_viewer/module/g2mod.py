@@ -3,6 +3,8 @@ from matplotlib.ticker import FormatStrFormatter
 import pyqtgraph as pg
 import logging
 import matplotlib.pyplot as plt
+from pyqtgraph.Qt import QtCore
+from ..helper.fitting import single_exp_all
 
 
 pg.setConfigOption("foreground", pg.mkColor(80, 80, 80))
@@ -163,7 +165,15 @@ def pg_plot(hdl, xf_list, q_range, t_range, y_range,
             y_auto=False, num_col=4, rows=None,
             offset=0, show_fit=False, show_label=False, bounds=None,
             fit_flag=None, plot_type='multiple', subtract_baseline=True,
-            marker_size=5, label_size=4, fit_func='single'):
+            marker_size=5, label_size=4, fit_func='single', fit_ready=None,
+            show_quick_look=False):
+    """
+    plot g2 with pyqtgraph; if fit_ready is given, the fitting is done by a
+    background job and only the files flagged as ready show the fitting;
+    otherwise the files are fitted here when show_fit is True; the quick
+    look estimate, xf.quick_look, is shown as dashed lines if
+    show_quick_look is True;
+    """
     flag, tel, qd, g2, g2_err = get_data(xf_list, q_range=q_range,
                                          t_range=t_range)
 
@@ -197,13 +207,18 @@ def pg_plot(hdl, xf_list, q_range, t_range, y_range,
     for m in range(num_data):
         # default base line to be 1.0; used for non-fitting or fit error cases
         baseline_offset = np.ones(num_qval)
-        if show_fit:
+        fit_summary = None
+        if show_fit and fit_ready is not None:
+            if fit_ready[m]:
+                fit_summary = xf_list[m].fit_summary
+        elif show_fit:
             fit_summary = xf_list[m].fit_g2(q_range, t_range, bounds, fit_flag,
                                             fit_func)
-            if fit_summary is not None and subtract_baseline:
-                # make sure the fitting is successful
-                if fit_summary['fit_line'][n].get('success', False):
-                    baseline_offset = fit_summary['fit_val'][:, 0, 3]
+        if fit_summary is not None and subtract_baseline:
+            # only use the baseline of the successful fittings
+            fit_res = fit_summary['fit_res']
+            baseline_offset = np.where(fit_res['success'],
+                                       fit_res['val'][:, 3], 1.0)
 
         for n in range(num_qval):
             color = colors[rows[m] % len(colors)]
@@ -244,12 +259,22 @@ def pg_plot(hdl, xf_list, q_range, t_range, y_range,
                 ax.setRange(yRange=y_range)
 
             if show_fit and fit_summary is not None:
-                if fit_summary['fit_line'][n].get('success', False):
-                    y_fit = fit_summary['fit_line'][n]['fit_y'] + m * offset
+                if fit_summary['fit_res']['success'][n]:
+                    y_fit = fit_summary['fit_y'][n] + m * offset
                     # normalize baseline
                     y_fit = y_fit - baseline_offset[n] + 1.0
-                    ax.plot(fit_summary['fit_line'][n]['fit_x'], y_fit,
+                    ax.plot(fit_summary['fit_x'], y_fit,
                             pen=pg.mkPen(color, width=2.5))
+
+            ql = xf_list[m].quick_look
+            if show_quick_look and ql is not None:
+                ql_x = np.logspace(np.log10(np.min(x)), np.log10(np.max(x)),
+                                   64)
+                ql_y = single_exp_all(ql_x, ql['contrast'][n], ql['tau'][n],
+                                      ql['stretch'][n], ql['baseline'][n])
+                ql_y = ql_y - baseline_offset[n] + 1.0 + m * offset
+                ax.plot(ql_x, ql_y, pen=pg.mkPen(color, width=1.5,
+                                                 style=QtCore.Qt.DashLine))
     return
 
 
@@ -5,23 +5,43 @@ colors = ('b', 'r', 'g', 'c', 'm', 'y', 'k')
 shapes = ('o', 'v', '^', '<', '>', '8', 's', 'p', 'P', '*')
 
 
-def plot(xf_list, hdl, q_range, offset, plot_type=3):
+def plot_quick_look(ax, xf, color, scale=1.0, key='tau'):
+    # the quick look estimate is shown as a dashed line with crosses; the
+    # invalid ones are skipped
+    ql = xf.quick_look
+    if ql is None:
+        return
+    valid = ql['valid']
+    ax.plot(ql['q_val'][valid], ql[key][valid] / scale, '--x', color=color,
+            markersize=4, linewidth=1)
+
+
+def plot(xf_list, hdl, q_range, offset, plot_type=3, chi2_max=None,
+         fit_mask=None, show_quick_look=False):
 
     hdl.clear()
     ax = hdl.subplots(1, 1)
 
     for n, xf in enumerate(xf_list):
         s = 10 ** (offset * n)
+        color = colors[n % len(colors)]
+        if show_quick_look:
+            plot_quick_look(ax, xf, color, s)
+
+        # only show the files whose fitting is ready
+        if xf.fit_summary is None or (fit_mask is not None and
+                                      not fit_mask[n]):
+            continue
+
         x = xf.fit_summary['q_val']
-        y = xf.fit_summary['fit_val'][:, 0, 1]
-        e = xf.fit_summary['fit_val'][:, 1, 1]
-        # remove failed fittings;
-        valid_idx = e > 0
+        y = xf.fit_summary['fit_res']['val'][:, 1]
+        e = xf.fit_summary['fit_res']['err'][:, 1]
+        # remove failed fittings and the ones with large chi-square;
+        valid_idx = xf.get_g2_fit_mask(chi2_max)
         x = x[valid_idx]
         y = y[valid_idx]
         e = e[valid_idx]
 
-        color = colors[n % len(colors)]
         shape = shapes[n % len(shapes)]
         line = ax.errorbar(x, y/s,  yerr=e/s, fmt=shape, markersize=3,
                            label=xf.label, color=color, mfc='white')
@@ -46,7 +66,7 @@ def plot(xf_list, hdl, q_range, offset, plot_type=3):
     return
 
 
-def plot_pre(xf_list, hdl):
+def plot_pre(xf_list, hdl, show_quick_look=False):
 
     hdl.clear()
     ax = hdl.subplots(2, 2, sharex=True).flatten()
@@ -57,10 +77,13 @@ def plot_pre(xf_list, hdl):
         shape = shapes[idx % len(shapes)]
         for n in range(4):
             x = xf.fit_summary['q_val']
-            y = xf.fit_summary['fit_val'][:, 0, n]
-            e = xf.fit_summary['fit_val'][:, 1, n]
+            y = xf.fit_summary['fit_res']['val'][:, n]
+            e = xf.fit_summary['fit_res']['err'][:, n]
             ax[n].errorbar(x, y,  yerr=e, fmt=shape, markersize=3,
                            color=color, mfc='white')
+            if show_quick_look:
+                key = ['contrast', 'tau', 'stretch', 'baseline'][n]
+                plot_quick_look(ax[n], xf, color, key=key)
 
         if idx == len(xf_list) - 1:
             bounds = xf.fit_summary['bounds']
@@ -61,8 +61,18 @@ class XpcsViewer(QtWidgets.QMainWindow, Ui):
         # finite states
         self.data_state = 0
         self.plot_state = np.zeros(len(self.tab_dict), dtype=np.int64)
-        self.thread_pool = QtCore.QThreadPool()
-        logger.info('Maximal threads: %d', self.thread_pool.maxThreadCount())
+        # the fitting jobs run one at a time; a killed job finishes the file
+        # it is fitting before the next job starts
+        self.fit_thread_pool = QtCore.QThreadPool()
+        self.fit_thread_pool.setMaxThreadCount(1)
+        self.fit_plot_kwargs = {}
+        self.fit_timer = {}
+        for mode in ['g2', 'tauq']:
+            self.fit_timer[mode] = QtCore.QTimer()
+            self.fit_timer[mode].setSingleShot(True)
+            self.fit_timer[mode].setInterval(200)
+            self.fit_timer[mode].timeout.connect(
+                lambda m=mode: self.redraw_fit_plot(m))
 
         self.vk = None
         # list widget models
@@ -104,6 +114,9 @@ class XpcsViewer(QtWidgets.QMainWindow, Ui):
         self.btn_set_average_save_name.clicked.connect(
             self.set_average_save_name)
         self.btn_avg_kill.clicked.connect(self.avg_kill_job)
+        self.max_thread_count.valueChanged.connect(self.update_avg_scheduler)
+        self.sb_avg_io_limit.valueChanged.connect(self.update_avg_scheduler)
+        self.cb_avg_auto_start.stateChanged.connect(self.update_avg_scheduler)
         self.btn_avg_jobinfo.clicked.connect(self.show_avg_jobinfo)
         # self.avg_job_table.selectionModel().selectionChanged.connect(
         #     self.update_avg_info)
@@ -111,6 +124,8 @@ class XpcsViewer(QtWidgets.QMainWindow, Ui):
         self.show_g2_fit_summary.clicked.connect(self.show_g2_fit_summary_func)
         self.hdf_key_filter.textChanged.connect(self.show_hdf_info)
         self.btn_g2_refit.clicked.connect(self.plot_g2)
+        self.g2_show_quick_look.stateChanged.connect(self.plot_g2)
+        self.tauq_show_quick_look.stateChanged.connect(self.plot_tauq)
         self.saxs2d_autorange.stateChanged.connect(self.update_saxs2d_range)
         self.load_default_setting()
         self.btn_deselect.clicked.connect(self.clear_target_selection)
@@ -121,6 +136,7 @@ class XpcsViewer(QtWidgets.QMainWindow, Ui):
         self.g2_fitting_function.currentIndexChanged.connect(
             self.update_g2_fitting_function
         )
+        self.cb_g2_save_fit.currentIndexChanged.connect(self.confirm_save_fit)
         # self.btn_g2_export.clicked.connect(self.export_g2)
         # disable browse function; it freezes on linux workstation;
         # self.pushButton.setEnabled(False)
@@ -494,7 +510,10 @@ class XpcsViewer(QtWidgets.QMainWindow, Ui):
         if not self.check_status() or self.vk.type != 'Multitau':
             return
 
-        self.vk.plot_tauq_pre(hdl=self.mp_tauq_pre.hdl)
+        p = self.check_g2_number()
+        self.vk.plot_tauq_pre(
+            hdl=self.mp_tauq_pre.hdl, t_range=(p[2], p[3]),
+            show_quick_look=self.tauq_show_quick_look.isChecked())
 
     def plot_tauq(self):
         if not self.check_status() or self.vk.type != 'Multitau':
@@ -517,22 +536,113 @@ class XpcsViewer(QtWidgets.QMainWindow, Ui):
         tauq = [self.tauq_qmin, self.tauq_qmax]
         q_range = [float(x.text()) for x in tauq]
 
-        kwargs = {
-            'bounds': bounds,
-            'fit_flag': fit_flag,
+        # the global fitting and the quick look use the g2 time range
+        p = self.check_g2_number()
+        fit_mode = ['per-q', 'global'][self.cb_tauq_fit_mode.currentIndex()]
+        if fit_mode == 'global':
+            # the global fitting uses the g2 settings from the g2 tab; it
+            # only supports the single exp function
+            g2_bounds, g2_fit_flag, _ = self.check_g2_fitting_number()
+            fit_kwargs = {
+                'q_range': q_range,
+                't_range': (p[2], p[3]),
+                'bounds': g2_bounds[:, 0:4],
+                'fit_flag': g2_fit_flag[0:4],
+                'tauq_bounds': bounds,
+                'tauq_flag': fit_flag,
+            }
+        else:
+            fit_kwargs = {
+                'q_range': q_range,
+                'bounds': bounds,
+                'fit_flag': fit_flag,
+                'chi2_max': self.sb_tauq_chi2max.value(),
+            }
+
+        rows = self.get_selected_rows()
+        worker = self.start_fit_job('tauq', rows=rows, fit_mode=fit_mode,
+                                    **fit_kwargs)
+
+        self.fit_plot_kwargs['tauq'] = {
             'offset': self.sb_tauq_offset.value(),
-            'rows': self.get_selected_rows(),
+            'rows': rows,
             'q_range': q_range,
-            'plot_type': self.cb_tauq_type.currentIndex()
+            'plot_type': self.cb_tauq_type.currentIndex(),
+            'fit_ready': worker.done,
+            'chi2_max': self.sb_tauq_chi2max.value(),
+            'show_quick_look': self.tauq_show_quick_look.isChecked(),
+            't_range': (p[2], p[3]),
         }
+        self.redraw_fit_plot('tauq')
+
+    def start_fit_job(self, mode, rows=None, **kwargs):
+        worker, flag = self.vk.submit_fit_job(mode, rows=rows, **kwargs)
+        if flag:
+            worker.signals.result.connect(
+                lambda x, m=mode: self.set_fit_result(m, x))
+            worker.signals.progress.connect(
+                lambda x, m=mode: self.update_fit_progress(m, x))
+            worker.signals.status.connect(
+                lambda x, m=mode: self.finish_fit_job(m, x))
+            self.fit_thread_pool.start(worker)
+        return worker
+
+    def is_current_fit_job(self, mode, jid):
+        # the signals from the killed (stale) jobs are dropped
+        worker = self.vk.fit_worker.get(mode, None)
+        return worker is not None and worker.jid == jid
+
+    def set_fit_result(self, mode, data):
+        # the summary of a file is replaced in the gui thread, where the
+        # plots read it
+        if not self.is_current_fit_job(mode, data[0]):
+            return
+        worker = self.vk.fit_worker[mode]
+        jid, n, summary = data
+        if summary is not None:
+            worker.xf_list[n].fit_summary = summary
+        worker.done[n] = True
+        self.update_fit_plot(mode, (jid, n))
+
+    def update_fit_plot(self, mode, data):
+        if not self.is_current_fit_job(mode, data[0]):
+            return
+        # redraw at most once every fit_timer interval
+        if not self.fit_timer[mode].isActive():
+            self.fit_timer[mode].start()
 
-        msg = self.vk.plot_tauq(hdl=self.mp_tauq.hdl, **kwargs)
-        self.mp_tauq.parent().repaint()
+    def update_fit_progress(self, mode, data):
+        if not self.is_current_fit_job(mode, data[0]):
+            return
+        self.progress_bar.setValue(data[1])
+        self.statusbar.showMessage('%s fitting: %d%%' % (mode, data[1]), 1000)
+
+    def finish_fit_job(self, mode, data):
+        if not self.is_current_fit_job(mode, data[0]):
+            return
+        self.fit_timer[mode].stop()
+        self.redraw_fit_plot(mode)
+        if mode == 'tauq':
+            # the per-q parameters are updated by the global fitting
+            self.plot_tauq_pre()
+        self.statusbar.showMessage('%s fitting %s' % (mode, data[1]), 1000)
+
+    def redraw_fit_plot(self, mode):
+        kwargs = self.fit_plot_kwargs.get(mode, None)
+        if kwargs is None:
+            return
+        if mode == 'g2':
+            try:
+                self.vk.plot_g2(handler=self.mp_g2, **kwargs)
+            except ZeroDivisionError:
+                self.statusbar.showMessage('check range', 1000)
+        else:
+            msg = self.vk.plot_tauq(hdl=self.mp_tauq.hdl, **kwargs)
+            self.mp_tauq.parent().repaint()
+            self.tauq_msg.clear()
+            self.tauq_msg.setData(msg)
+            self.tauq_msg.parent().repaint()
 
-        self.tauq_msg.clear()
-        self.tauq_msg.setData(msg)
-        self.tauq_msg.parent().repaint()
-    
     def select_bkgfile(self):
         path = self.work_dir.text()
         f = QtWidgets.QFileDialog.getOpenFileName(self, 
@@ -585,8 +695,6 @@ class XpcsViewer(QtWidgets.QMainWindow, Ui):
                 'select at least 2 files for averaging', 1000)
             return
 
-        self.thread_pool.setMaxThreadCount(self.max_thread_count.value())
-
         save_path = self.avg_save_path.text()
         save_name = self.avg_save_name.text()
 
@@ -618,14 +726,25 @@ class XpcsViewer(QtWidgets.QMainWindow, Ui):
             'avg_blmax': self.avg_blmax.value(),
             'avg_qindex': self.avg_qindex.value(),
             'avg_window': self.avg_window.value(),
-            'fields': avg_fields
+            'fields': avg_fields,
+            'num_workers': self.sb_avg_workers.value() or None,
+            'mem_budget': self.sb_avg_mem_budget.value() or None,
+            'checkpoint_interval': self.sb_avg_checkpoint.value() or None,
+            'incremental': self.cb_avg_incremental.isChecked(),
+            'group_by': self.le_avg_group_by.text().strip() or None,
+            # one cluster is shown as off
+            'intt_clusters': self.sb_avg_intt_clusters.value() if
+            self.sb_avg_intt_clusters.value() > 1 else None,
+            'weighting': self.cb_avg_weighting.currentText(),
+            'abs_scale': self.cb_avg_abs_scale.isChecked(),
+            'slab_stat': self.cb_avg_slab_stat.isChecked(),
         }
 
         if kwargs['avg_blmax'] <= kwargs['avg_blmin']:
             self.statusbar.showMessage('check avg min/max values.', 1000)
             return
 
-        self.vk.submit_job(**kwargs)
+        self.vk.submit_job(priority=self.sb_avg_priority.value(), **kwargs)
         # the target_average has been reset
         self.update_box(self.vk.target, mode='target')
         self.data_state = 1
@@ -658,18 +777,14 @@ class XpcsViewer(QtWidgets.QMainWindow, Ui):
             self.statusbar.showMessage('select a job to start', 1000)
             return
         worker = self.vk.avg_worker[index]
-        if worker.status == 'finished':
+        if worker.status in ['finished', 'empty']:
             self.statusbar.showMessage('this job has finished', 1000)
             return
         elif worker.status == 'running':
             self.statusbar.showMessage('this job is running.', 1000)
             return
-
-        # worker.signals.progress.connect(worker.update_plot)
-        # worker.signals.progress.connect(self.vk.update_avg_worker)
-        worker.signals.values.connect(self.vk.update_avg_values)
-        self.thread_pool.start(worker)
-        self.vk.avg_worker_active[worker.jid] = None
+        # start it now, regardless of the scheduler limits
+        self.vk.avg_scheduler.start(worker)
 
     def avg_kill_job(self):
         index = self.avg_job_table.currentIndex().row()
@@ -677,17 +792,27 @@ class XpcsViewer(QtWidgets.QMainWindow, Ui):
             self.statusbar.showMessage('select a job to kill', 1000)
             return
         worker = self.vk.avg_worker[index]
-        if worker.status != 'running':
+        if worker.status not in ['running', 'wait']:
             self.statusbar.showMessage('the selected job isn\'s running', 1000)
             return
-        worker.kill()
+        self.vk.avg_scheduler.kill(worker)
+
+    def update_avg_scheduler(self):
+        if self.vk is None:
+            return
+        scheduler = self.vk.avg_scheduler
+        scheduler.set_max_jobs(self.max_thread_count.value())
+        scheduler.set_io_limit(self.sb_avg_io_limit.value() or None)
+        scheduler.set_auto_start(self.cb_avg_auto_start.isChecked())
+        scheduler.activate()
 
     def show_g2_fit_summary_func(self):
         if not self.check_status() or self.vk.type != 'Multitau':
             return
         
         rows = self.get_selected_rows()
-        self.tree = self.vk.get_fitting_tree(rows)
+        self.tree = self.vk.get_fitting_tree(
+            rows, chi2_max=self.sb_tauq_chi2max.value())
         self.tree.show()
 
     def show_avg_jobinfo(self):
@@ -752,7 +877,8 @@ class XpcsViewer(QtWidgets.QMainWindow, Ui):
             'fit_flag': fit_flag,
             'marker_size': self.g2_marker_size.value(),
             'subtract_baseline': self.g2_sub_baseline.isChecked(),
-            'fit_func': fit_func
+            'fit_func': fit_func,
+            'show_quick_look': self.g2_show_quick_look.isChecked(),
             # 'label_size': self.sb_g2_label_size.value(),
         }
         if kwargs['show_fit'] and sum(kwargs['fit_flag']) == 0:
@@ -762,6 +888,20 @@ class XpcsViewer(QtWidgets.QMainWindow, Ui):
         self.pushButton_4.setDisabled(True)
         self.pushButton_4.setText('plotting')
 
+        if kwargs['show_fit']:
+            # the fitting runs in the background; the plot is updated when
+            # the fitting of each file is done
+            worker = self.start_fit_job(
+                'g2', rows=kwargs['rows'], q_range=kwargs['q_range'],
+                t_range=kwargs['t_range'], bounds=bounds, fit_flag=fit_flag,
+                fit_func=fit_func, bootstrap=self.sb_g2_bootstrap.value(),
+                boot_time=self.sb_g2_boot_time.value() or None,
+                save_fit=[None, 'sidecar', 'file'][
+                    self.cb_g2_save_fit.currentIndex()],
+                confirm_file=self.cb_g2_save_fit.currentIndex() == 2)
+            kwargs['fit_ready'] = worker.done
+        self.fit_plot_kwargs['g2'] = kwargs
+
         try:
             self.vk.plot_g2(handler=self.mp_g2, **kwargs)
         except ZeroDivisionError:
@@ -830,6 +970,7 @@ class XpcsViewer(QtWidgets.QMainWindow, Ui):
         self.reload_source()
 
         self.avg_job_table.setModel(self.vk.avg_worker)
+        self.update_avg_scheduler()
         # self.thread = QThread()
         # self.vk.moveToThread(self.thread)
         self.source_model = self.vk.source
@@ -1097,6 +1238,21 @@ class XpcsViewer(QtWidgets.QMainWindow, Ui):
         self.list_view_target.clearSelection()
         # self.list_view_target.repaint()
 
+    def confirm_save_fit(self, idx):
+        # the result files are the primary data; writing the fitting into
+        # them needs an explicit confirmation, otherwise the sidecar is used
+        if idx != 2:
+            return
+        ret = QtWidgets.QMessageBox.question(
+            self, 'Save g2 fitting to the result files',
+            'The g2 fitting will be written into the result files, which '
+            'are the primary data of the beamline. Use a sidecar file '
+            'instead if unsure.\n\nWrite into the result files?',
+            QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No,
+            QtWidgets.QMessageBox.No)
+        if ret != QtWidgets.QMessageBox.Yes:
+            self.cb_g2_save_fit.setCurrentIndex(1)
+
     def update_g2_fitting_function(self):
         idx = self.g2_fitting_function.currentIndex()
         title = [
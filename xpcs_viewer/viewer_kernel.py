@@ -2,6 +2,8 @@ import numpy as np
 from .file_locator import FileLocator
 from .module import saxs2d, saxs1d, intt, stability, g2mod, tauq, twotime
 from .module.average_toolbox import AverageToolbox
+from .module.avg_scheduler import AverageScheduler
+from .module.fit_toolbox import FitToolbox, get_job_key, quick_look
 import h5py
 from .helper.listmodel import TableDataModel
 import pyqtgraph as pg
@@ -23,6 +25,14 @@ class ViewerKernel(FileLocator):
         self.avg_worker = TableDataModel()
         self.avg_jid = 0
         self.avg_worker_active = {}
+        # the restored jobs wait for the limits of the viewer, see
+        # XpcsViewer.update_avg_scheduler
+        self.avg_scheduler = AverageScheduler(self.avg_worker,
+                                              on_start=self.register_avg_job,
+                                              active=False)
+        self.avg_scheduler.load_queue(self.restore_job)
+        self.fit_worker = {}
+        self.fit_jid = 0
 
     def reset_meta(self):
         self.meta = {
@@ -37,8 +47,6 @@ class ViewerKernel(FileLocator):
             'twotime_ims': [],
             'twotime_text': None,
             # avg
-            'avg_file_list': None,
-            'avg_intt_minmax': None,
             'avg_g2_avg': None,
             # g2
             'g2_num_points': None,
@@ -83,11 +91,12 @@ class ViewerKernel(FileLocator):
         xfile = self.cache[self.target[rows[0]]]
         return xfile.get_pg_tree()
     
-    def get_fitting_tree(self, rows, max_points=12):
+    def get_fitting_tree(self, rows, max_points=12, chi2_max=None):
         xf_list = self.get_xf_list(max_points, rows)
         result = {}
         for x in xf_list:
-            result[x.label] = x.get_fitting_info(mode='g2_fitting')
+            result[x.label] = x.get_fitting_info(mode='g2_fitting',
+                                                 chi2_max=chi2_max)
         tree = pg.DataTreeWidget(data=result)
         tree.setWindowTitle('fitting summary')
         tree.resize(1024, 800)
@@ -96,32 +105,65 @@ class ViewerKernel(FileLocator):
     def plot_g2(self, handler, q_range, t_range, y_range, max_points=128,
                 rows=None, **kwargs):
         xf_list = self.get_xf_list(max_points, rows=rows) 
+        if kwargs.get('show_quick_look', False):
+            quick_look(xf_list, q_range, t_range)
         g2mod.pg_plot(handler, xf_list, q_range, t_range, y_range, rows=rows,
                       **kwargs)
         return
 
-    def plot_tauq_pre(self, hdl=None, max_points=128, rows=None):
+    def plot_tauq_pre(self, hdl=None, max_points=128, rows=None,
+                      show_quick_look=False, t_range=None):
         xf_list = self.get_xf_list(max_points, rows=rows)
         short_list = [xf for xf in xf_list if xf.fit_summary is not None]
-        tauq.plot_pre(short_list, hdl)
+        if show_quick_look:
+            quick_look(short_list, t_range=t_range)
+        tauq.plot_pre(short_list, hdl, show_quick_look=show_quick_look)
 
-    def plot_tauq(self, hdl=None, bounds=None, rows=[], plot_type=3,
-                  fit_flag=None, offset=None, max_points=128, q_range=None):
-        
+    def plot_tauq(self, hdl=None, rows=[], plot_type=3, offset=None,
+                  max_points=128, q_range=None, fit_ready=None,
+                  chi2_max=None, show_quick_look=False, t_range=None):
         xf_list = self.get_xf_list(max_points, rows=rows) 
+        fit_mask = [x.fit_summary is not None for x in xf_list]
+        if fit_ready is not None:
+            # only show the files whose fitting in the current job is done
+            fit_mask = [x and y for x, y in zip(fit_mask, fit_ready)]
+        if show_quick_look:
+            # the quick look covers all q in the g2 time range
+            quick_look(xf_list, t_range=t_range)
+
         result = {}
-        for x in xf_list:
-            if x.fit_summary is None:
-                logger.info('g2 fitting is not available for %s', x.fname)
-            else:
-                x.fit_tauq(q_range, bounds, fit_flag)
+        for x, flag in zip(xf_list, fit_mask):
+            if flag:
                 result[x.label] = x.get_fitting_info(mode='tauq_fitting')
         
         tauq.plot(xf_list, hdl=hdl, q_range=q_range, offset=offset,
-                  plot_type=plot_type)
+                  plot_type=plot_type, chi2_max=chi2_max, fit_mask=fit_mask,
+                  show_quick_look=show_quick_look)
 
         return result
 
+    def submit_fit_job(self, mode='g2', rows=None, max_points=128, **kwargs):
+        """
+        create a fitting job for the selected files; the running job of the
+        same mode is killed unless it has the same files and parameters;
+        :param mode: ['g2' | 'tauq']
+        :param kwargs: parameters passed to the fitting of each file
+        :return: tuple of (worker, flag); flag is False if the running job
+            is reused
+        """
+        xf_list = self.get_xf_list(max_points, rows=rows)
+        prev = self.fit_worker.get(mode, None)
+        if prev is not None and prev.is_running():
+            if prev.key == get_job_key(mode, xf_list, kwargs):
+                return prev, False
+            prev.kill()
+
+        worker = FitToolbox(xf_list, mode=mode, jid=self.fit_jid, **kwargs)
+        logger.info('create %s fitting job, ID = %s', mode, worker.jid)
+        self.fit_jid += 1
+        self.fit_worker[mode] = worker
+        return worker, True
+
     def plot_saxs_2d(self, *args, **kwargs):
         ans = [self.cache[fn].saxs_2d for fn in self.target]
         # extents = extent = (qy_min, qy_max, qx_min, qx_max)
@@ -201,23 +243,41 @@ class ViewerKernel(FileLocator):
         fc = self.cache[self.target[plot_id]]
         stability.plot(fc, mp_hdl, **kwargs)
 
-    def submit_job(self, *args, **kwargs):
+    def submit_job(self, *args, priority=0, **kwargs):
         if len(self.target) <= 0:
             logger.error('no average target is selected')
             return
         worker = AverageToolbox(work_dir=self.cwd,
                                 flist=self.target,
-                                jid=self.avg_jid)
+                                jid=self.avg_jid,
+                                priority=priority)
         worker.setup(*args, **kwargs)
-        self.avg_worker.append(worker)
+        worker.signals.values.connect(self.update_avg_values)
+        worker.signals.progress.connect(self.update_avg_progress)
+        self.avg_scheduler.submit(worker)
         logger.info('create average job, ID = %s', worker.jid)
         self.avg_jid += 1
 
         self.target.clear()
         return
 
+    def restore_job(self, config):
+        # create a job saved in the queue of the scheduler
+        worker = AverageToolbox(work_dir=config['work_dir'],
+                                flist=config['flist'],
+                                jid=config['jid'],
+                                priority=config['priority'])
+        worker.setup(**config['kwargs'])
+        worker.signals.values.connect(self.update_avg_values)
+        worker.signals.progress.connect(self.update_avg_progress)
+        self.avg_jid = max(self.avg_jid, worker.jid + 1)
+        return worker
+
+    def register_avg_job(self, worker):
+        self.avg_worker_active[worker.jid] = None
+
     def remove_job(self, index):
-        self.avg_worker.pop(index)
+        self.avg_scheduler.remove(index)
         return
 
     # def register_avg_worker(self, worker):
@@ -229,17 +289,23 @@ class ViewerKernel(FileLocator):
         if 0 <= jid < len(self.avg_worker):
             self.avg_worker[jid].update_plot()
 
+    def update_avg_progress(self, data):
+        # the progress and the rates of the jobs are emitted at the ui rate
+        self.avg_worker.layoutChanged.emit()
+
     def update_avg_values(self, data):
-        key, val = data[0], data[1]
+        # the baselines are emitted in batches
+        key, val = data[0], np.atleast_1d(data[1])
         if self.avg_worker_active[key] is None:
             self.avg_worker_active[key] = [0, np.zeros(128, dtype=np.float32)]
         record = self.avg_worker_active[key]
-        if record[0] == record[1].size:
-            new_g2 = np.zeros(record[1].size * 2, dtype=np.float32)
-            new_g2[0:record[0]] = record[1]
+        if record[0] + val.size > record[1].size:
+            size = max(record[1].size * 2, record[0] + val.size)
+            new_g2 = np.zeros(size, dtype=np.float32)
+            new_g2[0:record[0]] = record[1][0:record[0]]
             record[1] = new_g2
-        record[1][record[0]] = val
-        record[0] += 1
+        record[1][record[0]:record[0] + val.size] = val
+        record[0] += val.size
 
         return
     
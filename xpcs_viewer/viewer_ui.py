@@ -857,6 +857,45 @@ class Ui_mainWindow(object):
         self.g2_plot_type.addItem("")
         self.g2_plot_type.addItem("")
         self.gridLayout_19.addWidget(self.g2_plot_type, 0, 2, 1, 3)
+        self.g2_show_quick_look = QtWidgets.QCheckBox(self.groupBox)
+        sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Preferred, QtWidgets.QSizePolicy.Fixed)
+        sizePolicy.setHorizontalStretch(0)
+        sizePolicy.setVerticalStretch(0)
+        sizePolicy.setHeightForWidth(self.g2_show_quick_look.sizePolicy().hasHeightForWidth())
+        self.g2_show_quick_look.setSizePolicy(sizePolicy)
+        self.g2_show_quick_look.setChecked(False)
+        self.g2_show_quick_look.setObjectName("g2_show_quick_look")
+        self.gridLayout_19.addWidget(self.g2_show_quick_look, 4, 2, 1, 3)
+        self.label_70 = QtWidgets.QLabel(self.groupBox)
+        self.label_70.setObjectName("label_70")
+        self.gridLayout_19.addWidget(self.label_70, 4, 0, 1, 1)
+        self.sb_g2_bootstrap = QtWidgets.QSpinBox(self.groupBox)
+        self.sb_g2_bootstrap.setMaximum(10000)
+        self.sb_g2_bootstrap.setSingleStep(10)
+        self.sb_g2_bootstrap.setProperty("value", 0)
+        self.sb_g2_bootstrap.setObjectName("sb_g2_bootstrap")
+        self.gridLayout_19.addWidget(self.sb_g2_bootstrap, 4, 1, 1, 1)
+        self.label_71 = QtWidgets.QLabel(self.groupBox)
+        self.label_71.setObjectName("label_71")
+        self.gridLayout_19.addWidget(self.label_71, 5, 0, 1, 1)
+        self.sb_g2_boot_time = QtWidgets.QDoubleSpinBox(self.groupBox)
+        self.sb_g2_boot_time.setDecimals(1)
+        self.sb_g2_boot_time.setMaximum(3600.0)
+        self.sb_g2_boot_time.setSingleStep(5.0)
+        self.sb_g2_boot_time.setProperty("value", 30.0)
+        self.sb_g2_boot_time.setObjectName("sb_g2_boot_time")
+        self.gridLayout_19.addWidget(self.sb_g2_boot_time, 5, 1, 1, 1)
+        self.cb_g2_save_fit = QtWidgets.QComboBox(self.groupBox)
+        sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Preferred, QtWidgets.QSizePolicy.Fixed)
+        sizePolicy.setHorizontalStretch(0)
+        sizePolicy.setVerticalStretch(0)
+        sizePolicy.setHeightForWidth(self.cb_g2_save_fit.sizePolicy().hasHeightForWidth())
+        self.cb_g2_save_fit.setSizePolicy(sizePolicy)
+        self.cb_g2_save_fit.setObjectName("cb_g2_save_fit")
+        self.cb_g2_save_fit.addItem("")
+        self.cb_g2_save_fit.addItem("")
+        self.cb_g2_save_fit.addItem("")
+        self.gridLayout_19.addWidget(self.cb_g2_save_fit, 5, 2, 1, 3)
         self.gridLayout_13.addLayout(self.gridLayout_19, 0, 0, 1, 1)
         self.groupBox_2 = QtWidgets.QGroupBox(self.splitter_2)
         sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Preferred, QtWidgets.QSizePolicy.Preferred)
@@ -1115,6 +1154,27 @@ class Ui_mainWindow(object):
         self.sb_tauq_offset.setProperty("value", 0.0)
         self.sb_tauq_offset.setObjectName("sb_tauq_offset")
         self.gridLayout_15.addWidget(self.sb_tauq_offset, 1, 1, 1, 1)
+        self.label_68 = QtWidgets.QLabel(self.groupBox_5)
+        self.label_68.setObjectName("label_68")
+        self.gridLayout_15.addWidget(self.label_68, 2, 0, 1, 1)
+        self.cb_tauq_fit_mode = QtWidgets.QComboBox(self.groupBox_5)
+        self.cb_tauq_fit_mode.setObjectName("cb_tauq_fit_mode")
+        self.cb_tauq_fit_mode.addItem("")
+        self.cb_tauq_fit_mode.addItem("")
+        self.gridLayout_15.addWidget(self.cb_tauq_fit_mode, 2, 1, 1, 1)
+        self.label_69 = QtWidgets.QLabel(self.groupBox_5)
+        self.label_69.setObjectName("label_69")
+        self.gridLayout_15.addWidget(self.label_69, 3, 0, 1, 1)
+        self.sb_tauq_chi2max = QtWidgets.QDoubleSpinBox(self.groupBox_5)
+        self.sb_tauq_chi2max.setDecimals(2)
+        self.sb_tauq_chi2max.setMaximum(1000000.0)
+        self.sb_tauq_chi2max.setSingleStep(0.5)
+        self.sb_tauq_chi2max.setProperty("value", 0.0)
+        self.sb_tauq_chi2max.setObjectName("sb_tauq_chi2max")
+        self.gridLayout_15.addWidget(self.sb_tauq_chi2max, 3, 1, 1, 1)
+        self.tauq_show_quick_look = QtWidgets.QCheckBox(self.groupBox_5)
+        self.tauq_show_quick_look.setObjectName("tauq_show_quick_look")
+        self.gridLayout_15.addWidget(self.tauq_show_quick_look, 4, 0, 1, 2)
         self.gridLayout_38.addLayout(self.gridLayout_15, 1, 1, 1, 1)
         self.gridLayout_21 = QtWidgets.QGridLayout()
         self.gridLayout_21.setObjectName("gridLayout_21")
@@ -1429,6 +1489,86 @@ class Ui_mainWindow(object):
         self.avg_blmin.setProperty("value", 0.95)
         self.avg_blmin.setObjectName("avg_blmin")
         self.gridLayout_28.addWidget(self.avg_blmin, 2, 1, 1, 3)
+        self.label_72 = QtWidgets.QLabel(self.groupBox_8)
+        self.label_72.setObjectName("label_72")
+        self.gridLayout_28.addWidget(self.label_72, 8, 0, 1, 2)
+        self.sb_avg_workers = QtWidgets.QSpinBox(self.groupBox_8)
+        self.sb_avg_workers.setMaximum(256)
+        self.sb_avg_workers.setProperty("value", 0)
+        self.sb_avg_workers.setObjectName("sb_avg_workers")
+        self.gridLayout_28.addWidget(self.sb_avg_workers, 8, 2, 1, 2)
+        self.label_73 = QtWidgets.QLabel(self.groupBox_8)
+        self.label_73.setObjectName("label_73")
+        self.gridLayout_28.addWidget(self.label_73, 9, 0, 1, 2)
+        self.sb_avg_mem_budget = QtWidgets.QSpinBox(self.groupBox_8)
+        self.sb_avg_mem_budget.setMaximum(65536)
+        self.sb_avg_mem_budget.setSingleStep(64)
+        self.sb_avg_mem_budget.setProperty("value", 256)
+        self.sb_avg_mem_budget.setObjectName("sb_avg_mem_budget")
+        self.gridLayout_28.addWidget(self.sb_avg_mem_budget, 9, 2, 1, 2)
+        self.label_74 = QtWidgets.QLabel(self.groupBox_8)
+        self.label_74.setObjectName("label_74")
+        self.gridLayout_28.addWidget(self.label_74, 10, 0, 1, 2)
+        self.sb_avg_checkpoint = QtWidgets.QSpinBox(self.groupBox_8)
+        self.sb_avg_checkpoint.setMaximum(3600)
+        self.sb_avg_checkpoint.setSingleStep(10)
+        self.sb_avg_checkpoint.setProperty("value", 60)
+        self.sb_avg_checkpoint.setObjectName("sb_avg_checkpoint")
+        self.gridLayout_28.addWidget(self.sb_avg_checkpoint, 10, 2, 1, 2)
+        self.cb_avg_incremental = QtWidgets.QCheckBox(self.groupBox_8)
+        self.cb_avg_incremental.setObjectName("cb_avg_incremental")
+        self.gridLayout_28.addWidget(self.cb_avg_incremental, 11, 0, 1, 4)
+        self.label_75 = QtWidgets.QLabel(self.groupBox_8)
+        self.label_75.setObjectName("label_75")
+        self.gridLayout_28.addWidget(self.label_75, 12, 0, 1, 2)
+        self.le_avg_group_by = QtWidgets.QLineEdit(self.groupBox_8)
+        self.le_avg_group_by.setObjectName("le_avg_group_by")
+        self.gridLayout_28.addWidget(self.le_avg_group_by, 12, 2, 1, 2)
+        self.label_76 = QtWidgets.QLabel(self.groupBox_8)
+        self.label_76.setObjectName("label_76")
+        self.gridLayout_28.addWidget(self.label_76, 13, 0, 1, 2)
+        self.sb_avg_priority = QtWidgets.QSpinBox(self.groupBox_8)
+        self.sb_avg_priority.setMinimum(-99)
+        self.sb_avg_priority.setMaximum(99)
+        self.sb_avg_priority.setObjectName("sb_avg_priority")
+        self.gridLayout_28.addWidget(self.sb_avg_priority, 13, 2, 1, 2)
+        self.label_77 = QtWidgets.QLabel(self.groupBox_8)
+        self.label_77.setObjectName("label_77")
+        self.gridLayout_28.addWidget(self.label_77, 14, 0, 1, 2)
+        self.sb_avg_io_limit = QtWidgets.QSpinBox(self.groupBox_8)
+        self.sb_avg_io_limit.setMaximum(100000)
+        self.sb_avg_io_limit.setSingleStep(50)
+        self.sb_avg_io_limit.setObjectName("sb_avg_io_limit")
+        self.gridLayout_28.addWidget(self.sb_avg_io_limit, 14, 2, 1, 2)
+        self.cb_avg_auto_start = QtWidgets.QCheckBox(self.groupBox_8)
+        self.cb_avg_auto_start.setChecked(True)
+        self.cb_avg_auto_start.setObjectName("cb_avg_auto_start")
+        self.gridLayout_28.addWidget(self.cb_avg_auto_start, 15, 0, 1, 4)
+        self.label_78 = QtWidgets.QLabel(self.groupBox_8)
+        self.label_78.setObjectName("label_78")
+        self.gridLayout_28.addWidget(self.label_78, 16, 0, 1, 2)
+        self.sb_avg_intt_clusters = QtWidgets.QSpinBox(self.groupBox_8)
+        self.sb_avg_intt_clusters.setMinimum(1)
+        self.sb_avg_intt_clusters.setMaximum(10)
+        self.sb_avg_intt_clusters.setObjectName("sb_avg_intt_clusters")
+        self.gridLayout_28.addWidget(self.sb_avg_intt_clusters, 16, 2, 1, 2)
+        self.label_79 = QtWidgets.QLabel(self.groupBox_8)
+        self.label_79.setObjectName("label_79")
+        self.gridLayout_28.addWidget(self.label_79, 17, 0, 1, 2)
+        self.cb_avg_weighting = QtWidgets.QComboBox(self.groupBox_8)
+        self.cb_avg_weighting.setObjectName("cb_avg_weighting")
+        self.cb_avg_weighting.addItem("")
+        self.cb_avg_weighting.addItem("")
+        self.cb_avg_weighting.addItem("")
+        self.gridLayout_28.addWidget(self.cb_avg_weighting, 17, 2, 1, 2)
+        self.cb_avg_abs_scale = QtWidgets.QCheckBox(self.groupBox_8)
+        self.cb_avg_abs_scale.setChecked(True)
+        self.cb_avg_abs_scale.setObjectName("cb_avg_abs_scale")
+        self.gridLayout_28.addWidget(self.cb_avg_abs_scale, 18, 0, 1, 4)
+        self.cb_avg_slab_stat = QtWidgets.QCheckBox(self.groupBox_8)
+        self.cb_avg_slab_stat.setChecked(True)
+        self.cb_avg_slab_stat.setObjectName("cb_avg_slab_stat")
+        self.gridLayout_28.addWidget(self.cb_avg_slab_stat, 19, 0, 1, 4)
         self.gridLayout_30.addLayout(self.gridLayout_28, 0, 0, 1, 1)
         self.gridLayout_36.addWidget(self.groupBox_8, 1, 0, 1, 1)
         self.groupBox_12 = QtWidgets.QGroupBox(self.tab_5)
@@ -1881,6 +2021,15 @@ class Ui_mainWindow(object):
         self.g2_plot_type.setItemText(0, _translate("mainWindow", "multiple"))
         self.g2_plot_type.setItemText(1, _translate("mainWindow", "single"))
         self.g2_plot_type.setItemText(2, _translate("mainWindow", "single-combined"))
+        self.g2_show_quick_look.setText(_translate("mainWindow", "quick look"))
+        self.label_70.setText(_translate("mainWindow", "bootstrap:"))
+        self.sb_g2_bootstrap.setSpecialValueText(_translate("mainWindow", "off"))
+        self.label_71.setText(_translate("mainWindow", "boot time (s):"))
+        self.sb_g2_boot_time.setSpecialValueText(_translate("mainWindow", "no limit"))
+        self.cb_g2_save_fit.setToolTip(_translate("mainWindow", "store the g2 fitting in a sidecar file or in the result file; the stored fitting is loaded when the file is reopened"))
+        self.cb_g2_save_fit.setItemText(0, _translate("mainWindow", "don\'t save"))
+        self.cb_g2_save_fit.setItemText(1, _translate("mainWindow", "save to sidecar"))
+        self.cb_g2_save_fit.setItemText(2, _translate("mainWindow", "save to file"))
         self.groupBox_2.setTitle(_translate("mainWindow", "g2 fitting"))
         self.label_66.setText(_translate("mainWindow", "c2"))
         self.label_48.setText(_translate("mainWindow", "baseline:"))
@@ -1916,6 +2065,12 @@ class Ui_mainWindow(object):
         self.cb_tauq_type.setItemText(2, _translate("mainWindow", "log(τ)-q"))
         self.cb_tauq_type.setItemText(3, _translate("mainWindow", "log(τ)-log(q)"))
         self.label_18.setText(_translate("mainWindow", "Offset:"))
+        self.label_68.setText(_translate("mainWindow", "fit mode:"))
+        self.cb_tauq_fit_mode.setItemText(0, _translate("mainWindow", "per q"))
+        self.cb_tauq_fit_mode.setItemText(1, _translate("mainWindow", "global"))
+        self.label_69.setText(_translate("mainWindow", "max chi2:"))
+        self.sb_tauq_chi2max.setSpecialValueText(_translate("mainWindow", "off"))
+        self.tauq_show_quick_look.setText(_translate("mainWindow", "quick look"))
         self.tauq_amax.setText(_translate("mainWindow", "1.00e-3"))
         self.tauq_amax.setPlaceholderText(_translate("mainWindow", "max"))
         self.tauq_qmax.setText(_translate("mainWindow", "0.0092"))
@@ -1984,12 +2139,46 @@ class Ui_mainWindow(object):
         self.bx_avg_saxs.setText(_translate("mainWindow", "saxs 1d/2d"))
         self.label_26.setText(_translate("mainWindow", "selection:"))
         self.label_33.setText(_translate("mainWindow", "avg_window:"))
-        self.label_40.setText(_translate("mainWindow", "max_thread:"))
+        self.label_40.setToolTip(_translate("mainWindow", "maximal number of average jobs running at the same time"))
+        self.label_40.setText(_translate("mainWindow", "max_jobs:"))
         self.cb_avg_chunk_size.setItemText(0, _translate("mainWindow", "32"))
         self.cb_avg_chunk_size.setItemText(1, _translate("mainWindow", "64"))
         self.cb_avg_chunk_size.setItemText(2, _translate("mainWindow", "128"))
         self.cb_avg_chunk_size.setItemText(3, _translate("mainWindow", "256"))
         self.cb_avg_chunk_size.setItemText(4, _translate("mainWindow", "512"))
+        self.label_72.setText(_translate("mainWindow", "workers:"))
+        self.sb_avg_workers.setToolTip(_translate("mainWindow", "number of processes to read and accumulate the files of one job"))
+        self.sb_avg_workers.setSpecialValueText(_translate("mainWindow", "auto"))
+        self.label_73.setText(_translate("mainWindow", "memory (MB):"))
+        self.sb_avg_mem_budget.setToolTip(_translate("mainWindow", "memory budget of each worker to stream G2, IP and IF slab by slab"))
+        self.sb_avg_mem_budget.setSpecialValueText(_translate("mainWindow", "no limit"))
+        self.label_74.setText(_translate("mainWindow", "checkpoint (s):"))
+        self.sb_avg_checkpoint.setToolTip(_translate("mainWindow", "interval to save the state of a job; a resubmitted job with the same files and parameters resumes from it"))
+        self.sb_avg_checkpoint.setSpecialValueText(_translate("mainWindow", "off"))
+        self.cb_avg_incremental.setToolTip(_translate("mainWindow", "if the output is an average of some of the files, only read the new files and add them to it"))
+        self.cb_avg_incremental.setText(_translate("mainWindow", "extend the existing output"))
+        self.label_75.setText(_translate("mainWindow", "group by:"))
+        self.le_avg_group_by.setToolTip(_translate("mainWindow", "a regular expression of the filename, or a metadata key such as X_energy, to average the files in groups; one output per group"))
+        self.le_avg_group_by.setPlaceholderText(_translate("mainWindow", "regex or metadata key"))
+        self.label_76.setText(_translate("mainWindow", "priority:"))
+        self.sb_avg_priority.setToolTip(_translate("mainWindow", "the waiting jobs with higher priority are started first"))
+        self.label_77.setText(_translate("mainWindow", "I/O limit (MB/s):"))
+        self.sb_avg_io_limit.setToolTip(_translate("mainWindow", "no job is started while the running jobs read faster than this"))
+        self.sb_avg_io_limit.setSpecialValueText(_translate("mainWindow", "no limit"))
+        self.cb_avg_auto_start.setToolTip(_translate("mainWindow", "start the waiting jobs automatically within the limits"))
+        self.cb_avg_auto_start.setText(_translate("mainWindow", "start the jobs automatically"))
+        self.label_78.setText(_translate("mainWindow", "Int-t clusters:"))
+        self.sb_avg_intt_clusters.setToolTip(_translate("mainWindow", "cluster the files by Int-t before averaging; only the largest cluster is averaged"))
+        self.sb_avg_intt_clusters.setSpecialValueText(_translate("mainWindow", "off"))
+        self.label_79.setText(_translate("mainWindow", "weighting:"))
+        self.cb_avg_weighting.setToolTip(_translate("mainWindow", "the weights of the files: uniform, inverse variance from g2_err, or the mean intensity of Int-t"))
+        self.cb_avg_weighting.setItemText(0, _translate("mainWindow", "uniform"))
+        self.cb_avg_weighting.setItemText(1, _translate("mainWindow", "inverse_variance"))
+        self.cb_avg_weighting.setItemText(2, _translate("mainWindow", "intensity"))
+        self.cb_avg_abs_scale.setToolTip(_translate("mainWindow", "weight saxs_1d by the absolute cross section scale of each file"))
+        self.cb_avg_abs_scale.setText(_translate("mainWindow", "weight saxs_1d by the abs. scale"))
+        self.cb_avg_slab_stat.setToolTip(_translate("mainWindow", "save the std_err of G2, IP and IF and the state to extend the output; both are as large as the averaged fields"))
+        self.cb_avg_slab_stat.setText(_translate("mainWindow", "save the statistics of G2, IP, IF"))
         self.groupBox_12.setTitle(_translate("mainWindow", "Action:"))
         self.btn_submit_job.setText(_translate("mainWindow", "submit"))
         self.avg_job_pop.setText(_translate("mainWindow", "delete"))
@@ -1,61 +1,80 @@
 import os
 import numpy as np
-from .fileIO.hdf_reader import get, get_type, create_id, get_abs_cs_scale
+from .fileIO.hdf_reader import (get, put, get_group, put_attrs, get_type,
+                                create_id, get_abs_cs_scale)
 from .fileIO.ftype_utils import get_ftype
 from .plothandler.matplot_qt import MplCanvasBarV
 from .module import saxs2d, saxs1d, intt, stability, g2mod
 from .module.g2mod import create_slice
-from .helper.fitting import fit_with_fixed
+from .helper.fitting import (fit_with_fixed, fit_g2_global, fit_tauq_batch,
+                              fit_bootstrap, get_g2_p0, correct_g2_err,
+                              goodness_of_fit, pack_fit_result,
+                              single_exp_all, double_exp_all, power_law)
 import pyqtgraph as pg
 from .fileIO.hdf_to_str import get_hdf_info
 from pyqtgraph.Qt import QtGui
 import traceback
+import logging
 
 
+logger = logging.getLogger(__name__)
 
-
-def single_exp_all(x, a, b, c, d):
-    """
-    single exponential fitting for xpcs-multitau analysis
-    :param x: delay in seconds
-    :param a: contrast
-    :param b: tau
-    :param c: restriction factor
-    :param d: baseline
-    :return:
-    """
-    return a * np.exp(-2 * (x / b) ** c) + d
+# the version of the stored g2 fitting results; increase it when the content
+# of fit_summary changes so the outdated results are not loaded
+fit_result_version = 2
+fit_result_group = '/xpcs_viewer/g2_fitting'
+fit_result_keys = ['fit_func', 'fit_res', 'p0_mode', 't_el', 'q_val',
+                   'q_range', 't_range', 'bounds', 'fit_flag', 'fit_x',
+                   'fit_y', 'fit_residual', 'fit_corr', 'fit_cond',
+                   'fit_boot_err', 'fit_boot_ci', 'fit_boot_num']
+# the settings that decide a g2 fitting; they are stored as the attributes
+# of fit_result_group and a stored result is only loaded if all of them
+# match, see match_fit_key
+fit_key_fields = ('fit_func', 'q_range', 't_range', 'bounds', 'fit_flag',
+                  'bootstrap', 'boot_time')
 
 
-def double_exp_all(x, a, b1, c1, d, b2, c2, f):
+def get_fit_key(fit_func, q_range, t_range, bounds, fit_flag, bootstrap,
+                boot_time):
     """
-    double exponential fitting for xpcs-multitau analysis
-    Args:
-        x: delay in seconds, float or 1d-numpy.ndarray
-        a: contrast
-        f: fraction for the 1st exp function; the 2nd has (1-f) weight
-        b1: tau for 1st exp function
-        c1: restriction factor for the 1st exp function
-        b2: tau for 2nd exp function
-        c2: restriction factor for the 2nd exp function
-        d: baseline
-    Return:
-        function value
+    get the settings of a g2 fitting, see fit_key_fields; the numbers are
+    kept as arrays to be compared numerically, and None is an empty range
+    or a nan boot_time, as hdf attributes can't hold it
     """
-    t1 = np.exp(-1 * (x / b1) ** c1) * f
-    t2 = np.exp(-1 * (x / b2) ** c2) * (1 - f)
-    return a * (t1 + t2) ** 2 + d
+    def to_array(x):
+        return np.asarray([] if x is None else x, dtype=np.float64)
 
+    return {
+        'fit_func': str(fit_func),
+        'q_range': to_array(q_range),
+        't_range': to_array(t_range),
+        'bounds': to_array(bounds),
+        'fit_flag': np.asarray(fit_flag, dtype=bool),
+        'bootstrap': int(bootstrap),
+        'boot_time': np.nan if boot_time is None else float(boot_time),
+    }
 
-def power_law(x, a, b):
+
+def match_fit_key(key, other):
     """
-    power law for fitting the diffusion factor
-    :param x: tau
-    :param a:
-    :param b:
-    :return:
+    check if two fitting settings from get_fit_key are the same; the
+    numbers are compared with np.allclose, so the ones read back from a
+    file match
     """
-    return a * x ** b
+    if key is None or other is None:
+        return False
+    for field in fit_key_fields:
+        if field not in key or field not in other:
+            return False
+        if field == 'fit_func':
+            if str(key[field]) != str(other[field]):
+                return False
+            continue
+        x, y = np.asarray(key[field]), np.asarray(other[field])
+        if x.shape != y.shape or not np.allclose(x, y, rtol=1e-9, atol=0,
+                                                 equal_nan=True):
+            return False
+    return True
 
 
 def reshape_static_analysis(info):
@@ -110,6 +129,9 @@ class XpcsFile(object):
 
         self.hdf_info = None
         self.fit_summary = None
+        self.quick_look = None
+        # if the result file has a stored g2 fitting; None if not checked
+        self.fit_in_file = None
 
     def __str__(self):
         ans = ['File:' + str(self.full_path)]
@@ -442,32 +464,49 @@ class XpcsFile(object):
         if abs(self.fit_summary['q_val'][idx] - q) > tor:
             return None, None
 
-        fit_x = self.fit_summary['fit_line'][idx]['fit_x']
-        fit_y = self.fit_summary['fit_line'][idx]['fit_y']
-        return fit_x, fit_y
+        if not self.fit_summary['fit_res']['success'][idx]:
+            return None, None
+        return self.fit_summary['fit_x'], self.fit_summary['fit_y'][idx]
 
-    def get_fitting_info(self, mode='g2_fitting'):
+    def get_fitting_info(self, mode='g2_fitting', chi2_max=None):
         if self.fit_summary is None:
             return "fitting is not ready for %s" % self.label
 
         if mode == 'g2_fitting':
             result = self.fit_summary.copy()
-            # fit_line is not useful to display
-            result.pop('fit_line', None)
-            val = result.pop('fit_val', None)
+            # the fitting lines and the diagnostic arrays are not useful to
+            # display
+            for key in ['fit_x', 'fit_y', 'fit_residual', 'fit_corr',
+                        'fit_boot_ci', 'fit_key']:
+                result.pop(key, None)
+            fit_res = result.pop('fit_res')
+            result['fit_nfev'] = int(np.sum(fit_res['nfev']))
             if result['fit_func'] == 'single':
                 prefix = ['a', 'b', 'c', 'd']
             else:
                 prefix = ['a', 'b', 'c', 'd', 'b2', 'c2', 'f']
 
+            chi2 = fit_res['chi2']
+            boot_err = result.pop('fit_boot_err', None)
+            if 'fit_boot_num' in result:
+                result['fit_boot_num'] = int(np.max(result['fit_boot_num']))
+            valid = self.get_g2_fit_mask(chi2_max)
             msg = []
-            for n in range(val.shape[0]):
+            for n in range(fit_res.size):
+                if chi2_max and not valid[n]:
+                    continue
                 temp = []
                 for m in range(len(prefix)):
                     temp.append('%s = %f ± %f' % (
-                        prefix[m], val[n, 0, m], val[n, 1, m]))
+                        prefix[m], fit_res['val'][n, m],
+                        fit_res['err'][n, m]))
+                    if boot_err is not None:
+                        temp[-1] += ' (boot ± %f)' % boot_err[n, m]
+                temp.append('chi2 = %.3f' % chi2[n])
                 msg.append(', '.join(temp))
             result['fit_val'] = np.array(msg)
+            if chi2_max:
+                result['excluded_q'] = result['q_val'][~valid]
 
         elif mode == 'tauq_fitting':
             if 'tauq_fit_val' not in self.fit_summary:
@@ -476,13 +515,17 @@ class XpcsFile(object):
                 v = self.fit_summary['tauq_fit_val']
                 result = "a = %e ± %e; b = %f ± %f" % (v[0, 0], v[1, 0],
                                                        v[0, 1], v[1, 1])
+                if 'tauq_chi2' in self.fit_summary:
+                    result += "; chi2 = %.3f" % self.fit_summary['tauq_chi2']
         else:
             raise ValueError('mode not supported.')
 
         return result
 
     def fit_g2(self, q_range=None, t_range=None, bounds=None,
-               fit_flag=None, fit_func='single'):
+               fit_flag=None, fit_func='single', p0_mode='auto',
+               bootstrap=0, boot_time=None, save_fit=None,
+               confirm_file=False, update=True):
         """
         fit the g2 values using single exponential decay function
         :param q_range: a tuple of q lower bound and upper bound
@@ -491,6 +534,25 @@ class XpcsFile(object):
         :param fit_flag: tuple of bools; True to fit and False to float
         :param fit_func: ['single' | 'double']: to fit with single exponential
             or double exponential function
+        :param p0_mode: ['auto' | 'bounds' | 'estimate' | 'neighbor' |
+            'previous']: how to seed the fitting. 'bounds' uses the center
+            of the bounds for every q; 'estimate' uses a log-linear
+            pre-estimate for each q; 'neighbor' seeds each q with the
+            solution of the previous q; 'previous' reuses the last fitting
+            of this file. 'auto' uses 'previous' when the last fitting
+            covers the same q values, otherwise 'neighbor';
+        :param bootstrap: the number of bootstrap replicates used to estimate
+            the uncertainty of the parameters; 0 to skip the bootstrap;
+        :param boot_time: the time limit of the bootstrap in seconds; None
+            for no limit;
+        :param save_fit: [None | 'sidecar' | 'file']: where to store the
+            fitting result, see save_fit_result; None to keep it in memory
+            only. The stored result with the same settings (fit_key_fields)
+            is loaded instead of fitting again when the file is reopened;
+        :param confirm_file: True to confirm that save_fit='file' writes to
+            the result file; otherwise the sidecar is used;
+        :param update: if True, the result is assigned to fit_summary;
+            False to only return it, e.g. in a worker thread
         :return: dictionary with the fitting result;
         """
         assert len(bounds) == 2
@@ -513,6 +575,15 @@ class XpcsFile(object):
         if t_range is None:
             q_range = [np.min(self.t_el) * 0.95, np.max(self.t_el) * 1.05]
 
+        fit_key = get_fit_key(fit_func, q_range, t_range, bounds, fit_flag,
+                              bootstrap, boot_time)
+        if self.fit_summary is None:
+            stored = self.load_fit_result(fit_key)
+            if stored is not None:
+                if update:
+                    self.fit_summary = stored
+                return stored
+
         # create a data slice for the given range;
         t_slice = create_slice(self.t_el, t_range)
         q_slice = create_slice(self.ql_dyn, q_range)
@@ -522,22 +593,49 @@ class XpcsFile(object):
         g2 = self.g2[t_slice, q_slice]
         sigma = self.g2_err_mod[t_slice, q_slice]
 
-        # set the initial guess
-        p0 = np.array(bounds).mean(axis=0)
-        # tau's bounds are in log scale, set as the geometric average
-        p0[1] = np.sqrt(bounds[0][1] * bounds[1][1])
-        if fit_func == 'double':
-            p0[4] = np.sqrt(bounds[0][4] * bounds[1][4])
+        p0, p0_mode = self.get_g2_p0(t_el, q, g2, bounds, fit_func, p0_mode)
 
         fit_x = np.logspace(np.log10(np.min(t_el)) - 0.5,
                             np.log10(np.max(t_el)) + 0.5, 128)
 
         fit_line, fit_val = fit_with_fixed(func, t_el, g2, sigma,
-                                           bounds, fit_flag, fit_x, p0=p0)
-
-        self.fit_summary = {
+                                           bounds, fit_flag, fit_x, p0=p0,
+                                           warm_start=(p0_mode == 'neighbor'))
+
+        gof = goodness_of_fit(func, t_el, g2, sigma, fit_val, fit_flag)
+
+        boot = None
+        prev = self.fit_summary
+        if bootstrap > 0 and prev is not None and 'fit_boot_err' in prev \
+                and match_fit_key(prev.get('fit_key', None), fit_key) and \
+                prev['fit_res']['val'].shape == fit_val[:, 0].shape and \
+                np.allclose(prev['fit_res']['val'], fit_val[:, 0],
+                            rtol=1e-6, atol=0, equal_nan=True):
+            # the replicates of the same settings are only reused if the
+            # fitting converged to the same optimum; a warm start or another
+            # p0_mode can end up elsewhere
+            boot = {'err': prev['fit_boot_err'], 'ci': prev['fit_boot_ci'],
+                    'num': prev['fit_boot_num']}
+        elif bootstrap > 0:
+            boot = fit_bootstrap(func, t_el, g2, sigma, bounds, fit_flag,
+                                 fit_val, num_boot=bootstrap,
+                                 time_budget=boot_time)
+
+        fit_res, fit_x, fit_y = pack_fit_result(fit_line, fit_val, gof['chi2'])
+
+        msg = 'g2 fitting of %s with p0_mode=%s used %d function evaluations'
+        args = [self.label, p0_mode, np.sum(fit_res['nfev'])]
+        if self.fit_summary is not None and \
+                self.fit_summary.get('fit_mode', 'per-q') == 'per-q' and \
+                self.fit_summary['fit_func'] == fit_func:
+            msg += '; the previous fitting used %d'
+            args.append(np.sum(self.fit_summary['fit_res']['nfev']))
+        logger.info(msg, *args)
+
+        summary = {
             'fit_func': fit_func,
-            'fit_val': fit_val,
+            'fit_res': fit_res,
+            'p0_mode': p0_mode,
             't_el': t_el,
             'q_val': q,
             # 'g2': g2,
@@ -546,73 +644,345 @@ class XpcsFile(object):
             't_range': str(t_range),
             'bounds': bounds,
             'fit_flag': str(fit_flag),
-            'fit_line': fit_line
+            'fit_x': fit_x,
+            'fit_y': fit_y,
+            'fit_residual': gof['residual'],
+            'fit_corr': gof['corr'],
+            'fit_cond': gof['cond'],
+            'fit_key': fit_key,
         }
+        if boot is not None:
+            summary.update({
+                'fit_boot_err': boot['err'],
+                'fit_boot_ci': boot['ci'],
+                'fit_boot_num': boot['num'],
+            })
+
+        if save_fit is not None:
+            self.save_fit_result(save_fit, confirm_file, summary)
+        if update:
+            self.fit_summary = summary
+        return summary
+
+    def get_g2_data(self, q_range=None, t_range=None):
+        """
+        get g2 in the given ranges
+        :param q_range: a tuple of q lower bound and upper bound
+        :param t_range: a tuple of t lower bound and upper bound
+        :return: a tuple of (t_el, q, g2, g2_err)
+        """
+        t_slice = create_slice(self.t_el, t_range)
+        q_slice = create_slice(self.ql_dyn, q_range)
+        return (self.t_el[t_slice], self.ql_dyn[q_slice],
+                self.g2[t_slice, q_slice], self.g2_err_mod[t_slice, q_slice])
 
-        return self.fit_summary
+    def get_g2_p0(self, t_el, q, g2, bounds, fit_func='single',
+                  p0_mode='auto'):
+        """
+        get the initial values for the g2 fitting
+        :param t_el: delay in seconds for the selected range
+        :param q: q values for the selected range
+        :param g2: g2 values in the selected range, (t_el.size, q.size)
+        :param bounds: bounds for fitting;
+        :param fit_func: ['single' | 'double']
+        :param p0_mode: see fit_g2
+        :return: tuple of (p0, p0_mode); p0 has the shape of
+            (num_args, ) for 'bounds' and (q.size, num_args) otherwise;
+            p0_mode is the mode actually used;
+        """
+        if p0_mode == 'auto':
+            prev = self.fit_summary
+            if prev is not None and prev['fit_func'] == fit_func and \
+                    prev['q_val'].shape == q.shape and \
+                    np.allclose(prev['q_val'], q):
+                p0_mode = 'previous'
+            else:
+                p0_mode = 'neighbor'
+
+        p0 = get_g2_p0(t_el, g2, bounds, fit_func,
+                       estimate=(p0_mode != 'bounds'))
+        if p0_mode == 'bounds':
+            return p0, p0_mode
+
+        if p0_mode == 'previous':
+            prev = self.fit_summary
+            if prev is None or prev['fit_res'].size != q.size or \
+                    prev['fit_func'] != fit_func:
+                logger.info('no previous fitting to reuse; use estimate')
+                p0_mode = 'estimate'
+            else:
+                # only reuse the successful ones; failed fittings have -1 err
+                valid = prev['fit_res']['success']
+                p0[valid] = prev['fit_res']['val'][valid]
+
+        return p0, p0_mode
 
     @staticmethod
     def correct_g2_err(g2_err=None, threshold=1E-6):
-        # correct the err for some data points with really small error, which
-        # may cause the fitting to blowup
-
-        g2_err_mod = np.copy(g2_err)
-        for n in range(g2_err.shape[1]):
-            data = g2_err[:, n]
-            idx = data > threshold
-            # avoid averaging of empty slice
-            if np.sum(idx) > 0:
-                avg = np.mean(data[idx])
-            else:
-                avg = threshold
-            g2_err_mod[np.logical_not(idx), n] = avg
+        return correct_g2_err(g2_err, threshold)
 
-        return g2_err_mod
+    def get_g2_fit_mask(self, chi2_max=None):
+        """
+        get the mask of the good g2 fittings
+        :param chi2_max: the maximal reduced chi-square; None or 0 to keep
+            all successful fittings
+        :return: bool array, one for each q in fit_summary['q_val']
+        """
+        fit_res = self.fit_summary['fit_res']
+        valid = fit_res['success'].copy()
+        if chi2_max:
+            valid &= fit_res['chi2'] <= chi2_max
+        return valid
 
-    def fit_tauq(self, q_range, bounds, fit_flag):
+    def get_tauq_data(self, q_range, chi2_max=None):
+        """
+        get the tau(q) values from the g2 fitting in the q range
+        :param q_range: the q range for the power law fitting
+        :param chi2_max: the g2 fittings with larger reduced chi-square are
+            excluded; None or 0 to keep all successful fittings
+        :return: a tuple of (q, tau, tau_err); None if g2 is not fitted
+        """
         if self.fit_summary is None:
-            return
+            return None
 
         x = self.fit_summary['q_val']
         q_slice = create_slice(x, q_range)
         x = x[q_slice]
 
-        y = self.fit_summary['fit_val'][q_slice, 0, 1]
-        sigma = self.fit_summary['fit_val'][q_slice, 1, 1]
+        y = self.fit_summary['fit_res']['val'][q_slice, 1]
+        sigma = self.fit_summary['fit_res']['err'][q_slice, 1]
 
-        # filter out those invalid fittings; failed g2 fitting has -1 err
-        valid_idx = (sigma > 0)
+        # tau(q) needs the error of tau; failed g2 fitting has -1 err, and
+        # a fixed tau has 0
+        valid_idx = self.get_g2_fit_mask(chi2_max)[q_slice] & (sigma > 0)
+        return x[valid_idx], y[valid_idx], sigma[valid_idx]
 
-        if np.sum(valid_idx) == 0:
-            self.fit_summary['tauq_success'] = False
+    def get_tauq_summary(self, data, fit_line, fit_val, fit_flag):
+        """
+        get a copy of fit_summary with the tau(q) fitting result; the
+        fit_summary itself is not modified
+        :param data: the tuple of (q, tau, tau_err) used for the fitting
+        :param fit_line: the fitting line of this file
+        :param fit_val: the fitting value of this file, (2, 2)
+        :param fit_flag: 2 bools for [a, b]
+        :return: the new fitting summary
+        """
+        x, y, sigma = data
+        gof = goodness_of_fit(power_law, x, y.reshape(-1, 1),
+                              sigma.reshape(-1, 1), fit_val[None], fit_flag)
+        return dict(self.fit_summary, tauq_chi2=gof['chi2'][0],
+                    tauq_success=fit_line['success'], tauq_q=x, tauq_tau=y,
+                    tauq_tau_err=sigma, tauq_fit_line=fit_line,
+                    tauq_fit_val=fit_val)
+
+    def fit_tauq(self, q_range, bounds, fit_flag, chi2_max=None):
+        data = self.get_tauq_data(q_range, chi2_max)
+        if data is None:
             return
 
-        x = x[valid_idx]
-        y = y[valid_idx]
-        sigma = sigma[valid_idx]
+        if data[0].size == 0:
+            self.fit_summary = dict(self.fit_summary, tauq_success=False)
+            return
 
-        # reshape to two-dimension so the fit_with_fixed function works
-        y = y.reshape(-1, 1)
-        sigma = sigma.reshape(-1, 1)
+        x, y, sigma = data
+        fit_line, fit_val = fit_tauq_batch([x], [y], [sigma], bounds,
+                                           fit_flag)
 
-        # the initial value for typical gel systems
-        p0 = [1.0e-7, -2.0]
-        fit_x = np.logspace(np.log10(np.min(x) / 1.1),
-                            np.log10(np.max(x) * 1.1), 128)
+        # fit_line and fit_val have just one element;
+        self.fit_summary = self.get_tauq_summary(data, fit_line[0],
+                                                 fit_val[0], fit_flag)
+        return self.fit_summary
 
-        fit_line, fit_val = fit_with_fixed(power_law, x, y, sigma, bounds,
-                                           fit_flag, fit_x, p0=p0)
+    def fit_g2_global(self, q_range=None, t_range=None, bounds=None,
+                      fit_flag=None, tauq_bounds=None, tauq_flag=None,
+                      update=True):
+        """
+        fit g2 of all q in one problem with the single exponential function,
+        where tau follows a shared power law tau = a * q ^ b; the contrast,
+        stretch and baseline are fitted for each q. the result has the same
+        keys as fit_g2 followed by fit_tauq.
+        :param q_range: a tuple of q lower bound and upper bound
+        :param t_range: a tuple of t lower bound and upper bound
+        :param bounds: bounds of the single exp function, (2, 4);
+        :param fit_flag: tuple of 4 bools; True to fit and False to fix
+        :param tauq_bounds: bounds of the power law, (2, 2)
+        :param tauq_flag: tuple of 2 bools for a and b
+        :param update: see fit_g2
+        :return: dictionary with the fitting result;
+        """
+        assert len(bounds[0]) == 4, \
+            "global fitting only supports single exp; bounds must be (2, 4)"
+        if fit_flag is None:
+            fit_flag = [True for _ in range(4)]
+        if tauq_flag is None:
+            tauq_flag = [True, True]
 
-        # fit_line and fit_val are lists with just one element;
-        self.fit_summary['tauq_success'] = fit_line[0]['success']
-        self.fit_summary['tauq_q'] = x
-        self.fit_summary['tauq_tau'] = np.squeeze(y)
-        self.fit_summary['tauq_tau_err'] = np.squeeze(sigma)
-        self.fit_summary['tauq_fit_line'] = fit_line[0]
-        self.fit_summary['tauq_fit_val'] = fit_val[0]
+        t_slice = create_slice(self.t_el, t_range)
+        q_slice = create_slice(self.ql_dyn, q_range)
+
+        t_el = self.t_el[t_slice]
+        q = self.ql_dyn[q_slice]
+        g2 = self.g2[t_slice, q_slice]
+        sigma = self.g2_err_mod[t_slice, q_slice]
+
+        p0 = get_g2_p0(t_el, g2, bounds, 'single')
+        fit_x = np.logspace(np.log10(np.min(t_el)) - 0.5,
+                            np.log10(np.max(t_el)) + 0.5, 128)
+
+        fit_line, fit_val, tauq_val, success, msg = fit_g2_global(
+            t_el, q, g2, sigma, bounds, fit_flag, tauq_bounds, tauq_flag,
+            fit_x, p0=p0)
+
+        # tau is derived from the power law but varies with q
+        gof = goodness_of_fit(single_exp_all, t_el, g2, sigma, fit_val,
+                              [fit_flag[0], True, fit_flag[2], fit_flag[3]])
+
+        fit_res, fit_x, fit_y = pack_fit_result(fit_line, fit_val, gof['chi2'])
+
+        tauq_x = np.logspace(np.log10(np.min(q) / 1.1),
+                             np.log10(np.max(q) * 1.1), 128)
+        tauq_line = {'fit_x': tauq_x,
+                     'fit_y': power_law(tauq_x, *tauq_val[0]),
+                     'success': success, 'msg': msg}
+
+        summary = {
+            'fit_func': 'single',
+            'fit_mode': 'global',
+            'fit_res': fit_res,
+            't_el': t_el,
+            'q_val': q,
+            'q_range': str(q_range),
+            't_range': str(t_range),
+            'bounds': bounds,
+            'fit_flag': str(fit_flag),
+            'fit_x': fit_x,
+            'fit_y': fit_y,
+            'fit_residual': gof['residual'],
+            'fit_corr': gof['corr'],
+            'fit_cond': gof['cond'],
+            'tauq_success': success,
+            'tauq_q': q,
+            'tauq_tau': fit_val[:, 0, 1],
+            'tauq_tau_err': fit_val[:, 1, 1],
+            'tauq_fit_line': tauq_line,
+            'tauq_fit_val': tauq_val,
+        }
+        if update:
+            self.fit_summary = summary
+        return summary
+
+    def get_fit_result_path(self, location='sidecar'):
+        """
+        get the file to store the g2 fitting result
+        :param location: ['sidecar' | 'file']; 'sidecar' is a separate hdf
+            file next to the result file, so the result file is not modified;
+            'file' is the result file itself
+        :return: the path of the hdf file
+        """
+        if location == 'sidecar':
+            return self.full_path + '.fit'
+        elif location == 'file':
+            return self.full_path
+        else:
+            raise ValueError('location not supported: %s' % location)
+
+    def export_fit_result(self, fname, group=fit_result_group, summary=None):
+        """
+        write the g2 fitting result to a hdf file; the parameters, errors
+        and flags of all q are in one compound dataset, so each array is
+        written at once;
+        :param fname: the hdf file to write; it is created if not existing
+        :param group: the group to hold the fitting result
+        :param summary: the fitting summary to write; None for fit_summary
+        :return: None
+        """
+        if summary is None:
+            summary = self.fit_summary
+        if summary is None:
+            logger.info('g2 fitting is not available for %s', self.label)
+            return
+
+        result = {group + '/version': fit_result_version}
+        for key in fit_result_keys:
+            if key not in summary:
+                continue
+            val = summary[key]
+            if not isinstance(val, str):
+                val = np.asarray(val)
+            result[group + '/' + key] = val
+        put(fname, result, mode='raw', keep_shape=True)
+        if 'fit_key' in summary:
+            put_attrs(fname, group, summary['fit_key'])
+
+    def save_fit_result(self, location='sidecar', confirm_file=False,
+                        summary=None):
+        """
+        store the per-q g2 fitting result, so it can be loaded when the
+        file is reopened; the global fitting is not stored;
+        :param location: ['sidecar' | 'file'], see get_fit_result_path
+        :param confirm_file: the result files are the primary data, so
+            they are only written with location='file' if True; otherwise
+            the sidecar is used
+        :param summary: see export_fit_result
+        :return: None
+        """
+        if summary is None:
+            summary = self.fit_summary
+        if summary is None or summary.get('fit_mode', 'per-q') != 'per-q':
+            return
+        if location == 'file' and not confirm_file:
+            logger.warning('writing to the result file is not confirmed; '
+                           'save the g2 fitting of %s to the sidecar',
+                           self.label)
+            location = 'sidecar'
+        fname = self.get_fit_result_path(location)
+        try:
+            self.export_fit_result(fname, summary=summary)
+        except Exception:
+            logger.error('failed to save the g2 fitting to %s: %s', fname,
+                         traceback.format_exc())
+        else:
+            logger.info('g2 fitting of %s is saved to %s', self.label, fname)
+            if location == 'file':
+                self.fit_in_file = True
+
+    def load_fit_result(self, fit_key):
+        """
+        load the stored g2 fitting result; the sidecar file is checked
+        before the result file, which is only read once for each instance;
+        :param fit_key: the settings of the fitting from get_fit_key; the
+            stored result with different settings (see fit_key_fields) or an
+            old version is ignored
+        :return: the fitting summary; None if not available
+        """
+        for location in ['sidecar', 'file']:
+            fname = self.get_fit_result_path(location)
+            if location == 'sidecar' and not os.path.isfile(fname):
+                continue
+            if location == 'file':
+                if self.fit_in_file is False:
+                    continue
+                self.fit_in_file = False
+            try:
+                ret = get_group(fname, fit_result_group, attrs=True)
+            except Exception:
+                logger.error('failed to read the g2 fitting from %s: %s',
+                             fname, traceback.format_exc())
+                continue
+            if ret is None:
+                continue
+            if location == 'file':
+                self.fit_in_file = True
+            ret, attrs = ret
+            if ret.pop('version', None) != fit_result_version or \
+                    not match_fit_key(attrs, fit_key):
+                logger.info('the stored g2 fitting in %s is outdated', fname)
+                continue
+            ret['fit_key'] = {k: attrs[k] for k in fit_key_fields}
+            logger.info('load the stored g2 fitting from %s', fname)
+            return ret
+        return None
 
-        return self.fit_summary
-    
     def compute_qmap(self):
         shape = self.saxs_2d.shape
         k0 = 2 * np.pi / (12.398 / self.X_energy)